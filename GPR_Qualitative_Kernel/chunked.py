@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Memory-bounded prediction over very large candidate sets.
+
+predict() of a fitted regressor evaluates the cross-kernel K(X, X_train_)
+for the whole query matrix at once, so sweeping a parameter grid with
+millions of candidates needs n_candidates * n_train floats, several times
+over for the standard deviations.  predict_chunked() streams the predictions
+block by block instead, with blocks sized to a memory budget, and
+predict_top_k() keeps only the k best candidates in a running heap.
+
+Both work with GaussianProcessRegressor and SparseGaussianProcessRegressor,
+which have them as methods through ChunkedPredictionMixin.
+"""
+from __future__ import print_function
+
+import heapq
+
+import numpy as np
+
+# rows per block when neither chunk_size nor max_memory is given
+DEFAULT_CHUNK_SIZE = 4096
+
+# working arrays of n_basis floats per query row: K_trans and the
+# triangular (or CG) solves of the standard deviations
+_ARRAYS_PER_ROW = 4
+
+
+def chunk_rows(gpr, n_features, chunk_size=None, max_memory=None):
+    """Returns the number of query rows per block.
+
+    chunk_size wins if given; otherwise the rows are sized so that the
+    working arrays of one block take about max_memory bytes.
+    """
+    if chunk_size is not None:
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive, got %r"
+                             % chunk_size)
+        return int(chunk_size)
+    if max_memory is None:
+        return DEFAULT_CHUNK_SIZE
+    basis = getattr(gpr, "inducing_points_", getattr(gpr, "X_train_", None))
+    n_basis = 1 if basis is None else basis.shape[0]
+    row_bytes = 8 * (_ARRAYS_PER_ROW * n_basis + n_features)
+    return max(1, int(max_memory // row_bytes))
+
+
+def predict_chunked(gpr, X, return_std=False, chunk_size=None,
+                    max_memory=None):
+    """Predicts X block by block.
+
+    Parameters
+    ----------
+    gpr : GaussianProcessRegressor or SparseGaussianProcessRegressor
+        The (usually fitted) regressor
+
+    X : array-like or DataFrame, shape = (n_samples, n_features)
+        Query points; only one block is converted at a time
+
+    return_std : bool, default: False
+        If True, the standard deviations are yielded with the means.
+
+    chunk_size : int, optional
+        The number of rows per block
+
+    max_memory : int, optional
+        The approximate number of bytes of the working arrays of one block,
+        used if chunk_size is None
+
+    Yields
+    ------
+    rows : slice
+        The rows of X in the block
+
+    y_mean : array, shape = (n_rows, [n_output_dims])
+        Mean of predictive distribution at the rows
+
+    y_std : array, shape = (n_rows, [n_output_dims]), optional
+        Standard deviation at the rows, if return_std is True
+    """
+    n_samples, n_features = np.shape(X)
+    step = chunk_rows(gpr, n_features, chunk_size, max_memory)
+    take = X.iloc.__getitem__ if hasattr(X, "iloc") else X.__getitem__
+    for start in range(0, n_samples, step):
+        rows = slice(start, min(start + step, n_samples))
+        preds = gpr.predict(np.asarray(take(rows)), return_std=return_std)
+        if return_std:
+            yield (rows,) + tuple(preds)
+        else:
+            yield rows, preds
+
+
+def predict_top_k(gpr, X, k, kappa=0.0, chunk_size=None, max_memory=None):
+    """The k candidates of X with the lowest mean - kappa * std.
+
+    kappa = 0 selects the lowest predicted means, kappa > 0 the lowest
+    lower confidence bounds.  Only the first output dimension is scored.
+    The predictions are streamed as in predict_chunked() and the best k
+    are kept in a heap, so memory does not grow with the size of X.
+
+    Returns
+    -------
+    index : array of int, shape = (k,)
+        Rows of X, best first
+
+    y_mean : array, shape = (k,)
+        Their predicted means
+
+    y_std : array, shape = (k,)
+        Their standard deviations (zeros if kappa is 0)
+    """
+    if k < 1:
+        raise ValueError("k must be positive, got %r" % k)
+    return_std = kappa != 0.0
+    # a max-heap of (-score, -row, mean, std) holding the best k so far;
+    # of equal scores the first row is kept
+    heap = []
+    for block in predict_chunked(gpr, X, return_std, chunk_size, max_memory):
+        rows, y_mean = block[0], _first_output(block[1])
+        y_std = _first_output(block[2]) if return_std \
+            else np.zeros_like(y_mean)
+        score = y_mean - kappa * y_std
+        # only the best k of a block can enter the heap
+        for i in np.argsort(score, kind="mergesort")[:k]:
+            item = (-score[i], -(rows.start + i), y_mean[i], y_std[i])
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+    heap.sort(reverse=True)
+    index = np.array([-item[1] for item in heap], dtype=int)
+    y_mean = np.array([item[2] for item in heap])
+    y_std = np.array([item[3] for item in heap])
+    return index, y_mean, y_std
+
+
+class ChunkedPredictionMixin(object):
+    """Mixin for regressors with predict(X, return_std), adding
+    predict_chunked and predict_top_k."""
+
+    def predict_chunked(self, X, return_std=False, chunk_size=None,
+                        max_memory=None):
+        """Generator of predictions on X, block by block.
+
+        Yields (rows, y_mean[, y_std]) for consecutive slices rows of X,
+        each block at most chunk_size rows or about max_memory bytes of
+        working arrays; see predict_chunked() of this module.
+        """
+        return predict_chunked(self, X, return_std, chunk_size, max_memory)
+
+    def predict_top_k(self, X, k, kappa=0.0, chunk_size=None,
+                      max_memory=None):
+        """The k rows of X with the lowest mean - kappa * std.
+
+        Returns their indices (best first), means and standard deviations;
+        see predict_top_k() of this module.
+        """
+        return predict_top_k(self, X, k, kappa, chunk_size, max_memory)
+
+
+def _first_output(a):
+    return a[:, 0] if a.ndim > 1 else a
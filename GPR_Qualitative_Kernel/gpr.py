@@ -5,21 +5,32 @@
 # License: BSD 3 clause
 
 import warnings
+from collections import OrderedDict
 from operator import itemgetter
 
 import numpy as np
 from scipy.linalg import cholesky, cho_solve, solve_triangular
+from scipy.linalg import eigh_tridiagonal
 from scipy.optimize import fmin_l_bfgs_b
 
 from sklearn.base import BaseEstimator, RegressorMixin, clone
 # added 'log' parameter to Hyperparameter named_tuple
 #from sklearn.gaussian_process.kernels import RBF, ConstantKernel as C
 from kernels import RBF, ConstantKernel as C
+from kernels import TrainingDataCache, ThetaLayout
+from kernel_plan import compile_kernel, KernelPlan
+from qualitative_kernels import prefetch_hyperspheres
+from kronecker import kronecker_grid
+from chunked import ChunkedPredictionMixin
+from persistence import PersistenceMixin
+from sklearn.exceptions import ConvergenceWarning
 from sklearn.utils import check_random_state
 from sklearn.utils.validation import check_X_y, check_array
+from sklearn.externals.joblib import Parallel, delayed
 
 
-class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
+class GaussianProcessRegressor(ChunkedPredictionMixin, PersistenceMixin,
+                               BaseEstimator, RegressorMixin):
     """Gaussian process regression (GPR).
 
     The implementation is based on Algorithm 2.1 of Gaussian Processes
@@ -109,6 +120,69 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
         given, it fixes the seed. Defaults to the global numpy random
         number generator.
 
+    n_jobs : int, optional (default: 1)
+        The number of processes used to run the optimizer restarts in
+        parallel. If -1, all CPUs are used. The initial thetas of all
+        restarts are drawn from random_state before any run starts, so the
+        result does not depend on n_jobs. Large training arrays are
+        memory-mapped by joblib and shared with the workers, not copied.
+
+    lml_cache_size : int, optional (default: 0)
+        The number of log-marginal likelihood evaluations (value and gradient,
+        keyed on theta) kept in a least-recently-used cache while fitting, so
+        that thetas revisited by a custom optimizer are not evaluated again.
+        Off by default: fmin_l_bfgs_b evaluates value and gradient together
+        and does not revisit thetas, so the cache would never be hit.
+
+    n_restart_candidates : int, optional (default: 0)
+        If larger than n_restarts_optimizer, this many thetas are drawn
+        log-uniform from the bounds and screened with one batched call of
+        log_marginal_likelihood_batch; the optimizer is restarted from the
+        n_restarts_optimizer best of them instead of from random thetas.
+
+    kronecker : boolean or "auto", optional (default: False)
+        Whether to exploit training data on a full factorial grid (e.g. from
+        ParameterGrid) with a product kernel over its blocks of columns; see
+        the module kronecker. K is then never formed: the log-marginal
+        likelihood, its gradient and predictions cost O(sum n_b^3 + N * sum
+        n_b) for blocks of n_b values and N = prod n_b training points.
+        Requires a scalar alpha. If True, fit raises a ValueError unless the
+        kernel and data have this structure; if "auto", it is used when they
+        do. add_observations is not supported on such fits.
+
+    solver : string, optional (default: "cholesky")
+        How linear systems in K + alpha * I are solved. "cholesky" factorizes
+        it. "cg" is matrix-free: K is only used through matrix products, the
+        systems are solved by (Jacobi-)preconditioned conjugate gradients,
+        log |K| is estimated by stochastic Lanczos quadrature and the trace
+        terms of the gradient by Hutchinson probes, all from one batched CG
+        run per theta. This needs O(n^2) memory and no O(n^3) factorization,
+        for n of about 10^4. add_observations is not supported with "cg".
+
+    cg_tol : float, optional (default: 1e-6)
+        Relative residual tolerance of the conjugate gradients (solver="cg")
+
+    n_probes : int, optional (default: 16)
+        The number of random probe vectors of the stochastic estimates
+        (solver="cg"). They are drawn once per fit, so the estimated
+        log-marginal likelihood is a deterministic function of theta.
+
+    dtype : numpy dtype, optional (default: np.float64)
+        The floating point type the kernel on the training data, and its
+        gradient, are computed in. With np.float32 the cached distances and
+        the buffers of the compiled kernel take half the memory and use
+        single precision arithmetic. K is converted to float64 before it is
+        factorized, so the Cholesky factor, the solves and the log-marginal
+        likelihood stay in double precision.
+
+    output_scale : boolean, optional (default: False)
+        Whether each output dimension of y has its own scale: y[:, k] is
+        modelled with covariance s_k^2 * (K + alpha * I). The scales are
+        profiled out of the log-marginal likelihood in closed form, so the
+        outputs share the kernel hyperparameters, K and its Cholesky factor
+        without any extra hyperparameters to optimize. Useful for targets
+        on different scales, e.g. a loss and a runtime.
+
     Attributes
     ----------
     X_train_ : array-like, shape = (n_samples, n_features)
@@ -123,6 +197,11 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
 
     L_ : array-like, shape = (n_samples, n_samples)
         Lower-triangular Cholesky decomposition of the kernel in ``X_train_``
+        (None for Kronecker-structured fits and solver="cg")
+
+    kronecker_ : KroneckerDecomposition or None
+        The eigendecomposition of the kernel in ``X_train_`` if the fit is
+        Kronecker-structured
 
     alpha_ : array-like, shape = (n_samples,)
         Dual coefficients of training data points in kernel space
@@ -130,10 +209,33 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
     log_marginal_likelihood_value_ : float
         The log-marginal-likelihood of ``self.kernel_.theta``
 
+    output_scale_ : array, shape = (n_output_dims,)
+        The fitted scale s_k of each output dimension (only if output_scale)
+
+    lml_cache_hits_ : int
+        The number of log-marginal likelihood evaluations served from the
+        cache since the last fit
+
+    lml_cache_misses_ : int
+        The number of log-marginal likelihood evaluations computed since the
+        last fit
+
+    cg_n_iter_ : int
+        The number of conjugate gradient iterations of the last solve
+        (solver="cg"); a ConvergenceWarning is issued when it reaches
+        n_samples without meeting cg_tol
+
     """
+    # written to .npy files by save(), see persistence
+    _saved_arrays = ("X_train_", "y_train_", "L_", "alpha_", "_K", "_probes")
+    _saved_private = ("_n_added", "_lml_per_sample")
+
     def __init__(self, kernel=None, alpha=1e-10,
                  optimizer="fmin_l_bfgs_b", n_restarts_optimizer=0,
-                 normalize_y=False, copy_X_train=True, random_state=None):
+                 normalize_y=False, copy_X_train=True, random_state=None,
+                 n_jobs=1, lml_cache_size=0, output_scale=False,
+                 n_restart_candidates=0, kronecker=False, solver="cholesky",
+                 cg_tol=1e-6, n_probes=16, dtype=np.float64):
         self.kernel = kernel
         self.alpha = alpha
         self.optimizer = optimizer
@@ -141,6 +243,15 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
         self.normalize_y = normalize_y
         self.copy_X_train = copy_X_train
         self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.lml_cache_size = lml_cache_size
+        self.output_scale = output_scale
+        self.n_restart_candidates = n_restart_candidates
+        self.kronecker = kronecker
+        self.solver = solver
+        self.cg_tol = cg_tol
+        self.n_probes = n_probes
+        self.dtype = dtype
 
     def fit(self, X, y):
         """Fit Gaussian process regression model
@@ -157,6 +268,11 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
         -------
         self : returns an instance of self.
         """
+        return self._fit(X, y, self.alpha)
+
+    def _fit(self, X, y, alpha):
+        """Fit with the noise alpha of the training samples, which
+        add_observations extends without changing the parameter alpha."""
         if self.kernel is None:  # Use an RBF kernel as default
             self.kernel_ = C(1.0, constant_value_bounds="fixed") \
                 * RBF(1.0, length_scale_bounds="fixed")
@@ -164,6 +280,8 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
             self.kernel_ = clone(self.kernel)
 
         self.rng = check_random_state(self.random_state)
+        if self.solver not in ("cholesky", "cg"):
+            raise ValueError("Unknown solver %s." % self.solver)
 
         X, y = check_X_y(X, y, multi_output=True, y_numeric=True)
 
@@ -175,33 +293,31 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
         else:
             self.y_train_mean = np.zeros(1)
 
-        if np.iterable(self.alpha) \
-           and self.alpha.shape[0] != y.shape[0]:
-            if self.alpha.shape[0] == 1:
-                self.alpha = self.alpha[0]
+        if np.iterable(alpha) \
+           and alpha.shape[0] != y.shape[0]:
+            if alpha.shape[0] == 1:
+                alpha = alpha[0]
             else:
                 raise ValueError("alpha must be a scalar or an array"
                                  " with same number of entries as y.(%d != %d)"
-                                 % (self.alpha.shape[0], y.shape[0]))
+                                 % (alpha.shape[0], y.shape[0]))
+        self.alpha_train_ = alpha
 
         self.X_train_ = np.copy(X) if self.copy_X_train else X
         self.y_train_ = np.copy(y) if self.copy_X_train else y
+        probes = None
+        if self.solver == "cg":
+            # Rademacher probes, fixed for the whole fit
+            probes = self.rng.randint(
+                2, size=(self.X_train_.shape[0], self.n_probes)) * 2.0 - 1.0
+        self._prepare_training_data(probes)
 
         if self.optimizer is not None and self.kernel_.n_dims > 0:
             # Choose hyperparameters based on maximizing the log-marginal
             # likelihood (potentially starting from several initial values)
-            def obj_func(theta, eval_gradient=True):
-                if eval_gradient:
-                    lml, grad = self.log_marginal_likelihood(
-                        theta, eval_gradient=True)
-                    return -lml, -grad
-                else:
-                    return -self.log_marginal_likelihood(theta)
-
             # First optimize starting from theta specified in kernel
-            optima = [(self._constrained_optimization(obj_func,
-                                                      self.kernel_.theta,
-                                                      self.kernel_.bounds))]
+            bounds = self.kernel_.bounds
+            initial_thetas = [self.kernel_.theta]
 
             # Additional runs are performed from log-uniform chosen initial
             # theta
@@ -210,28 +326,219 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
                     raise ValueError(
                         "Multiple optimizer restarts (n_restarts_optimizer>0) "
                         "requires that all bounds are finite.")
-                bounds = self.kernel_.bounds
-                for iteration in range(self.n_restarts_optimizer):
-                    theta_initial = \
-                        self.rng.uniform(bounds[:, 0], bounds[:, 1])
-                    optima.append(
-                        self._constrained_optimization(obj_func, theta_initial,
-                                                       bounds))
+                if self.n_restart_candidates > self.n_restarts_optimizer:
+                    # screen many candidates at once, restart from the best
+                    candidates = self.rng.uniform(
+                        bounds[:, 0], bounds[:, 1],
+                        size=(self.n_restart_candidates, bounds.shape[0]))
+                    lml = self.log_marginal_likelihood_batch(candidates)
+                    best = np.argsort(-lml, kind="mergesort")
+                    initial_thetas.extend(
+                        candidates[best[:self.n_restarts_optimizer]])
+                else:
+                    for iteration in range(self.n_restarts_optimizer):
+                        initial_thetas.append(
+                            self.rng.uniform(bounds[:, 0], bounds[:, 1]))
+
+            if self.n_jobs == 1 or len(initial_thetas) == 1:
+                optima = [self._constrained_optimization(self._obj_func,
+                                                         theta_initial,
+                                                         bounds)
+                          for theta_initial in initial_thetas]
+            else:
+                # only the parameters and the training data are sent to
+                # the workers, not the caches of this estimator
+                params = self.get_params(deep=False)
+                params["kernel"] = clone(self.kernel_)
+                optima = Parallel(n_jobs=self.n_jobs)(
+                    delayed(_restart_optimization)(
+                        params, self.X_train_, self.y_train_,
+                        self.alpha_train_, self._probes, theta_initial,
+                        bounds)
+                    for theta_initial in initial_thetas)
             # Select result from run with minimal (negative) log-marginal
             # likelihood
             lml_values = list(map(itemgetter(1), optima))
-            self.kernel_.theta = optima[np.argmin(lml_values)][0]
+            theta_opt = optima[np.argmin(lml_values)][0]
+            self.kernel_.theta = theta_opt
             self.log_marginal_likelihood_value_ = -np.min(lml_values)
         else:
+            theta_opt = self.kernel_.theta
             self.log_marginal_likelihood_value_ = \
-                self.log_marginal_likelihood(self.kernel_.theta)
+                self.log_marginal_likelihood(theta_opt)
 
         # Precompute quantities required for predictions which are independent
-        # of actual query points
-        K = self.kernel_(self.X_train_)
-        K[np.diag_indices_from(K)] += self.alpha
-        self.L_ = cholesky(K, lower=True)  # Line 2
-        self.alpha_ = cho_solve((self.L_, True), self.y_train_)  # Line 3
+        # of actual query points; the optimizer has usually factorized K at
+        # the winning theta already
+        key = np.asarray(theta_opt, dtype=np.float64).tobytes()
+        self.kronecker_ = None
+        if self._kronecker_grid is not None:
+            self.L_ = None
+            self.kronecker_ = self._kronecker_grid.decompose(
+                theta_opt, self.alpha_train_)
+        elif self.solver == "cg":
+            self.L_ = None
+            K = np.asarray(self.kernel_(self.X_train_), dtype=np.float64)
+            K[np.diag_indices_from(K)] += self.alpha_train_
+            self._K = K
+        elif self._best_cholesky is not None and \
+                self._best_cholesky[0] == key:
+            self.L_ = self._best_cholesky[2]
+        else:
+            K = np.asarray(self.kernel_(self.X_train_), dtype=np.float64)
+            K[np.diag_indices_from(K)] += self.alpha_train_
+            self.L_ = cholesky(K, lower=True)  # Line 2
+        self._keep_cholesky = False
+        self._best_cholesky = None
+        if self.kronecker_ is not None:
+            self.alpha_ = self.kronecker_.solve(self.y_train_)
+        elif self.L_ is None:
+            self.alpha_ = self._cg_solve(self.y_train_)
+        else:
+            self.alpha_ = cho_solve((self.L_, True), self.y_train_)  # Line 3
+        if self.output_scale:
+            self.output_scale_ = np.sqrt(self._output_scale2(self.y_train_,
+                                                             self.alpha_))
+
+        # reference point for add_observations
+        self._n_added = 0
+        self._lml_per_sample = \
+            self.log_marginal_likelihood_value_ / self.X_train_.shape[0]
+
+        return self
+
+    def _prepare_training_data(self, probes=None):
+        """Sets up the state log_marginal_likelihood keeps on X_train_,
+        with the CG probes (solver="cg")."""
+        # distances etc. of X_train_ reused while theta is optimized
+        self._training_data_cache = TrainingDataCache(self.X_train_,
+                                                      self.dtype)
+        self._reset_lml_cache()
+        self._keep_cholesky = True
+        self._kronecker_grid = None
+        # only set by solver="cg", not left over from an earlier fit
+        self._K = None
+        self._probes = probes
+        if self.kronecker:
+            grid = None if np.iterable(self.alpha_train_) \
+                else kronecker_grid(self.kernel_, self.X_train_)
+            if grid is None and self.kronecker != "auto":
+                raise ValueError(
+                    "kronecker=True requires a scalar alpha, and training "
+                    "data on a full factorial grid of the blocks of columns "
+                    "of a product kernel.")
+            self._kronecker_grid = grid
+
+    def add_observations(self, X, y, alpha=None, refit_interval=None,
+                         lml_tolerance=None):
+        """Add training data without refitting the kernel hyperparameters
+
+        The Cholesky factor of the training kernel is extended by the k new
+        rows, which costs O(n^2 k) instead of the O(n^3) of a new
+        factorization. A full fit (including hyperparameter optimization)
+        on all the data is run instead when refit_interval observations have
+        been added since the last fit, or when the log-marginal likelihood
+        per sample has drifted by more than lml_tolerance.
+
+        Parameters
+        ----------
+        X : array-like, shape = (n_new_samples, n_features)
+            New training data
+
+        y : array-like, shape = (n_new_samples, [n_output_dims])
+            New target values
+
+        alpha : float or array-like, optional (default: None)
+            Value added to the diagonal of the kernel for the new samples.
+            Required if the training samples have an array of alphas;
+            defaults to their scalar alpha_train_ otherwise.
+
+        refit_interval : int, optional (default: None)
+            Refit once this many observations have been added since the last
+            call to fit. If None, the number of additions never forces a refit.
+
+        lml_tolerance : float, optional (default: None)
+            Refit when the log-marginal likelihood per sample differs from its
+            value after the last fit by more than this. If None, drift is not
+            checked.
+
+        Returns
+        -------
+        self : returns an instance of self.
+        """
+        if not hasattr(self, "X_train_"):
+            return self.fit(X, y)
+        if self.L_ is None:
+            raise ValueError("Observations can only be added to a fit with "
+                             "a Cholesky factor (solver='cholesky', not "
+                             "Kronecker-structured); call fit instead.")
+
+        X, y = check_X_y(X, y, multi_output=True, y_numeric=True)
+        if X.shape[1] != self.X_train_.shape[1]:
+            raise ValueError("X has %d features, training data has %d"
+                             % (X.shape[1], self.X_train_.shape[1]))
+
+        if alpha is None:
+            if np.iterable(self.alpha_train_):
+                raise ValueError("alpha must be given for the new samples "
+                                 "when alpha is an array")
+            alpha_all = self.alpha_train_
+        else:
+            alpha_all = np.hstack(
+                (np.broadcast_to(self.alpha_train_,
+                                 (self.X_train_.shape[0],)),
+                 np.broadcast_to(alpha, (X.shape[0],))))
+
+        y_all = np.concatenate((self.y_train_ + self.y_train_mean, y))
+        X_all = np.vstack((self.X_train_, X))
+        self._n_added += X.shape[0]
+
+        if refit_interval is not None and self._n_added >= refit_interval:
+            return self._fit(X_all, y_all, alpha_all)
+
+        # Extend L by the new block rows (with hyperparameters fixed):
+        # [[K, B], [B^T, C]] = [[L, 0], [S^T, L22]] [[L^T, S], [0, L22^T]]
+        # where S = L^-1 B and L22 L22^T = C - S^T S
+        n = self.X_train_.shape[0]
+        B = self.kernel_(self.X_train_, X)
+        C = self.kernel_(X)
+        C[np.diag_indices_from(C)] += \
+            alpha_all[n:] if np.iterable(alpha_all) else alpha_all
+        S = solve_triangular(self.L_, B, lower=True, check_finite=False)
+        try:
+            L22 = cholesky(C - S.T.dot(S), lower=True)
+        except np.linalg.LinAlgError:
+            # the new points are (numerically) dependent on the old ones
+            return self._fit(X_all, y_all, alpha_all)
+        L = np.zeros((n + X.shape[0], n + X.shape[0]))
+        L[:n, :n] = self.L_
+        L[n:, :n] = S.T
+        L[n:, n:] = L22
+
+        if self.normalize_y:
+            self.y_train_mean = np.mean(y_all, axis=0)
+        self.alpha_train_ = alpha_all
+        self.X_train_ = X_all
+        self._training_data_cache = TrainingDataCache(self.X_train_,
+                                                      self.dtype)
+        self.y_train_ = y_all - self.y_train_mean
+        self.L_ = L
+        self.alpha_ = cho_solve((self.L_, True), self.y_train_)
+        self._reset_lml_cache()
+        self._best_cholesky = None
+
+        # log-marginal likelihood at the fixed theta, compare line 7
+        self.log_marginal_likelihood_value_ = \
+            self._log_likelihood_dims(self.y_train_, self.alpha_, L).sum(-1)
+        if self.output_scale:
+            self.output_scale_ = np.sqrt(self._output_scale2(self.y_train_,
+                                                             self.alpha_))
+
+        if lml_tolerance is not None:
+            drift = abs(self.log_marginal_likelihood_value_ / L.shape[0]
+                        - self._lml_per_sample)
+            if drift > lml_tolerance:
+                return self.fit(self.X_train_, y_all)
 
         return self
 
@@ -261,13 +568,15 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
         y_mean : array, shape = (n_samples, [n_output_dims])
             Mean of predictive distribution a query points
 
-        y_std : array, shape = (n_samples,), optional
+        y_std : array, shape = (n_samples, [n_output_dims]), optional
             Standard deviation of predictive distribution at query points.
-            Only returned when return_std is True.
+            Only returned when return_std is True. Has one column per
+            output dimension only if output_scale is True.
 
-        y_cov : array, shape = (n_samples, n_samples), optional
+        y_cov : array, shape = (n_samples, n_samples, [n_output_dims]), optional
             Covariance of joint predictive distribution a query points.
-            Only returned when return_cov is True.
+            Only returned when return_cov is True. Has one slice per
+            output dimension only if output_scale is True.
         """
         if return_std and return_cov:
             raise RuntimeError(
@@ -286,22 +595,33 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
                 return y_mean, np.sqrt(y_var)
             else:
                 return y_mean
+        elif getattr(self, "kronecker_", None) is not None:
+            return self._predict_kronecker(X, return_std, return_cov)
         else:  # Predict based on GP posterior
             K_trans = self.kernel_(X, self.X_train_)
             y_mean = K_trans.dot(self.alpha_)  # Line 4 (y_mean = f_star)
             y_mean = self.y_train_mean + y_mean  # undo normal.
             if return_cov:
-                v = cho_solve((self.L_, True), K_trans.T)  # Line 5
+                if self.L_ is None:
+                    v = self._cg_solve(K_trans.T)
+                else:
+                    v = cho_solve((self.L_, True), K_trans.T)  # Line 5
                 y_cov = self.kernel_(X) - K_trans.dot(v)  # Line 6
+                if self.output_scale:
+                    y_cov = self._scale_outputs(y_cov, 2)
                 return y_mean, y_cov
             elif return_std:
-                # compute inverse K_inv of K based on its Cholesky
-                # decomposition L and its inverse L_inv
-                L_inv = solve_triangular(self.L_.T, np.eye(self.L_.shape[0]))
-                K_inv = L_inv.dot(L_inv.T)
-                # Compute variance of predictive distribution
+                # Compute variance of predictive distribution from
+                # V = L^-1 K_trans^T, since k_*^T K^-1 k_* = |L^-1 k_*|^2;
+                # one triangular solve per batch, K_inv is never formed
                 y_var = self.kernel_.diag(X)
-                y_var -= np.einsum("ki,kj,ij->k", K_trans, K_trans, K_inv)
+                if self.L_ is None:
+                    y_var -= np.einsum("ij,ji->i", K_trans,
+                                       self._cg_solve(K_trans.T))
+                else:
+                    V = solve_triangular(self.L_, K_trans.T, lower=True,
+                                         check_finite=False)
+                    y_var -= np.einsum("ij,ij->j", V, V)
 
                 # Check if any of the variances is negative because of
                 # numerical issues. If yes: set the variance to 0.
@@ -310,10 +630,45 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
                     warnings.warn("Predicted variances smaller than 0. "
                                   "Setting those variances to 0.")
                     y_var[y_var_negative] = 0.0
-                return y_mean, np.sqrt(y_var)
+                y_std = np.sqrt(y_var)
+                if self.output_scale:
+                    y_std = self._scale_outputs(y_std, 1)
+                return y_mean, y_std
             else:
                 return y_mean
 
+    def _restore(self):
+        """Rebuilds the caches of a loaded model."""
+        self._training_data_cache = TrainingDataCache(self.X_train_,
+                                                      self.dtype)
+        self._reset_lml_cache()
+        self._keep_cholesky = False
+        kronecker = getattr(self, "kronecker_", None)
+        self._kronecker_grid = None if kronecker is None else kronecker.grid
+
+    def _predict_kronecker(self, X, return_std, return_cov):
+        """predict for a Kronecker-structured fit."""
+        y_mean = self.y_train_mean + self.kronecker_.predict_mean(
+            X, self.alpha_)
+        if return_cov:
+            y_cov = self.kronecker_.predict_cov(X)
+            if self.output_scale:
+                y_cov = self._scale_outputs(y_cov, 2)
+            return y_mean, y_cov
+        elif return_std:
+            y_var = self.kronecker_.predict_var(X)
+            y_var_negative = y_var < 0
+            if np.any(y_var_negative):
+                warnings.warn("Predicted variances smaller than 0. "
+                              "Setting those variances to 0.")
+                y_var[y_var_negative] = 0.0
+            y_std = np.sqrt(y_var)
+            if self.output_scale:
+                y_std = self._scale_outputs(y_std, 1)
+            return y_mean, y_std
+        else:
+            return y_mean
+
     def sample_y(self, X, n_samples=1, random_state=0):
         """Draw samples from Gaussian process and evaluate at X.
 
@@ -341,7 +696,9 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
             y_samples = rng.multivariate_normal(y_mean, y_cov, n_samples).T
         else:
             y_samples = \
-                [rng.multivariate_normal(y_mean[:, i], y_cov,
+                [rng.multivariate_normal(y_mean[:, i],
+                                         y_cov[..., i] if y_cov.ndim == 3
+                                         else y_cov,
                                          n_samples).T[:, np.newaxis]
                  for i in range(y_mean.shape[1])]
             y_samples = np.hstack(y_samples)
@@ -378,17 +735,44 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
                     "Gradient can only be evaluated for theta!=None")
             return self.log_marginal_likelihood_value_
 
-        kernel = self.kernel_.clone_with_theta(theta)
+        theta = np.asarray(theta, dtype=np.float64)
+        key = theta.tobytes()
+        cache = getattr(self, "_lml_cache", None)
+        if cache is not None and key in cache:
+            log_likelihood, log_likelihood_gradient = cache.pop(key)
+            if not eval_gradient or log_likelihood_gradient is not None:
+                # most recently used entries are kept at the end
+                cache[key] = log_likelihood, log_likelihood_gradient
+                self.lml_cache_hits_ += 1
+                if eval_gradient:
+                    return log_likelihood, log_likelihood_gradient.copy()
+                else:
+                    return log_likelihood
+        if cache is not None:
+            self.lml_cache_misses_ += 1
+
+        if getattr(self, "_kronecker_grid", None) is not None:
+            return self._kronecker_log_marginal_likelihood(theta, key,
+                                                           eval_gradient)
 
-        if eval_gradient:
-            K, K_gradient = kernel(self.X_train_, eval_gradient=True)
+        plan = self._kernel_plan()
+        if plan is not None:
+            K = plan(theta)
         else:
+            kernel = self._kernel_with_theta(theta)
             K = kernel(self.X_train_)
-
-        K[np.diag_indices_from(K)] += self.alpha
+        # computed in self.dtype, factorized in double precision
+        K = np.asarray(K, dtype=np.float64)
+
+        K[np.diag_indices_from(K)] += self.alpha_train_
+        if self.solver == "cg":
+            return self._cg_log_marginal_likelihood(
+                theta, key, K, plan if plan is not None else kernel,
+                eval_gradient)
         try:
             L = cholesky(K, lower=True)  # Line 2
         except np.linalg.LinAlgError:
+            self._cache_lml(key, -np.inf, np.zeros_like(theta))
             return (-np.inf, np.zeros_like(theta)) \
                 if eval_gradient else -np.inf
 
@@ -400,26 +784,340 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
         alpha = cho_solve((L, True), y_train)  # Line 3
 
         # Compute log-likelihood (compare line 7)
-        log_likelihood_dims = -0.5 * np.einsum("ik,ik->k", y_train, alpha)
-        log_likelihood_dims -= np.log(np.diag(L)).sum()
-        log_likelihood_dims -= K.shape[0] / 2 * np.log(2 * np.pi)
+        log_likelihood_dims = self._log_likelihood_dims(y_train, alpha, L)
         log_likelihood = log_likelihood_dims.sum(-1)  # sum over dimensions
 
         if eval_gradient:  # compare Equation 5.9 from GPML
-            tmp = np.einsum("ik,jk->ijk", alpha, alpha)  # k: output-dimension
-            tmp -= cho_solve((L, True), np.eye(K.shape[0]))[:, :, np.newaxis]
-            # Compute "0.5 * trace(tmp.dot(K_gradient))" without
-            # constructing the full matrix tmp.dot(K_gradient) since only
-            # its diagonal is required
-            log_likelihood_gradient_dims = \
-                0.5 * np.einsum("ijl,ijk->kl", tmp, K_gradient)
-            log_likelihood_gradient = log_likelihood_gradient_dims.sum(-1)
+            # tmp summed over the output dimensions k; with output scales
+            # the profiled likelihood weights output k by 1 / s_k^2
+            if self.output_scale:
+                tmp = (alpha / self._output_scale2(y_train, alpha)).dot(
+                    alpha.T)
+            else:
+                tmp = alpha.dot(alpha.T)
+            tmp -= alpha.shape[1] * cho_solve((L, True), np.eye(K.shape[0]))
+            # Compute "0.5 * trace(tmp.dot(K_gradient))" one hyperparameter
+            # at a time; the kernel contracts its own gradient with tmp, so
+            # the (n, n, n_dims) gradient tensor is never materialized
+            if plan is not None:
+                log_likelihood_gradient = 0.5 * plan.contract_gradient(tmp)
+            else:
+                log_likelihood_gradient = \
+                    0.5 * kernel.contract_gradient(self.X_train_, tmp)
+
+        self._cache_lml(key, log_likelihood,
+                        log_likelihood_gradient.copy() if eval_gradient
+                        else None, L)
 
         if eval_gradient:
             return log_likelihood, log_likelihood_gradient
         else:
             return log_likelihood
 
+    def _kronecker_log_marginal_likelihood(self, theta, key, eval_gradient):
+        """log_marginal_likelihood for a Kronecker-structured fit."""
+        decomposition = self._kronecker_grid.decompose(
+            theta, self.alpha_train_, eval_gradient)
+        log_det = decomposition.log_det
+        if not np.isfinite(log_det):
+            self._cache_lml(key, -np.inf, np.zeros_like(theta))
+            return (-np.inf, np.zeros_like(theta)) \
+                if eval_gradient else -np.inf
+
+        y_train = self.y_train_
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+        alpha = decomposition.solve(y_train)
+        log_likelihood = self._log_likelihood_dims(
+            y_train, alpha, log_det=log_det).sum(-1)
+
+        log_likelihood_gradient = None
+        if eval_gradient:
+            if self.output_scale:
+                weights = 1.0 / self._output_scale2(y_train, alpha)
+            else:
+                weights = np.ones(y_train.shape[1])
+            log_likelihood_gradient = \
+                decomposition.log_likelihood_gradient(y_train, weights)
+
+        self._cache_lml(key, log_likelihood,
+                        log_likelihood_gradient.copy() if eval_gradient
+                        else None)
+
+        if eval_gradient:
+            return log_likelihood, log_likelihood_gradient
+        else:
+            return log_likelihood
+
+    def _cg_log_marginal_likelihood(self, theta, key, K, kernel,
+                                    eval_gradient):
+        """log_marginal_likelihood with solver="cg".
+
+        One CG run on the Jacobi preconditioned A = D^-1/2 K D^-1/2 with
+        the right-hand sides [D^-1/2 y, z_1, ..., z_P] gives alpha = K^-1 y,
+        A^-1 z_p for the probes z_p and, from its coefficients, the Lanczos
+        tridiagonalization T_p of A on each z_p.  With
+        u_p = D^-1/2 A^-1 z_p and v_p = D^-1/2 z_p,
+            log |K| ~ log |D| + n / P * sum_p e_1^T log(T_p) e_1
+            trace(K^-1 dK) ~ 1 / P * sum_p u_p^T dK v_p
+        kernel is the KernelPlan or kernel at theta, for contract_gradient.
+        """
+        y_train = self.y_train_
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+        n, n_outputs = y_train.shape
+        probes = self._probes
+        alpha, U, lanczos, d, self.cg_n_iter_ = _jacobi_cg(
+            K, y_train, self.cg_tol, probes)
+
+        log_det = 2.0 * np.sum(np.log(d)) + n * np.mean(
+            [_lanczos_log_quadrature(*coefficients)
+             for coefficients in lanczos])
+        log_likelihood = self._log_likelihood_dims(
+            y_train, alpha, log_det=log_det).sum(-1)
+
+        log_likelihood_gradient = None
+        if eval_gradient:
+            if self.output_scale:
+                tmp = (alpha / self._output_scale2(y_train, alpha)).dot(
+                    alpha.T)
+            else:
+                tmp = alpha.dot(alpha.T)
+            tmp -= n_outputs / float(probes.shape[1]) * \
+                (U / d[:, np.newaxis]).dot((probes / d[:, np.newaxis]).T)
+            if isinstance(kernel, KernelPlan):
+                log_likelihood_gradient = 0.5 * kernel.contract_gradient(tmp)
+            else:
+                log_likelihood_gradient = \
+                    0.5 * kernel.contract_gradient(self.X_train_, tmp)
+
+        self._cache_lml(key, log_likelihood,
+                        log_likelihood_gradient.copy() if eval_gradient
+                        else None)
+
+        if eval_gradient:
+            return log_likelihood, log_likelihood_gradient
+        else:
+            return log_likelihood
+
+    def _cg_solve(self, B):
+        """Returns (K + alpha * I)^-1 B at the fitted theta, by CG."""
+        X, self.cg_n_iter_ = _jacobi_cg(self._K, B.reshape(len(B), -1),
+                                        self.cg_tol)
+        return X.reshape(B.shape)
+
+    def log_marginal_likelihood_batch(self, thetas, eval_gradient=False,
+                                      batch_size=None):
+        """Returns log-marginal likelihoods of many thetas at once.
+
+        The kernels of a batch of thetas are stacked into one array of shape
+        (batch_size, n_samples, n_samples) and factorized by a single call
+        of NumPy's batched Cholesky decomposition, which avoids the per-call
+        overhead of evaluating one theta at a time when n_samples is
+        moderate. Likewise the HyperSpheres of the UnrestrictiveCorrelation
+        factors are computed for the whole batch by one HyperSphereBatch.
+        The evaluations enter the same cache as those of
+        log_marginal_likelihood.
+
+        Parameters
+        ----------
+        thetas : array-like, shape = (n_thetas, n_kernel_params)
+            Kernel hyperparameters at which the log-marginal likelihood is
+            evaluated.
+
+        eval_gradient : bool, default: False
+            If True, the gradients of the log-marginal likelihood with
+            respect to the kernel hyperparameters are returned additionally.
+
+        batch_size : int, optional
+            The number of kernels stacked at a time. By default as many as
+            fit into about 64 MB.
+
+        Returns
+        -------
+        log_likelihood : array, shape = (n_thetas,)
+            Log-marginal likelihood of each theta; -inf where K is not
+            positive definite.
+
+        log_likelihood_gradient : array, shape = (n_thetas, n_kernel_params)
+            Gradients of the log-marginal likelihood at each theta.
+            Only returned when eval_gradient is True.
+        """
+        thetas = np.atleast_2d(np.asarray(thetas, dtype=np.float64))
+        if getattr(self, "_kronecker_grid", None) is not None or \
+                self.solver == "cg":
+            # nothing to factorize
+            results = [self.log_marginal_likelihood(theta, eval_gradient)
+                       for theta in thetas]
+            if eval_gradient:
+                return (np.array([r[0] for r in results]),
+                        np.array([r[1] for r in results]))
+            return np.array(results)
+        n = self.X_train_.shape[0]
+        if batch_size is None:
+            batch_size = max(1, 2 ** 23 // (n * n))
+        y_train = self.y_train_
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+
+        log_likelihood = np.full(len(thetas), -np.inf)
+        log_likelihood_gradient = np.zeros(thetas.shape)
+        plan = self._kernel_plan()
+        diag = np.arange(n)
+        for start in range(0, len(thetas), batch_size):
+            batch = thetas[start:start + batch_size]
+            K = np.empty((len(batch), n, n))
+            # the HyperSpheres of the whole batch, one HyperSphereBatch each
+            prefetch = prefetch_hyperspheres(self.kernel_, batch)
+            for i, theta in enumerate(batch):
+                prefetch(i)
+                K[i] = plan(theta) if plan is not None \
+                    else self._kernel_with_theta(theta)(self.X_train_)
+            K[:, diag, diag] += self.alpha_train_
+            L, ok = _stacked_cholesky(K)
+            del K
+            for i in np.flatnonzero(ok):
+                theta = batch[i]
+                # the triangular solves are O(n^2) and stay per theta
+                alpha = cho_solve((L[i], True), y_train)
+                lml = self._log_likelihood_dims(y_train, alpha,
+                                                L[i]).sum(-1)
+                grad = None
+                if eval_gradient:
+                    # as in log_marginal_likelihood
+                    if self.output_scale:
+                        tmp = (alpha / self._output_scale2(
+                            y_train, alpha)).dot(alpha.T)
+                    else:
+                        tmp = alpha.dot(alpha.T)
+                    tmp -= alpha.shape[1] * cho_solve((L[i], True),
+                                                      np.eye(n))
+                    prefetch(i)
+                    if plan is not None:
+                        plan(theta)
+                        grad = 0.5 * plan.contract_gradient(tmp)
+                    else:
+                        grad = 0.5 * self._kernel_with_theta(
+                            theta).contract_gradient(self.X_train_, tmp)
+                    log_likelihood_gradient[start + i] = grad
+                log_likelihood[start + i] = lml
+                self._cache_lml(theta.tobytes(), lml,
+                                grad.copy() if grad is not None else None,
+                                np.array(L[i]))
+            for i in np.flatnonzero(~ok):
+                self._cache_lml(batch[i].tobytes(), -np.inf,
+                                np.zeros(thetas.shape[1]))
+            if getattr(self, "_lml_cache", None) is not None:
+                self.lml_cache_misses_ += len(batch)
+
+        if eval_gradient:
+            return log_likelihood, log_likelihood_gradient
+        else:
+            return log_likelihood
+
+    def _kernel_plan(self):
+        """Returns the KernelPlan of kernel_ on X_train_, or None.
+
+        Compiled on first use and again whenever X_train_ or kernel_ is
+        replaced (fit, add_observations).  None means the kernel is not
+        supported by compile_kernel and is evaluated the usual way.
+        """
+        compiled = getattr(self, "_compiled_kernel", None)
+        if compiled is None or compiled[0] is not self.X_train_ \
+                or compiled[1] is not self.kernel_:
+            compiled = (self.X_train_, self.kernel_,
+                        compile_kernel(self.kernel_, self.X_train_,
+                                       self.dtype))
+            self._compiled_kernel = compiled
+        return compiled[2]
+
+    def _kernel_with_theta(self, theta):
+        """Returns a private copy of kernel_ with hyperparameters theta.
+
+        The copy is cloned once per kernel_ and then updated in place through
+        a ThetaLayout, instead of clone_with_theta for every theta.  It is
+        overwritten by the next call, so must not leak out of the estimator.
+        """
+        layout = getattr(self, "_theta_layout", None)
+        if layout is None or layout[0] is not self.kernel_:
+            layout = (self.kernel_, ThetaLayout(clone(self.kernel_)))
+            self._theta_layout = layout
+        return layout[1].set_theta(theta)
+
+    def _log_likelihood_dims(self, y_train, alpha, L=None, log_det=None):
+        """Log-marginal likelihood of each output dimension.
+
+        log |K| is taken from the Cholesky factor L, or given as log_det.
+
+        With output_scale, each s_k^2 is replaced by its maximum likelihood
+        value y_k^T K^-1 y_k / n, which turns -0.5 * y_k^T K^-1 y_k / s_k^2
+        - n * log(s_k) into -0.5 * n * (1 + log(s_k^2)).
+        """
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+            alpha = alpha[:, np.newaxis]
+        n = y_train.shape[0]
+        if self.output_scale:
+            log_likelihood_dims = \
+                -0.5 * n * (1.0 + np.log(self._output_scale2(y_train, alpha)))
+        else:
+            log_likelihood_dims = -0.5 * np.einsum("ik,ik->k", y_train, alpha)
+        if L is not None:
+            log_likelihood_dims -= np.log(np.diag(L)).sum()
+        else:
+            log_likelihood_dims -= 0.5 * log_det
+        log_likelihood_dims -= n / 2 * np.log(2 * np.pi)
+        return log_likelihood_dims
+
+    @staticmethod
+    def _output_scale2(y_train, alpha):
+        """Maximum likelihood s_k^2 = y_k^T K^-1 y_k / n of each output."""
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+            alpha = alpha[:, np.newaxis]
+        scale2 = np.einsum("ik,ik->k", y_train, alpha) / y_train.shape[0]
+        return np.maximum(scale2, np.finfo(np.float64).tiny)
+
+    def _scale_outputs(self, a, axis):
+        """Multiplies a by s_k^2 (cov, axis 2) or s_k (std, axis 1) of each
+        output, adding the output axis if y has more than one dimension."""
+        scale = self.output_scale_ ** (2 if axis == 2 else 1)
+        if self.y_train_.ndim == 1:
+            return a * scale[0]
+        return a[..., np.newaxis] * scale
+
+    def _reset_lml_cache(self):
+        """Empties the log-marginal likelihood cache and its counters."""
+        self._lml_cache = OrderedDict()
+        self.lml_cache_hits_ = 0
+        self.lml_cache_misses_ = 0
+        # (theta bytes, lml, L) of the best theta evaluated during fit
+        self._best_cholesky = None
+
+    def _cache_lml(self, key, log_likelihood, log_likelihood_gradient,
+                   L=None):
+        """Stores an evaluation, evicting the least recently used one."""
+        cache = getattr(self, "_lml_cache", None)
+        if cache is None:
+            return
+        if self.lml_cache_size > 0:
+            cache[key] = log_likelihood, log_likelihood_gradient
+            while len(cache) > self.lml_cache_size:
+                cache.popitem(last=False)
+        if L is not None and getattr(self, "_keep_cholesky", False) and \
+                (self._best_cholesky is None or
+                 log_likelihood > self._best_cholesky[1]):
+            self._best_cholesky = (key, log_likelihood, L)
+
+    def _obj_func(self, theta, eval_gradient=True):
+        """Negative log-marginal likelihood, the objective minimized in fit."""
+        if eval_gradient:
+            lml, grad = self.log_marginal_likelihood(
+                theta, eval_gradient=True)
+            return -lml, -grad
+        else:
+            return -self.log_marginal_likelihood(theta)
+
     def _constrained_optimization(self, obj_func, initial_theta, bounds):
         if self.optimizer == "fmin_l_bfgs_b":
             theta_opt, func_min, convergence_dict = \
@@ -434,3 +1132,130 @@ class GaussianProcessRegressor(BaseEstimator, RegressorMixin):
             raise ValueError("Unknown optimizer %s." % self.optimizer)
 
         return theta_opt, func_min
+
+
+def _conjugate_gradient(A, B, tol, max_iter):
+    """Solves A X = B for symmetric positive definite A by conjugate
+    gradients, with all the columns of B at once.
+
+    Returns X, for each column the coefficients (alphas, betas) of its
+    iterations, from which the Lanczos tridiagonalization of A on the Krylov
+    space of that column follows (see _lanczos_log_quadrature), and the
+    number of iterations.  Warns with ConvergenceWarning if a column has
+    not converged after max_iter iterations.
+    """
+    X = np.zeros_like(B)
+    R = B.copy()
+    P = R.copy()
+    rr = np.einsum("ij,ij->j", R, R)
+    threshold = tol ** 2 * np.maximum(rr, np.finfo(np.float64).tiny)
+    coefficients = [([], []) for _ in range(B.shape[1])]
+    n_iter = 0
+    while True:
+        active = np.flatnonzero(rr > threshold)
+        if len(active) == 0:
+            break
+        if n_iter == max_iter:
+            warnings.warn("Conjugate gradients did not converge to tol=%g in "
+                          "%d iterations for %d of %d right-hand sides."
+                          % (tol, max_iter, len(active), B.shape[1]),
+                          ConvergenceWarning)
+            break
+        n_iter += 1
+        P_active = P[:, active]
+        AP = A.dot(P_active)
+        a = rr[active] / np.einsum("ij,ij->j", P_active, AP)
+        X[:, active] += a * P_active
+        R[:, active] -= a * AP
+        rr_new = np.einsum("ij,ij->j", R[:, active], R[:, active])
+        b = rr_new / rr[active]
+        P[:, active] = R[:, active] + b * P_active
+        rr[active] = rr_new
+        for j, column in enumerate(active):
+            coefficients[column][0].append(a[j])
+            coefficients[column][1].append(b[j])
+    return X, coefficients, n_iter
+
+
+def _jacobi_cg(K, B, tol, probes=None):
+    """Solves K X = B by conjugate gradients on A = D^-1/2 K D^-1/2 for the
+    diagonal D of K.
+
+    With probes Z, A U = Z is solved in the same run: A, not K, is the
+    matrix whose log-determinant the CG coefficients of the probe columns
+    estimate, and Z is passed unscaled so that those estimates stay
+    unbiased when D is not a multiple of the identity.
+
+    Returns X, and with probes also U, the CG coefficients of each probe
+    column and the square root d of the diagonal D; last the number of CG
+    iterations.
+    """
+    d = np.sqrt(np.diag(K))
+    scaled = K / d[:, np.newaxis] / d[np.newaxis, :]
+    k = B.shape[1]
+    B = B / d[:, np.newaxis]
+    if probes is not None:
+        B = np.hstack((B, probes))
+    S, coefficients, n_iter = _conjugate_gradient(scaled, B, tol, K.shape[0])
+    X = S[:, :k] / d[:, np.newaxis]
+    if probes is None:
+        return X, n_iter
+    return X, S[:, k:], coefficients[k:], d, n_iter
+
+
+def _lanczos_log_quadrature(alphas, betas):
+    """Returns e_1^T log(T) e_1 for the Lanczos tridiagonal matrix T of
+    a CG run with coefficients alphas, betas, started from the probe (the
+    estimate of z^T log(A) z / |z|^2).
+
+    T_jj = 1 / a_j + b_(j-1) / a_(j-1), T_j,j+1 = sqrt(b_j) / a_j.
+    """
+    a = np.asarray(alphas)
+    b = np.asarray(betas[:len(a) - 1])
+    if len(a) == 0:
+        return 0.0
+    diagonal = 1.0 / a
+    diagonal[1:] += b / a[:-1]
+    off_diagonal = np.sqrt(b) / a[:-1]
+    theta, V = eigh_tridiagonal(diagonal, off_diagonal)
+    return np.sum(V[0] ** 2 * np.log(np.maximum(theta,
+                                                np.finfo(np.float64).tiny)))
+
+
+def _stacked_cholesky(K):
+    """Lower Cholesky factors of a stack of matrices K, shape (b, n, n).
+
+    Returns the factors and a boolean mask of the matrices which are
+    positive definite; the factors of the others are left zero.
+    """
+    try:
+        return np.linalg.cholesky(K), np.ones(len(K), dtype=bool)
+    except np.linalg.LinAlgError:
+        # one matrix failed the whole batch; factorize them one by one
+        L = np.zeros_like(K)
+        ok = np.zeros(len(K), dtype=bool)
+        for i in range(len(K)):
+            try:
+                L[i] = np.linalg.cholesky(K[i])
+                ok[i] = True
+            except np.linalg.LinAlgError:
+                pass
+        return L, ok
+
+
+def _restart_optimization(params, X_train, y_train, alpha_train, probes,
+                          initial_theta, bounds):
+    """Runs one optimizer restart of fit in a worker process.
+
+    The worker builds its own estimator from the parameters params (with
+    kernel the kernel_ being fitted) and its own caches on X_train.
+    """
+    gpr = GaussianProcessRegressor(**params)
+    gpr.kernel_ = gpr.kernel
+    gpr.X_train_ = X_train
+    gpr.y_train_ = y_train
+    gpr.alpha_train_ = alpha_train
+    gpr._prepare_training_data(probes)
+    # the best Cholesky factor is only reused by the parent
+    gpr._keep_cholesky = False
+    return gpr._constrained_optimization(gpr._obj_func, initial_theta, bounds)
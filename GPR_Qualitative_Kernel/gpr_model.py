@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+import os
+import pickle
 
-from sklearn.gaussian_process import GaussianProcessRegressor
+#from sklearn.gaussian_process import GaussianProcessRegressor
+from gpr import GaussianProcessRegressor
+from sparse_gpr import SparseGaussianProcessRegressor
+import chunked
+import persistence
 #from sklearn.gaussian_process.kernels import RBF, ConstantKernel
 #from kernels import RBF, ConstantKernel
 import kernels as kr
@@ -10,6 +16,7 @@ import qualitative_kernels as qk
 import parameter_set as prs
 from sklearn.model_selection import ParameterSampler
 from sklearn.model_selection import train_test_split
+from sklearn.utils import check_random_state
 from sklearn.cluster import AffinityPropagation
 
 import pandas as pd
@@ -42,6 +49,11 @@ class GPR_Model(object):
             or UnrestrictiveCorrelation on the dummy-coded variates
             
     The .fit() method runs a Gaussian Process Regression on the data
+    target may be a single column or a list of columns, e.g.
+    ['validation_loss', 'runtime_hours'].  All targets share the kernel
+    and its Cholesky factorization (each with its own scale by default);
+    the first target is the one optimized by optimize() and LCB(), and
+    predict() returns all of them at once.
     The resulting model may be numerically optimized
     Each point in the data is used to initialize the optimizer, and the
     resulting set of local minima are identified by Affinity Propagation
@@ -61,26 +73,45 @@ class GPR_Model(object):
         dfc_set = set(data_df.columns)
         xcol_set = set(X_columns)
         factor_set = set(factors)
+        targets = [target] if isinstance(target, str) else list(target)
         
-        assert target in dfc_set, "Target column must be in dataframe"
+        assert set(targets).issubset(dfc_set), "Target columns must be in dataframe"
         assert xcol_set.issubset(dfc_set), "X_columns must be in dataframe's columns"
         assert factor_set.issubset(dfc_set), "Factors must be in dataframe's columns"
         #assert set(factors).issubset(set(X_columns)), "Factors should be listed in X_columns"
         
         self.data = data_df
         self.factors = factors
+        self.target = target
+        self.targets = targets
+        self.prefix_sep = prefix_sep
         
         xcol_set = xcol_set | factor_set    # set union
-        xcol_set.discard(target)
+        xcol_set.difference_update(targets)
         
         # n.b. set is not a hashable type so make it a list
-        X = data_df[list(xcol_set)]
+        # keep the order, add_observations selects the same columns
+        self.X_columns = list(xcol_set)
+        X = data_df[self.X_columns]
+        # a Series for a single target, a DataFrame for a list of targets
         y = data_df[target]
         
         # Create auxiliary dataframe with dummy-coded indicators 
         Xd = pd.get_dummies(X,
                             columns=factors,
                             prefix_sep=prefix_sep) if factors else X
+        
+        # order the columns in blocks, the continuous ones first and then
+        # each factor's dummies in the order of factors, so that every
+        # Projection takes a slice (a view) of X rather than a copy;
+        # column_permutation maps them back to the order of get_dummies
+        blocks = [[i for i, name in enumerate(Xd.columns)
+                   if name.split(prefix_sep)[0] not in factors]]
+        for factor in factors:
+            blocks.append([i for i, name in enumerate(Xd.columns)
+                           if name.split(prefix_sep)[0] == factor])
+        self.column_permutation = np.concatenate(blocks).astype(int)
+        Xd = Xd.iloc[:, self.column_permutation]
             
         continuous_columns = []
         factor_columns = defaultdict(list)
@@ -302,7 +333,27 @@ class GPR_Model(object):
 # TODO: Unrestrictive FTW!
 # =============================================================================
      # for now just use UC as tha model
-    def fit(self, theta=0.5, alpha=0.01, n_restarts_optimizer=20):
+    def fit(self, theta=0.5, alpha=0.01, n_restarts_optimizer=20,
+            n_inducing=None, output_scale=None, solver="cholesky",
+            dtype=np.float64, n_jobs=1, random_state=None):
+        """Fit a Gaussian Process Regression with the UC kernel.
+        
+        If n_inducing is given and smaller than the number of runs, a
+        SparseGaussianProcessRegressor with that many inducing inputs is
+        used instead, keeping the inducing values of each factor on the
+        simplex of its dummy-coded columns.
+        
+        With several targets, output_scale (default: True if there is
+        more than one target) gives each target its own scale; see
+        GaussianProcessRegressor.  It is ignored by the sparse model, and
+        so are solver ("cholesky" or the matrix-free "cg", for many runs)
+        and dtype (np.float32 computes the kernel in single precision).
+        
+        n_jobs runs the optimizer restarts in parallel.  random_state
+        seeds the initial correlations and the restarts; with the same
+        random_state the fit does not depend on n_jobs."""
+        
+        rng = check_random_state(random_state)
         
         # First model all qualitative factors with an Exchangeable Correlation
         
@@ -319,7 +370,7 @@ class GPR_Model(object):
             columns = factor.columns
             dim = len(columns)
             m = dim * (dim - 1) // 2
-            theta = np.random.random_sample(m)
+            theta = rng.random_sample(m)
             uc = qk.UnrestrictiveCorrelation(dim, zeta=theta)
             kernel = qk.Projection(columns, name=factor.name, kernel=uc)
             kernels.append(kernel)
@@ -333,10 +384,28 @@ class GPR_Model(object):
         print("Unrestrictive Correlation Kernel for Gaussian Process Regression")
         print(uc_kernel)
         logging.debug("Unrestrictive Correlation Kernel for Gaussian Process Regression\n{}".format(uc_kernel))
-        gpr = GaussianProcessRegressor(kernel=uc_kernel,
-                                       alpha=alpha,
-                                       normalize_y=True,
-                                       n_restarts_optimizer=n_restarts_optimizer)
+        if n_inducing is not None and n_inducing < len(self.Xd):
+            simplex_columns = [factor.columns
+                               for factor in self.factor_objects.values()]
+            gpr = SparseGaussianProcessRegressor(kernel=uc_kernel,
+                                                 n_inducing=n_inducing,
+                                                 alpha=alpha,
+                                                 normalize_y=True,
+                                                 n_restarts_optimizer=n_restarts_optimizer,
+                                                 simplex_columns=simplex_columns,
+                                                 random_state=rng)
+        else:
+            if output_scale is None:
+                output_scale = len(self.targets) > 1
+            gpr = GaussianProcessRegressor(kernel=uc_kernel,
+                                           alpha=alpha,
+                                           normalize_y=True,
+                                           n_restarts_optimizer=n_restarts_optimizer,
+                                           output_scale=output_scale,
+                                           solver=solver,
+                                           dtype=dtype,
+                                           n_jobs=n_jobs,
+                                           random_state=rng)
         #gpr = GaussianProcessRegressor(kernel=k, alpha=0.001, normalize_y=True)
         self.gpr_ = gpr        
         gpr.fit(self.Xd, self.y)
@@ -350,14 +419,84 @@ class GPR_Model(object):
                 print("Correlation for Factor[{}]:\n{}".format(name, k_.correlation))
             except:
                 print("Factor[{}]:\n{}".format(name, k_))
-            
+
+    def add_observations(self, data_df, refit_interval=None,
+                         lml_tolerance=None):
+        """Add new runs to the data and update the fitted GPR model.
+        
+        data_df must have the same columns as the data the model was
+        constructed with, and factors may only take levels already seen.
+        The kernel hyperparameters are kept fixed and the Cholesky factor
+        is extended, unless refit_interval or lml_tolerance trigger a full
+        refit (see GaussianProcessRegressor.add_observations)."""
+        X = data_df[self.X_columns]
+        y = data_df[self.target]
+        Xd = pd.get_dummies(X,
+                            columns=self.factors,
+                            prefix_sep=self.prefix_sep) if self.factors else X
+        unseen = set(Xd.columns) - set(self.Xd.columns)
+        if unseen:
+            raise ValueError("New data have columns or factor levels not in "
+                             "the model: {}".format(sorted(unseen)))
+        Xd = Xd.reindex(columns=self.Xd.columns, fill_value=0)
+        
+        self.data = pd.concat([self.data, data_df], ignore_index=True)
+        self.X = pd.concat([self.X, X], ignore_index=True)
+        self.Xd = pd.concat([self.Xd, Xd], ignore_index=True)
+        self.y = pd.concat([self.y, y], ignore_index=True)
+        
+        if self.gpr_ is not None:
+            self.gpr_.add_observations(Xd, y,
+                                       refit_interval=refit_interval,
+                                       lml_tolerance=lml_tolerance)
+            # hyperparameters may have been refit
+            self._factor_keys = {}
+            self._factor_kernels_ = {}
                
+    def predict(self, Xd=None, return_std=False, gpr=None):
+        """Predict every target with one call of the fitted GPR.
+        
+        Returns a dataframe with one column per target, and if return_std
+        a second dataframe with their standard deviations."""
+        if gpr is None:
+            gpr = self.gpr_
+        if Xd is None:
+            Xd = self.Xd
+        preds = gpr.predict(Xd, return_std=return_std)
+        # an array of rows has no index of its own
+        index = getattr(Xd, "index", None)
+        mean = pd.DataFrame(np.reshape(preds[0] if return_std else preds,
+                                       (len(Xd), -1)),
+                            columns=self.targets, index=index)
+        if not return_std:
+            return mean
+        std = np.reshape(preds[1], (len(Xd), -1))
+        if std.shape[1] != len(self.targets):
+            # one standard deviation shared by all targets
+            std = np.repeat(std, len(self.targets), axis=1)
+        std = pd.DataFrame(std, columns=self.targets, index=index)
+        return mean, std
+
+    def _predict_target(self, gpr, X, return_std=False):
+        """Predictions (and standard deviations) of the first target only."""
+        preds = gpr.predict(X, return_std=return_std)
+        if return_std:
+            mean, std = preds
+            mean = mean[:, 0] if mean.ndim > 1 else mean
+            std = std[:, 0] if std.ndim > 1 else std
+            return mean, std
+        return preds[:, 0] if preds.ndim > 1 else preds
+
     def dummy_data_to_dict(self, datum):
         columns = self.Xd.columns
         return {col : val for col, val in zip(columns, datum)}
 
     def decode_dummies(self, X, param_set):
-        #columns = self.Xd.columns
+        """Decodes rows of dummy-coded data into parameter dictionaries.
+        
+        X is a dataframe, or an array with the columns of self.Xd."""
+        if not isinstance(X, pd.DataFrame):
+            X = pd.DataFrame(np.atleast_2d(X), columns=self.Xd.columns)
         decoded = []
         for i in range(X.shape[0]):
             x = X.iloc[i]
@@ -384,7 +523,7 @@ class GPR_Model(object):
         #TODO: see if this still works, was: X.reshape(1,-1)
         # n.b. gpr.predict accepts matrix input and returns an array
         # e.g. if X is n * p return an array with shape (p,)        
-        return lambda X : gpr.predict(X.reshape(1,-1))[0] + \
+        return lambda X : self._predict_target(gpr, X.reshape(1,-1))[0] + \
             sum(factor_penalty(X, factor.columns) \
                 for factor in self.factor_objects.values())
 #               for columns in self.factor_columns.values())
@@ -410,7 +549,7 @@ class GPR_Model(object):
             #start_val = np.atleast_2d(Xd.iloc[i]).reshape(1,-1)
             start_val = Xd.iloc[i]
             # Fit the GPR model
-            predict = lambda X : gpr.predict(X.reshape(1,-1))[0]
+            predict = lambda X : self._predict_target(gpr, X.reshape(1,-1))[0]
             result = sp.optimize.minimize(predict, start_val, method='L-BFGS-B', bounds=bounds)
             # the result will be a mixture of factor values
             # Now penalize points which are not feasible
@@ -418,7 +557,7 @@ class GPR_Model(object):
                 predict = self.predict_penalized(gpr, epsilon, epsilon)
             result = sp.optimize.minimize(predict, result.x, method='L-BFGS-B', bounds=bounds)
             rx = result.x
-            pred = gpr.predict(rx.reshape(1,-1))
+            pred = self._predict_target(gpr, rx.reshape(1,-1))
             for col, val in zip(columns, rx):
                 result_data[col].append(val)
             # pred is an ndarray with shape (1,) so unpack it
@@ -499,7 +638,7 @@ class GPR_Model(object):
         gpr = self.gpr_ #self._get_gpr(gpr)
         if Xd is None:
             Xd = self.Xd
-        preds = gpr.predict(Xd, return_std=True)
+        preds = self._predict_target(gpr, Xd, return_std=True)
         preds = pd.DataFrame({"prediction" : preds[0], "std_dev" : preds[1]})
         # n.b. lambda is a keyword so change vector of values to alpha
         alpha = ParameterSampler({ "alpha" : expon()}, n_iter=n_sample)
@@ -533,6 +672,70 @@ class GPR_Model(object):
         else:
             return recommend
 
+    def save(self, path):
+        """Saves the fitted model to the directory path.
+
+        The regressor goes to path/gpr (see GaussianProcessRegressor.save),
+        the column layout and factor metadata to path/model.pkl.  The data
+        frames are not saved: Xd is the regressor's X_train_.
+        """
+        if self.gpr_ is None:
+            raise ValueError("Only a fitted GPR_Model can be saved")
+        persistence.save_regressor(self.gpr_, os.path.join(path, "gpr"))
+        state = {name: value for name, value in vars(self).items()
+                 if name not in ("data", "X", "Xd", "y", "_gpr_",
+                                 "_factor_keys", "_factor_kernels_")}
+        state["Xd_columns"] = list(self.Xd.columns)
+        with open(os.path.join(path, "model.pkl"), "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Loads a model saved with save(), for predictions and
+        recommendations.
+
+        The training data are memory-mapped with mmap_mode and shared by
+        Xd; data, X and y are None, so add_observations and fit are not
+        available.
+        """
+        with open(os.path.join(path, "model.pkl"), "rb") as f:
+            state = pickle.load(f)
+        model = cls.__new__(cls)
+        Xd_columns = state.pop("Xd_columns")
+        model.__dict__.update(state)
+        model.data = model.X = model.y = None
+        model.gpr_ = persistence.load_regressor(os.path.join(path, "gpr"),
+                                                mmap_mode)
+        model.Xd = pd.DataFrame(model.gpr_.X_train_, columns=Xd_columns,
+                                copy=False)
+        return model
+
+    def top_k_recommend(self, param_set, X, k=3, kappa=0.0, gpr=None,
+                        chunk_size=None, max_memory=None,
+                        return_data=False):
+        """Recommendations from a large candidate set X, e.g. a full grid.
+
+        X has the columns of self.Xd.  The k candidates with the lowest
+        prediction - kappa * std_dev are found with predict_top_k, in
+        blocks of chunk_size rows or about max_memory bytes, so X can be
+        much larger than what predict could handle at once.
+        """
+        if gpr is None:
+            gpr = self.gpr_
+        index, mean, std = chunked.predict_top_k(
+            gpr, X, k, kappa, chunk_size=chunk_size, max_memory=max_memory)
+        if isinstance(X, pd.DataFrame):
+            Xk = X.iloc[index]
+        else:
+            Xk = pd.DataFrame(np.asarray(X)[index], columns=self.Xd.columns,
+                              index=index)
+        recommend = self.decode_dummies(Xk, param_set)
+        if return_data:
+            Xk = Xk.assign(prediction=mean, std_dev=std)
+            return recommend, Xk
+        else:
+            return recommend
+
     def name_report(self, gpr):
         """Report correlations for factors.
         
@@ -903,7 +1106,6 @@ class GPR_Model_old(object):
         #x_rec = pd.DataFrame(aff.cluster_centers_, columns=x.columns)
         # select the lowest validation loss from each cluster
         x_rec = pd.concat([x, pd.DataFrame({'cluster_id' : aff.labels_})], axis=1)
-<<<<<<< HEAD
         x_rec.sort_values(by=['cluster_id', 'gpr_optimum'], inplace=True)
         x_rec = x_rec.groupby('cluster_id').first()
         x_rec.sort_values(by=['gpr_optimum'], inplace=True)
@@ -913,11 +1115,6 @@ class GPR_Model_old(object):
         x_rec = x.iloc[:max_recommend]
         #x_rec.index = range(len(x_rec))
         #x_rec = x_rec.drop(['gpr_optimum'], axis=1)
-=======
-        clus_rec = x_rec.groupby('cluster_id')
-        x_rec = x_rec.iloc[clus_rec['gpr_optimum'].idxmin()]
-        x_rec = x_rec.drop(['gpr_optimum','cluster_id'], axis=1)
->>>>>>> 28981818020bd81b77cd336914a79d8ef72a93f0
         paramdictlist = self.decode_dummies(x_rec, param_set)
         if return_data:
             return paramdictlist, x_rec
@@ -13,6 +13,21 @@ import random
 import timeit
 import numpy as np
 import hypersphere_cython as hs
+try:
+    # OpenMP derivative rows, built from ../hypersphere by setup.py
+    import hypersphere_parallel as hsp
+except ImportError:
+    hsp = None
+
+# threads for the derivative rows in hypersphere_parallel, 0: OpenMP default
+_num_threads = 0
+
+
+def set_num_threads(num_threads):
+    """Sets the number of OpenMP threads for the derivative rows of
+    HyperSphere; 0 uses the OpenMP default (OMP_NUM_THREADS)."""
+    global _num_threads
+    _num_threads = int(num_threads)
 
 # =============================================================================
 # Cythonize construction of matrices and gradient for efficiency
@@ -98,20 +113,55 @@ class HyperSphere(object):
     # see HyperSphere_test for pure Python equivalent
     def _lower_triangular_derivative(self):
         dim = self.dim
-        #zeta = self.zeta
-        cos_zeta = self.cos_zeta
-        sin_zeta = self.sin_zeta
-        
-        dLstack = []
-        for dr in range(1, dim):
-            for ds in range(dr):  
-                dL = np.zeros((dim, dim), dtype=np.float64)
-                    
-                hs.HyperSphere_lower_triangular_derivative(dL, dim, dr, ds,
-                                                           cos_zeta, sin_zeta)
-                dLstack.append(dL)
-        return dLstack
-    
+        rows = self._lower_triangular_derivative_rows()
+        dLstack = np.zeros((len(rows), dim, dim), dtype=np.float64)
+        dLstack[np.arange(len(rows)), np.tril_indices(dim, -1)[0]] = rows
+        return list(dLstack)
+
+    def _lower_triangular_derivative_rows(self):
+        """Row dr of d L / d zeta[dr,ds] for every parameter, in the order
+        of np.tril_indices(dim, -1); the other rows are zero.
+
+        With hypersphere_parallel, one call fills all of them (in parallel
+        from PARALLEL_MIN_ANGLES parameters, see set_num_threads),
+        otherwise one call per parameter."""
+        dim = self.dim
+        param_rows, param_cols = np.tril_indices(dim, -1)
+        rows = np.zeros((len(param_rows), dim), dtype=np.float64)
+        if hsp is not None:
+            hsp.HyperSphere_lower_triangular_derivative_rows(
+                rows, dim, param_rows.astype(np.intp),
+                param_cols.astype(np.intp), self.cos_zeta, self.sin_zeta,
+                _num_threads)
+            return rows
+        for k, (dr, ds) in enumerate(zip(param_rows, param_cols)):
+            hs.HyperSphere_lower_triangular_derivative_row(rows[k], dim,
+                                                           dr, ds,
+                                                           self.cos_zeta,
+                                                           self.sin_zeta)
+        return rows
+
+    @property
+    def gradient_rows(self):
+        """Row-sparse gradients, one row for each parameter.
+
+        The gradient for zeta[r,s] is nonzero only in row and column r,
+        where both equal the same vector: it is e_r w^T + w e_r^T, since
+        d L / d zeta[r,s] is nonzero only in row r.
+
+        Returns
+        -------
+        rows : array of int, shape (dim*(dim-1)/2,)
+            The row r of each parameter
+        W : array, shape (dim*(dim-1)/2, dim)
+            The vector w of each parameter, with w[r] = 0
+        """
+        L = self._lower_triangular()
+        rows = np.tril_indices(self.dim, -1)[0]
+        W = self._lower_triangular_derivative_rows().dot(L.T)
+        W[np.arange(len(W)), rows] = 0.0
+        return rows, W
+
     @property
     def gradient(self):
         """List of gradients, one for each parameter.
@@ -152,43 +202,6 @@ class HyperSphere(object):
         return np.arccos(C[np.tril_indices(dim, -1)])
     
     
-class HyperSphere_full_gradient(HyperSphere):
-    """Working on a parallelizable gradient computation"""
-    def _lower_triangular_derivative_row(self, dr, ds):
-        """For given dr, all non-zero elements are in the same row"""
-        dim = self.dim
-        #zeta = self.zeta
-        cos_zeta = self.cos_zeta
-        sin_zeta = self.sin_zeta
-        
-        dL_dr = np.zeros(dim, dtype=np.float64)
-            
-        hs.HyperSphere_lower_triangular_derivative_row(dL_dr, dim, dr, ds,
-                                                       cos_zeta, sin_zeta)
-        return dL_dr    
-    
-    def full_gradient(self, X):
-        dim = self.dim
-        gradstack = []
-        L = self._lower_triangular()
-        # these for loops will use prange in OpenMP
-        for dr in range(1, dim):
-            for ds in range(dr):
-                dL = self._lower_triangular_derivative_row(dr, ds)
-                dLLt = dL.dot(L.T)
-                dLLtXt = dLLt.dot(X.T)
-                #grad = np.zeros((dim, dim), dtype=np.float64)
-                #grad = np.outer(X[:, dr], dLLtXt)
-                #grad = grad + grad.T
-                # or:
-                grad = np.zeros((dim, dim), dtype=np.float64)
-                grad[dr] = dLLtXt
-                grad[:,dr] = dLLtXt
-                print(grad)
-                gradstack.append(grad)
-        return gradstack
-            
-            
 # =============================================================================
 # Pure Python implememntation, compare to Cython version for testing
 # =============================================================================
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized NumPy version of HyperSphere, for nodes without the Cython
+extension.  Same interface as hypersphere.HyperSphere.
+
+Row r of the lower triangular L is
+
+    L[r,s] = cos(zeta[r,s]) * prod_{j<s} sin(zeta[r,j])     (s < r)
+    L[r,r] = prod_{j<r} sin(zeta[r,j])
+
+so all of L follows from one exclusive cumulative product of the sines
+along the rows.  d L / d zeta[dr,ds] is nonzero only in row dr, where the
+same product holds with sin(zeta[dr,ds]) replaced by cos(zeta[dr,ds]) (and
+cos(zeta[dr,ds]) by -sin(zeta[dr,ds]) in column ds); those rows are computed
+for all d*(d-1)/2 parameters at once from cumprods of masked copies of the
+sine rows, without dividing by sines which may vanish.
+
+HyperSphereBatch does the same for many zeta vectors at once, e.g. the
+candidate thetas of a batched log-marginal likelihood.
+"""
+from __future__ import print_function
+from math import pi
+
+import numpy as np
+from scipy.linalg import cholesky
+
+
+class HyperSphere(object):
+    """Parameterizes the d-1-dimensional surface of a d-dimensional hypersphere
+    using a lower triangular matrix with d*(d-1)/2 parameters, each in the
+    interval (0, pi).  Used for constructing correlation matrices over
+    dummy-coded variables representing a categorical variable (factor).
+
+    Parameters
+    ----------
+    dim     int dimension, the number of category levels
+    zeta    optional, list or array of parameter values, between 0 and pi
+            If supplied, the length must be dim * (dim - 1) / 2
+    """
+    def __init__(self, dim, zeta=[]):
+        m = dim*(dim-1)//2
+        self.dim = dim
+        if isinstance(zeta, (list, tuple, np.ndarray)) and len(zeta):
+            assert len(zeta) == m, "Expecting {0}*({0}-1)/2 elements".format(dim)
+        elif isinstance(zeta, (int, float, np.float64, np.int64)):
+            zeta = [zeta]
+        else:
+            zeta = [pi/4.0]*m
+        self._tables = _tables(dim)
+        zeta_lt = np.zeros((dim, dim))
+        # lower triangular indices, offset -1 to get below-diagonal elements
+        self._rows, self._cols = self._tables.rows, self._tables.cols
+        zeta_lt[self._rows, self._cols] = np.array(zeta, dtype=np.float64)
+        # set the diagonal to 1
+        np.fill_diagonal(zeta_lt, 1.0)
+
+        self.zeta = zeta_lt
+
+        # initialize trig values
+        self._cos_zeta = None
+        self._sin_zeta = None
+        self._initialize_trig_values()
+
+        self._lt = None
+
+    def _initialize_trig_values(self):
+        # only the below-diagonal elements are used, the others are 0
+        zeta = self.zeta[self._rows, self._cols]
+        self._cos_zeta = np.zeros((self.dim, self.dim))
+        self._sin_zeta = np.zeros((self.dim, self.dim))
+        self._cos_zeta[self._rows, self._cols] = np.cos(zeta)
+        self._sin_zeta[self._rows, self._cols] = np.sin(zeta)
+
+    @property
+    def cos_zeta(self):
+        return self._cos_zeta
+
+    @property
+    def sin_zeta(self):
+        return self._sin_zeta
+
+    def _sine_rows(self):
+        """sin(zeta[r,j]) for j < r, and 1 elsewhere."""
+        return self.sin_zeta + self._tables.upper
+
+    def _lower_triangular(self):
+        if self._lt is None:
+            # P[r,s] = prod_{j<s} sin(zeta[r,j])
+            P = _exclusive_cumprod(self._sine_rows())
+            # cos_zeta is 0 on and above the diagonal, so add the diagonal
+            L = self.cos_zeta * P
+            L[np.diag_indices(self.dim)] = np.diag(P)
+            self._lt = L
+        return self._lt
+
+    def _lower_triangular_derivative_rows(self):
+        """Row dr of d L / d zeta[dr,ds] for every parameter, in the order
+        of the parameters (np.tril_indices(dim, -1)).
+
+        Returns
+        -------
+        rows : array, shape (dim*(dim-1)/2, dim)
+        """
+        t = self._tables
+        k, r, s = t.params, t.rows, t.cols
+        # the sine rows, with the factor of the parameter differentiated
+        A = self._sine_rows()[r]
+        A[k, s] = self.cos_zeta[r, s]
+        Q = _exclusive_cumprod(A)
+        # cos(zeta[dr,s]) for ds < s < dr, 1 at s = dr
+        B = self.cos_zeta[r] + t.diagonal
+        B[k, s] = -self.sin_zeta[r, s]
+        B[t.before] = 0.0
+        return B * Q
+
+    def _lower_triangular_derivative(self):
+        dim = self.dim
+        rows = self._lower_triangular_derivative_rows()
+        dLstack = np.zeros((len(rows), dim, dim))
+        dLstack[np.arange(len(rows)), self._rows] = rows
+        return list(dLstack)
+
+    @property
+    def correlation(self):
+        """Correlation matrix corresponding to zeta."""
+        lt = self._lower_triangular()
+        corr = lt.dot(lt.T)
+        # this is not strictly needed,
+        # but numerical error may cause some diagonal values to be
+        # slightly off
+        np.fill_diagonal(corr, 1.0)
+        return corr
+
+    @property
+    def gradient(self):
+        """List of gradients, one for each parameter.
+
+        Not used directly for computations; primarily for testing."""
+        dim = self.dim
+        L = self._lower_triangular()
+        # d L / d zeta = e_dr v^T, so the gradient is e_dr w^T + w e_dr^T
+        # with w = L v
+        W = self._lower_triangular_derivative_rows().dot(L.T)
+        k = self._tables.params
+        grad = np.zeros((len(W), dim, dim))
+        grad[k, self._rows] = W
+        grad[k, :, self._rows] += W
+        grad[:, np.arange(dim), np.arange(dim)] = 0.0
+        return list(grad)
+
+    @property
+    def gradient_rows(self):
+        """Row-sparse gradients, one row for each parameter.
+
+        The gradient for zeta[r,s] is nonzero only in row and column r,
+        where both equal the same vector: it is e_r w^T + w e_r^T, since
+        d L / d zeta[r,s] is nonzero only in row r.
+
+        Returns
+        -------
+        rows : array of int, shape (dim*(dim-1)/2,)
+            The row r of each parameter
+        W : array, shape (dim*(dim-1)/2, dim)
+            The vector w of each parameter, with w[r] = 0
+        """
+        L = self._lower_triangular()
+        W = self._lower_triangular_derivative_rows().dot(L.T)
+        W[self._tables.params, self._rows] = 0.0
+        return self._rows, W
+
+    @staticmethod
+    def zeta(correlation):
+        """"Hypersphere parameterization of a kernel or correlation matrix. """
+        K = correlation
+        assert isinstance(K, np.ndarray), "Correlations must be an array"
+        assert K.shape[0] == K.shape[1], "Correlations must be square"
+        np.fill_diagonal(K, 1.0)
+        L = cholesky(K, lower=True)
+        dim = L.shape[0]
+        C = np.zeros_like(L)
+        # the product of the sines so far, column by column for all rows
+        prod = np.ones(dim)
+        for s in range(dim - 1):
+            below = slice(s + 1, dim)
+            C[below, s] = L[below, s] / prod[below]
+            prod[below] *= np.sqrt(1.0 - C[below, s]**2)
+        return np.arccos(C[np.tril_indices(dim, -1)])
+
+
+class _Tables(object):
+    """Index arrays and masks which depend only on the dimension."""
+    def __init__(self, dim):
+        self.rows, self.cols = np.tril_indices(dim, -1)
+        self.params = np.arange(len(self.rows))
+        # 1 on and above the diagonal
+        self.upper = np.triu(np.ones((dim, dim)))
+        # row dr of the identity, and the columns s < ds, of each parameter
+        self.diagonal = np.eye(dim)[self.rows]
+        self.before = np.arange(dim) < self.cols[:, np.newaxis]
+
+
+_tables_by_dim = {}
+
+
+def _tables(dim):
+    if dim not in _tables_by_dim:
+        _tables_by_dim[dim] = _Tables(dim)
+    return _tables_by_dim[dim]
+
+
+def _exclusive_cumprod(A):
+    """P[..., s] = prod_{j<s} A[..., j]"""
+    P = np.ones_like(A)
+    np.cumprod(A[..., :-1], axis=-1, out=P[..., 1:])
+    return P
+
+
+class HyperSphereBatch(object):
+    """HyperSphere for many angle vectors of the same dimension at once.
+
+    The correlations and gradients of all b vectors are computed together,
+    with the same cumulative products as HyperSphere along a leading axis,
+    instead of one HyperSphere and its Python-level work per vector.
+
+    Parameters
+    ----------
+    dim     int dimension, the number of category levels
+    zeta    array, shape (b, dim * (dim - 1) / 2), parameter values between
+            0 and pi, one vector per row
+    """
+    def __init__(self, dim, zeta):
+        m = dim*(dim-1)//2
+        zeta = np.asarray(zeta, dtype=np.float64).reshape(-1, m)
+        self.dim = dim
+        self._tables = _tables(dim)
+        rows, cols = self._tables.rows, self._tables.cols
+        self.zeta = zeta
+        # as in HyperSphere, 0 on and above the diagonal
+        self._cos_zeta = np.zeros((len(zeta), dim, dim))
+        self._sin_zeta = np.zeros((len(zeta), dim, dim))
+        self._cos_zeta[:, rows, cols] = np.cos(zeta)
+        self._sin_zeta[:, rows, cols] = np.sin(zeta)
+        self._lt = None
+
+    def __len__(self):
+        return len(self.zeta)
+
+    def _lower_triangular(self):
+        """The lower triangular factors, shape (b, dim, dim)."""
+        if self._lt is None:
+            diagonal = np.diag_indices(self.dim)
+            P = _exclusive_cumprod(self._sin_zeta + self._tables.upper)
+            L = self._cos_zeta * P
+            L[:, diagonal[0], diagonal[1]] = P[:, diagonal[0], diagonal[1]]
+            self._lt = L
+        return self._lt
+
+    def _lower_triangular_derivative_rows(self):
+        """Row dr of d L / d zeta[dr,ds] for every vector and parameter,
+        shape (b, dim*(dim-1)/2, dim); see HyperSphere."""
+        t = self._tables
+        k, r, s = t.params, t.rows, t.cols
+        A = (self._sin_zeta + t.upper)[:, r]
+        A[:, k, s] = self._cos_zeta[:, r, s]
+        Q = _exclusive_cumprod(A)
+        B = self._cos_zeta[:, r] + t.diagonal
+        B[:, k, s] = -self._sin_zeta[:, r, s]
+        B[:, t.before] = 0.0
+        return B * Q
+
+    @property
+    def correlation(self):
+        """Correlation matrices, shape (b, dim, dim)."""
+        L = self._lower_triangular()
+        corr = np.matmul(L, L.transpose(0, 2, 1))
+        corr[:, np.arange(self.dim), np.arange(self.dim)] = 1.0
+        return corr
+
+    @property
+    def gradient_rows(self):
+        """Row-sparse gradients, see HyperSphere.gradient_rows.
+
+        Returns
+        -------
+        rows : array of int, shape (dim*(dim-1)/2,)
+            The row r of each parameter, the same for every vector
+        W : array, shape (b, dim*(dim-1)/2, dim)
+            The vector w of each vector and parameter, with w[r] = 0
+        """
+        L = self._lower_triangular()
+        W = np.matmul(self._lower_triangular_derivative_rows(),
+                      L.transpose(0, 2, 1))
+        W[:, self._tables.params, self._tables.rows] = 0.0
+        return self._tables.rows, W
+
+    @property
+    def gradient(self):
+        """Dense gradients, shape (b, dim*(dim-1)/2, dim, dim)."""
+        dim = self.dim
+        rows, W = self.gradient_rows
+        k = self._tables.params
+        grad = np.zeros(W.shape[:2] + (dim, dim))
+        grad[:, k, rows] = W
+        grad[:, k, :, rows] += W.transpose(1, 0, 2)
+        return grad
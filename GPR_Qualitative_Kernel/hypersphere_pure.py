@@ -115,6 +115,49 @@ class HyperSphere(object):
                 dLstack.append(dL)
         return dLstack
 
+    def _lower_triangular_derivative_rows(self):
+        """Row dr of d L / d zeta[dr,ds] for every parameter, in the order
+        of np.tril_indices(dim, -1); the other rows are zero."""
+        dim = self.dim
+        C = self.cos_zeta
+        S = self.sin_zeta
+        rows = np.zeros((dim*(dim-1)//2, dim), dtype=np.float64)
+        k = 0
+        for dr in range(dim):
+            for ds in range(dr):
+                for s in range(ds, dr):
+                    dL_drs = C[dr,s] if s != ds else -S[dr,s]
+                    for j in range(s):
+                        dL_drs *= S[dr,j] if j != ds else C[dr,j]
+                    rows[k,s] = dL_drs
+                dL_drs = 1.0
+                for j in range(dr):
+                    dL_drs *= S[dr,j] if j != ds else C[dr,j]
+                rows[k,dr] = dL_drs
+                k += 1
+        return rows
+
+    @property
+    def gradient_rows(self):
+        """Row-sparse gradients, one row for each parameter.
+
+        The gradient for zeta[r,s] is nonzero only in row and column r,
+        where both equal the same vector: it is e_r w^T + w e_r^T, since
+        d L / d zeta[r,s] is nonzero only in row r.
+
+        Returns
+        -------
+        rows : array of int, shape (dim*(dim-1)/2,)
+            The row r of each parameter
+        W : array, shape (dim*(dim-1)/2, dim)
+            The vector w of each parameter, with w[r] = 0
+        """
+        L = self._lower_triangular()
+        rows = np.tril_indices(self.dim, -1)[0]
+        W = self._lower_triangular_derivative_rows().dot(L.T)
+        W[np.arange(len(W)), rows] = 0.0
+        return rows, W
+
     @property
     def correlation(self):
         """Correlation matrix corresponding to zeta."""
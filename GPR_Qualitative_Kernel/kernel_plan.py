@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Fused evaluation of product kernels on fixed training data.
+
+GPR_Model builds kernels of the form
+
+    ConstantKernel * Tensor([Projection(RBF), Projection(UC), ...])
+
+While the hyperparameters are optimized, such a kernel is evaluated many
+times on the same X_train_, each time after clone_with_theta and a walk of
+the tree that re-slices columns and multiplies n*n intermediates one by one.
+compile_kernel() flattens the tree once into a list of factors with
+everything that does not depend on theta precomputed against X_train_: the
+per-dimension squared distances of each RBF block and the level code pairs
+of each categorical block.  K and its contracted gradient are then products
+over the n*(n-1)/2 pairs i < j, accumulated in place.
+"""
+from __future__ import print_function
+
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+from sklearn.base import clone
+
+from kernels import ConstantKernel, Product, RBF, ThetaLayout
+from qualitative_kernels import CategoricalKernelMixin, Projection, Tensor
+
+
+def compile_kernel(kernel, X, dtype=np.float64):
+    """Compiles kernel into a KernelPlan on the training data X.
+
+    Parameters
+    ----------
+    kernel : kernel object
+        Products (Tensor or *) of ConstantKernel, RBF and the categorical
+        kernels, the latter two optionally inside a Projection.
+
+    X : array, shape (n_samples, n_features)
+        The training data; categorical columns must be one-hot.
+
+    dtype : numpy dtype, optional (default: np.float64)
+        The floating point type of the precomputed distances and of the
+        buffers K and its gradient are computed in.
+
+    Returns
+    -------
+    plan : KernelPlan or None
+        None if the kernel contains anything else.
+    """
+    X = np.atleast_2d(X)
+    kernel = clone(kernel)
+    factors = []
+    if not _flatten(kernel, X, list(range(X.shape[1])), factors, dtype):
+        return None
+    return KernelPlan(X, factors, ThetaLayout(kernel), dtype)
+
+
+def _flatten(kernel, X, columns, factors, dtype):
+    """Appends the factors of kernel to factors, in the order of theta."""
+    if isinstance(kernel, Tensor):
+        return all(_flatten(k, X, columns, factors, dtype)
+                   for k in kernel.kernels)
+    elif isinstance(kernel, Product):
+        return _flatten(kernel.k1, X, columns, factors, dtype) and \
+            _flatten(kernel.k2, X, columns, factors, dtype)
+    elif isinstance(kernel, Projection):
+        return _flatten(kernel.kernel, X,
+                        [columns[c] for c in kernel.columns], factors, dtype)
+    elif isinstance(kernel, ConstantKernel):
+        factors.append(_ConstantFactor(kernel))
+    elif type(kernel) is RBF:
+        factors.append(_RBFFactor(kernel, X[:, columns], dtype))
+    elif isinstance(kernel, CategoricalKernelMixin):
+        codes = kernel.level_codes(X[:, columns])
+        if codes is None:
+            return False
+        factors.append(_CategoricalFactor(kernel, codes, dtype))
+    else:
+        return False
+    return True
+
+
+class KernelPlan(object):
+    """Fixed evaluation plan of a product kernel on training data X.
+
+    Use compile_kernel() to construct it.
+
+    Attributes
+    ----------
+    X : array, shape (n_samples, n_features)
+        The training data the plan was compiled against
+
+    n_dims : int
+        The number of hyperparameters, equal to kernel.n_dims
+    """
+    def __init__(self, X, factors, layout, dtype=np.float64):
+        self.X = X
+        self.factors = factors
+        # the factors are the leaves of the kernel, so they take
+        # consecutive slices of theta
+        widths = [f.n_dims for f in factors]
+        offsets = np.cumsum([0] + widths)
+        self.slices = [slice(offsets[i], offsets[i + 1])
+                       for i in range(len(factors))]
+        self.n_dims = offsets[-1]
+        self.layout = layout
+        n_pairs = X.shape[0] * (X.shape[0] - 1) // 2
+        self.dtype = np.dtype(dtype)
+        self._values = np.empty((len(factors), n_pairs), dtype=self.dtype)
+        self._product = np.empty(n_pairs, dtype=self.dtype)
+        self._diag = 1.0
+
+    def __call__(self, theta):
+        """Returns the kernel k(X, X) at theta.
+
+        The values of each factor are kept for contract_gradient.
+        """
+        self.layout.set_theta(theta)
+        product = self._product
+        product.fill(1.0)
+        diag = 1.0
+        for f, values in zip(self.factors, self._values):
+            f.evaluate(values)
+            np.multiply(product, values, out=product)
+            diag *= f.diag
+        self._diag = diag
+        K = squareform(product)
+        K[np.diag_indices_from(K)] = diag
+        return K
+
+    def contract_gradient(self, W):
+        """Returns the gradient at the last theta contracted with W.
+
+        Equal to np.einsum("ij,ijl->l", W, K_gradient) for the gradient
+        K_gradient of the kernel at the theta of the last call. It is
+        computed in the plan's dtype and returned as float64.
+        """
+        # pairs i < j stand for both (i, j) and (j, i)
+        w = squareform(W + W.T, checks=False).astype(self.dtype, copy=False)
+        n_factors = len(self.factors)
+        # product of the factors before each factor, times w
+        rest = np.empty_like(self._values)
+        acc = w.copy()
+        for i in range(n_factors):
+            rest[i] = acc
+            np.multiply(acc, self._values[i], out=acc)
+        # ... times the product of the factors after it
+        acc.fill(1.0)
+        for i in range(n_factors - 1, -1, -1):
+            np.multiply(rest[i], acc, out=rest[i])
+            np.multiply(acc, self._values[i], out=acc)
+        g = np.empty(self.n_dims)
+        trace_W = np.trace(W)
+        for f, s, r in zip(self.factors, self.slices, rest):
+            if s.start < s.stop:
+                g[s] = f.contract(r, trace_W * self._diag)
+        return g
+
+
+class _ConstantFactor(object):
+    """ConstantKernel: the same value on every pair and on the diagonal."""
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.n_dims = kernel.n_dims
+        self.diag = kernel.constant_value
+
+    def evaluate(self, values):
+        self.diag = self.kernel.constant_value
+        values.fill(self.diag)
+
+    def contract(self, rest, diag_term):
+        # dK/dlog(c) = K: pairs and diagonal
+        return np.array([self.diag * rest.sum() + diag_term])
+
+
+class _RBFFactor(object):
+    """RBF on a block of columns, from their cached squared distances."""
+    def __init__(self, kernel, X, dtype):
+        self.kernel = kernel
+        self.n_dims = kernel.n_dims
+        self.diag = 1.0
+        self.D = np.vstack([pdist(X[:, [l]], metric='sqeuclidean')
+                            for l in range(X.shape[1])]).astype(dtype)
+        self.anisotropic = kernel.anisotropic
+
+    def evaluate(self, values):
+        self.scale = np.broadcast_to(
+            np.asarray(self.kernel.length_scale, dtype=self.D.dtype) ** -2.0,
+            (self.D.shape[0],))
+        self.dists = self.scale.dot(self.D)
+        np.exp(-.5 * self.dists, out=values)
+        self.values = values
+
+    def contract(self, rest, diag_term):
+        wk = rest * self.values
+        if not self.anisotropic:
+            return np.array([wk.dot(self.dists)])
+        return self.D.dot(wk) * self.scale
+
+
+class _CategoricalFactor(object):
+    """Categorical kernel on one-hot columns, gathered by level code pairs."""
+    def __init__(self, kernel, codes, dtype):
+        self.kernel = kernel
+        self.dtype = dtype
+        self.n_dims = kernel.n_dims
+        self.diag = 1.0
+        dim = kernel.dim
+        i, j = np.triu_indices(len(codes), 1)
+        self.pairs = codes[i] * dim + codes[j]
+        self.dim = dim
+
+    def evaluate(self, values):
+        C = np.ravel(self.kernel.correlation).astype(self.dtype, copy=False)
+        np.take(C, self.pairs, out=values)
+
+    def contract(self, rest, diag_term):
+        # the correlations have unit diagonal, so only pairs i < j count
+        dim = self.dim
+        M = np.bincount(self.pairs, weights=rest, minlength=dim * dim)
+        return self.kernel.contract_level_sums(M.reshape(dim, dim))
@@ -25,6 +25,8 @@ optimization.
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
 import math
+import weakref
+import zlib
 
 import numpy as np
 from scipy.special import kv, gamma
@@ -55,6 +57,205 @@ def _check_length_scale(X, length_scale):
     return length_scale
 
 
+def _contract_scaled_differences(X, Y, WF, length_scale):
+    """Returns G[a, j] = sum_i WF[i, a] (X[i, j] - Y[a, j]) / l[j]**2.
+
+    For a stationary kernel with dk/dlog(l[j]) = F * (x[j] - y[j])**2 / l[j]**2
+    this is the derivative of sum(W * K) with respect to Y, WF = W * F.
+    """
+    G = WF.T.dot(X) - WF.sum(axis=0)[:, np.newaxis] * Y
+    return G / length_scale ** 2
+
+
+# TrainingDataCache objects by id() of their array, held weakly so that a
+# cache lives exactly as long as its owner (e.g. a fitted regressor) keeps it,
+# and its entry goes with it
+_training_data_caches = weakref.WeakValueDictionary()
+
+
+def _fingerprint(X):
+    """Shape, dtype and checksum of the values of the array X."""
+    X = np.ascontiguousarray(X)
+    return X.shape, X.dtype.str, zlib.crc32(X) & 0xffffffff
+
+
+class TrainingDataCache(object):
+    """Quantities of fixed training data shared by all kernel evaluations.
+
+    While the hyperparameters are optimized, k(X, X) is evaluated many times
+    on the same X_train_ with only theta changing. GaussianProcessRegressor
+    attaches a cache to X_train_; kernels look it up by the identity of the
+    array they are given (see training_data_cache), so it survives
+    clone_with_theta. Projection passes on the same array for its columns
+    every time, with a cache of its own, or the level codes of a factor's
+    dummy-coded columns.
+
+    The array must not be modified in place while the cache is alive; a
+    fingerprint (shape and checksum) of X is checked on every lookup, and
+    a modified array is treated as not cached.
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features)
+        The training data
+
+    dtype : numpy dtype, optional (default: np.float64)
+        The floating point type of the cached distances, and so of the
+        kernels computed from them (e.g. np.float32 for half the memory)
+    """
+    def __init__(self, X, dtype=np.float64):
+        self.X = X
+        self.dtype = np.dtype(dtype)
+        self._squared_distances = None
+        self._projections = {}
+        self._level_codes = {}
+        self._fingerprint = _fingerprint(X)
+        self._register()
+
+    def _register(self):
+        _training_data_caches[id(self.X)] = self
+
+    def __getstate__(self):
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        # e.g. a regressor sent to a joblib worker
+        self.__dict__.update(state)
+        self._register()
+
+    def project(self, columns):
+        """Returns X[:, columns], the same cached array on every call."""
+        key = tuple(columns)
+        if key not in self._projections:
+            self._projections[key] = \
+                TrainingDataCache(np.ascontiguousarray(self.X[:, columns]),
+                                  self.dtype)
+        return self._projections[key].X
+
+    def level_codes(self, columns, kernel):
+        """Returns kernel.level_codes(X[:, columns]), computed once."""
+        key = tuple(columns)
+        if key not in self._level_codes:
+            self._level_codes[key] = kernel.level_codes(self.X[:, columns])
+        return self._level_codes[key]
+
+    def squared_distances(self):
+        """Returns the per-dimension squared distances of X.
+
+        Returns
+        -------
+        D : array, shape (n_features, n_samples * (n_samples - 1) / 2)
+            Squared distances in each dimension, in the condensed (pdist)
+            order of the pairs
+        """
+        if self._squared_distances is None:
+            X = np.atleast_2d(self.X)
+            self._squared_distances = np.vstack(
+                [pdist(X[:, [l]], metric='sqeuclidean')
+                 for l in range(X.shape[1])]).astype(self.dtype, copy=False)
+        return self._squared_distances
+
+
+def training_data_cache(X):
+    """Returns the TrainingDataCache attached to the array X, or None.
+
+    None also if X has been modified since the cache was made."""
+    cache = _training_data_caches.get(id(X))
+    if cache is None or cache.X is not X or \
+            cache._fingerprint != _fingerprint(X):
+        return None
+    return cache
+
+
+def _training_squared_distances(X):
+    """Per-dimension squared distances of X if X is cached training data."""
+    cache = training_data_cache(X)
+    return cache.squared_distances() if cache is not None else None
+
+
+class ThetaLayout(object):
+    """Flat layout of the hyperparameters theta of a kernel tree.
+
+    The theta getter and setter of compound kernels rebuild the list of
+    hyperparameters through get_params on every access, and clone_with_theta
+    deep-copies the whole tree. A ThetaLayout walks the tree once and records
+    the offset in theta, the log flag and the bounds of every non-fixed
+    hyperparameter of every leaf kernel. set_theta then writes theta
+    directly into the leaves of that kernel, in place; values which are not
+    log-transformed become views of the layout's own theta buffer.
+
+    The kernel is modified, so it should be private to an optimizer loop
+    (e.g. a clone); user-facing copies still come from clone_with_theta.
+
+    Parameters
+    ----------
+    kernel : kernel object
+        The kernel whose hyperparameters are set
+
+    Attributes
+    ----------
+    theta : array, shape (n_dims,)
+        The theta last set, initially kernel.theta
+
+    bounds : array, shape (n_dims, 2)
+        The log-transformed bounds on theta
+
+    log : array of bool, shape (n_dims,)
+        Whether each entry of theta is log-transformed
+    """
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.entries = []
+        bounds = []
+        log = []
+        offset = 0
+        for leaf in kernel._theta_leaves():
+            for hyperparameter in leaf.hyperparameters:
+                if hyperparameter.fixed:
+                    continue
+                n = hyperparameter.n_elements
+                # a one-element array stays an array, as in the theta setter
+                vector = n > 1 or \
+                    np.ndim(getattr(leaf, hyperparameter.name)) > 0
+                self.entries.append((leaf, hyperparameter.name,
+                                     slice(offset, offset + n),
+                                     hyperparameter.log, vector))
+                b = np.asarray(hyperparameter.bounds, dtype=np.float64)
+                bounds.append(np.log(b) if hyperparameter.log else b)
+                log.extend([hyperparameter.log] * n)
+                offset += n
+        self.n_dims = offset
+        self.bounds = np.vstack(bounds) if bounds else np.empty((0, 2))
+        self.log = np.array(log, dtype=bool)
+        self.theta = np.array(kernel.theta, dtype=np.float64)
+
+    def set_theta(self, theta):
+        """Sets the hyperparameters of the kernel to theta, in place.
+
+        Parameters
+        ----------
+        theta : array, shape (n_dims,)
+            The non-fixed, log-transformed hyperparameters of the kernel
+
+        Returns
+        -------
+        kernel : kernel object
+            The kernel, with hyperparameters theta
+        """
+        theta = np.asarray(theta, dtype=np.float64)
+        if theta.shape != (self.n_dims,):
+            raise ValueError("theta has not the correct number of entries."
+                             " Should be %d; given are %d"
+                             % (self.n_dims, theta.size))
+        self.theta[:] = theta
+        for leaf, name, s, log, vector in self.entries:
+            value = self.theta[s]
+            if log:
+                value = np.exp(value)
+            setattr(leaf, name, value if vector else value[0])
+        return self.kernel
+
+
 class Hyperparameter(namedtuple('Hyperparameter',
                                 ('name', 'value_type', 'bounds',
                                  'n_elements', 'fixed', 'log'))):
@@ -222,6 +423,13 @@ class Kernel(six.with_metaclass(ABCMeta)):
         cloned.theta = theta
         return cloned
 
+    def _theta_leaves(self):
+        """Returns the kernels holding the hyperparameters, in theta order.
+
+        Kernels built from other kernels return the leaves of those.
+        """
+        return [self]
+
     @property
     def n_dims(self):
         """Returns the number of non-fixed hyperparameters of the kernel."""
@@ -277,8 +485,10 @@ class Kernel(six.with_metaclass(ABCMeta)):
         for hyperparameter in self.hyperparameters:
             if hyperparameter.fixed:
                 continue
-            if hyperparameter.n_elements > 1:
-                # vector-valued parameter
+            if hyperparameter.n_elements > 1 or \
+                    np.ndim(params[hyperparameter.name]) > 0:
+                # vector-valued parameter (possibly of one element, e.g. the
+                # zeta of a two-level UnrestrictiveCorrelation)
                 if hyperparameter.log:
                     params[hyperparameter.name] = np.exp(
                         theta[i:i + hyperparameter.n_elements])
@@ -320,6 +530,99 @@ class Kernel(six.with_metaclass(ABCMeta)):
         else:
             return np.array([])
 
+    def contract_gradient(self, X, W, Y=None):
+        """Returns the gradient of k(X, Y) contracted with the matrix W.
+
+        Computes g[l] = sum_ij W[i, j] * dK[i, j] / dtheta[l] for the
+        non-fixed hyperparameters theta. This is all the log-marginal
+        likelihood needs from the gradient. Kernels which can evaluate the
+        sum one hyperparameter at a time override this method, so that the
+        (n_samples_X, n_samples_X, n_dims) gradient is never built; the
+        default builds it and contracts it.
+
+        Parameters
+        ----------
+        X : array, shape (n_samples_X, n_features)
+            Left argument of the kernel k(X, Y)
+
+        W : array, shape (n_samples_X, n_samples_Y)
+            Matrix contracted with the gradient
+
+        Y : array, shape (n_samples_Y, n_features), (optional, default=None)
+            Right argument of the kernel k(X, Y). If None, k(X, X) is used.
+            The default evaluates the gradient of k on X and Y stacked.
+
+        Returns
+        -------
+        g : array, shape (n_dims,)
+            The contracted gradient
+        """
+        if Y is not None:
+            # k(X, Y) is the upper right block of k on the stacked samples
+            n = len(X)
+            XY = np.concatenate((X, Y))
+            W_XY = np.zeros((len(XY), len(XY)))
+            W_XY[:n, n:] = W
+            return self.contract_gradient(XY, W_XY)
+        K, K_gradient = self(X, eval_gradient=True)
+        return np.einsum("ij,ijl->l", W, K_gradient)
+
+    def contract_diag_gradient(self, X, w):
+        """Returns the gradient of the diagonal of k(X, X) contracted with w.
+
+        Computes g[l] = sum_i w[i] * dK[i, i] / dtheta[l]. The default
+        contracts the gradient of k(X, X) with diag(w).
+
+        Parameters
+        ----------
+        X : array, shape (n_samples_X, n_features)
+            Argument of the kernel k(X, X)
+
+        w : array, shape (n_samples_X,)
+            Vector contracted with the gradient of the diagonal
+
+        Returns
+        -------
+        g : array, shape (n_dims,)
+            The contracted gradient
+        """
+        return self.contract_gradient(X, np.diag(w))
+
+    def contract_input_gradient(self, X, Y, W):
+        """Returns the gradient of sum(W * k(X, Y)) with respect to Y.
+
+        The default takes central differences of k(X, Y), two evaluations
+        for each feature; kernels with an analytic derivative override it.
+
+        Parameters
+        ----------
+        X : array, shape (n_samples_X, n_features)
+            Left argument of the kernel k(X, Y)
+
+        Y : array, shape (n_samples_Y, n_features)
+            Right argument of the kernel k(X, Y)
+
+        W : array, shape (n_samples_X, n_samples_Y)
+            Matrix contracted with the kernel
+
+        Returns
+        -------
+        G : array, shape (n_samples_Y, n_features)
+            G[a, j] is the derivative with respect to Y[a, j]
+        """
+        Y = np.array(Y, dtype=np.float64)
+        G = np.empty_like(Y)
+        eps = 1e-6
+        for j in range(Y.shape[1]):
+            y = Y[:, j].copy()
+            Y[:, j] = y + eps
+            K_plus = self(X, Y)
+            Y[:, j] = y - eps
+            G[:, j] = np.einsum("ia,ia->a", W, K_plus - self(X, Y)) \
+                / (2 * eps)
+            Y[:, j] = y
+        return G
+
     def __add__(self, b):
         if not isinstance(b, Kernel):
             return Sum(self, ConstantKernel(b))
@@ -410,6 +713,10 @@ class NormalizedKernelMixin(object):
         """
         return np.ones(X.shape[0])
 
+    def contract_diag_gradient(self, X, w):
+        """The diagonal is constant, its gradient vanishes."""
+        return np.zeros(self.n_dims)
+
 
 class StationaryKernelMixin(object):
     """Mixin for kernels which are stationary: k(X, Y)= f(X-Y).
@@ -431,6 +738,11 @@ class CompoundKernel(Kernel):
     def __init__(self, kernels):
         self.kernels = kernels
 
+    def _theta_leaves(self):
+        """Returns the kernels holding the hyperparameters, in theta order."""
+        return [leaf for kernel in self.kernels
+                for leaf in kernel._theta_leaves()]
+
     def get_params(self, deep=True):
         """Get parameters of this kernel.
 
@@ -641,6 +953,10 @@ class KernelOperator(Kernel):
         self.k1 = k1
         self.k2 = k2
 
+    def _theta_leaves(self):
+        """Returns the kernels holding the hyperparameters, in theta order."""
+        return self.k1._theta_leaves() + self.k2._theta_leaves()
+
     def get_params(self, deep=True):
         """Get parameters of this kernel.
 
@@ -788,6 +1104,21 @@ class Sum(KernelOperator):
         else:
             return self.k1(X, Y) + self.k2(X, Y)
 
+    def contract_gradient(self, X, W, Y=None):
+        """The contracted gradients of k1 and k2, concatenated."""
+        return np.append(self.k1.contract_gradient(X, W, Y),
+                         self.k2.contract_gradient(X, W, Y))
+
+    def contract_diag_gradient(self, X, w):
+        """The contracted gradients of k1 and k2, concatenated."""
+        return np.append(self.k1.contract_diag_gradient(X, w),
+                         self.k2.contract_diag_gradient(X, w))
+
+    def contract_input_gradient(self, X, Y, W):
+        """The sum of those of k1 and k2."""
+        return self.k1.contract_input_gradient(X, Y, W) \
+            + self.k2.contract_input_gradient(X, Y, W)
+
     def diag(self, X):
         """Returns the diagonal of the kernel k(X, X).
 
@@ -863,6 +1194,22 @@ class Product(KernelOperator):
         else:
             return self.k1(X, Y) * self.k2(X, Y)
 
+    def contract_gradient(self, X, W, Y=None):
+        """Product rule: k1's gradient with W * k2, k2's with W * k1."""
+        return np.append(self.k1.contract_gradient(X, W * self.k2(X, Y), Y),
+                         self.k2.contract_gradient(X, W * self.k1(X, Y), Y))
+
+    def contract_diag_gradient(self, X, w):
+        """Product rule on the diagonals."""
+        return np.append(
+            self.k1.contract_diag_gradient(X, w * self.k2.diag(X)),
+            self.k2.contract_diag_gradient(X, w * self.k1.diag(X)))
+
+    def contract_input_gradient(self, X, Y, W):
+        """Product rule: k1's with W * k2 plus k2's with W * k1."""
+        return self.k1.contract_input_gradient(X, Y, W * self.k2(X, Y)) \
+            + self.k2.contract_input_gradient(X, Y, W * self.k1(X, Y))
+
     def diag(self, X):
         """Returns the diagonal of the kernel k(X, X).
 
@@ -907,6 +1254,10 @@ class Exponentiation(Kernel):
         self.kernel = kernel
         self.exponent = exponent
 
+    def _theta_leaves(self):
+        """Returns the kernels holding the hyperparameters, in theta order."""
+        return self.kernel._theta_leaves()
+
     def get_params(self, deep=True):
         """Get parameters of this kernel.
 
@@ -1017,6 +1368,24 @@ class Exponentiation(Kernel):
             K = self.kernel(X, Y, eval_gradient=False)
             return K ** self.exponent
 
+    def contract_gradient(self, X, W, Y=None):
+        """The base kernel's, with W * exponent * K**(exponent - 1)."""
+        K = self.kernel(X, Y)
+        return self.kernel.contract_gradient(
+            X, W * self.exponent * K ** (self.exponent - 1), Y)
+
+    def contract_diag_gradient(self, X, w):
+        """The base kernel's, with w * exponent * diag**(exponent - 1)."""
+        d = self.kernel.diag(X)
+        return self.kernel.contract_diag_gradient(
+            X, w * self.exponent * d ** (self.exponent - 1))
+
+    def contract_input_gradient(self, X, Y, W):
+        """The base kernel's, with W * exponent * K**(exponent - 1)."""
+        K = self.kernel(X, Y)
+        return self.kernel.contract_input_gradient(
+            X, Y, W * self.exponent * K ** (self.exponent - 1))
+
     def diag(self, X):
         """Returns the diagonal of the kernel k(X, X).
 
@@ -1116,6 +1485,22 @@ class ConstantKernel(StationaryKernelMixin, Kernel):
         else:
             return K
 
+    def contract_gradient(self, X, W, Y=None):
+        """The log constant_value's gradient is constant_value * sum(W)."""
+        if self.hyperparameter_constant_value.fixed:
+            return np.empty(0)
+        return np.array([self.constant_value * W.sum()])
+
+    def contract_diag_gradient(self, X, w):
+        """The log constant_value's gradient is constant_value * sum(w)."""
+        if self.hyperparameter_constant_value.fixed:
+            return np.empty(0)
+        return np.array([self.constant_value * np.sum(w)])
+
+    def contract_input_gradient(self, X, Y, W):
+        """The kernel does not depend on Y."""
+        return np.zeros(np.shape(Y))
+
     def diag(self, X):
         """Returns the diagonal of the kernel k(X, X).
 
@@ -1211,6 +1596,25 @@ class WhiteKernel(StationaryKernelMixin, Kernel):
         else:
             return np.zeros((X.shape[0], Y.shape[0]))
 
+    def contract_gradient(self, X, W, Y=None):
+        """The log noise_level's gradient is noise_level * trace(W)."""
+        if self.hyperparameter_noise_level.fixed:
+            return np.empty(0)
+        if Y is not None:
+            # k(X, Y) vanishes
+            return np.zeros(1)
+        return np.array([self.noise_level * np.trace(W)])
+
+    def contract_diag_gradient(self, X, w):
+        """The log noise_level's gradient is noise_level * sum(w)."""
+        if self.hyperparameter_noise_level.fixed:
+            return np.empty(0)
+        return np.array([self.noise_level * np.sum(w)])
+
+    def contract_input_gradient(self, X, Y, W):
+        """k(X, Y) vanishes."""
+        return np.zeros(np.shape(Y))
+
     def diag(self, X):
         """Returns the diagonal of the kernel k(X, X).
 
@@ -1308,7 +1712,15 @@ class RBF(StationaryKernelMixin, NormalizedKernelMixin, Kernel):
         """
         X = np.atleast_2d(X)
         length_scale = _check_length_scale(X, self.length_scale)
-        if Y is None:
+        D = _training_squared_distances(X) if Y is None else None
+        if D is not None:
+            # scale the cached per-dimension squared distances
+            scale = np.broadcast_to(length_scale ** -2.0,
+                                    (X.shape[1],)).astype(D.dtype)
+            dists = scale.dot(D)
+            K = squareform(np.exp(-.5 * dists))
+            np.fill_diagonal(K, 1)
+        elif Y is None:
             dists = pdist(X / length_scale, metric='sqeuclidean')
             K = np.exp(-.5 * dists)
             # convert from upper-triangular matrix to square matrix
@@ -1331,14 +1743,64 @@ class RBF(StationaryKernelMixin, NormalizedKernelMixin, Kernel):
                     (K * squareform(dists))[:, :, np.newaxis]
                 return K, K_gradient
             elif self.anisotropic:
+                if D is not None:
+                    K_gradient = np.empty(K.shape + (X.shape[1],),
+                                          dtype=K.dtype)
+                    for l in range(X.shape[1]):
+                        K_gradient[:, :, l] = squareform(D[l]) * scale[l]
                 # We need to recompute the pairwise dimension-wise distances
-                K_gradient = (X[:, np.newaxis, :] - X[np.newaxis, :, :]) ** 2 \
-                    / (length_scale ** 2)
+                else:
+                    K_gradient = \
+                        (X[:, np.newaxis, :] - X[np.newaxis, :, :]) ** 2 \
+                        / (length_scale ** 2)
                 K_gradient *= K[..., np.newaxis]
                 return K, K_gradient
         else:
             return K
 
+    def contract_gradient(self, X, W, Y=None):
+        """Squared distances one dimension at a time, or from X's cache."""
+        if self.hyperparameter_length_scale.fixed:
+            return np.empty(0)
+        X = np.atleast_2d(X)
+        length_scale = _check_length_scale(X, self.length_scale)
+        D = _training_squared_distances(X) if Y is None else None
+        if D is not None:
+            # on the pairs i < j of the cached squared distances
+            scale = np.broadcast_to(length_scale ** -2.0,
+                                    (X.shape[1],)).astype(D.dtype)
+            dists = scale.dot(D)
+            wk = squareform(W + W.T, checks=False) * np.exp(-.5 * dists)
+            if not self.anisotropic or length_scale.shape[0] == 1:
+                return np.array([wk.dot(dists)])
+            return D.dot(wk) * scale
+        if Y is None:
+            Y = X
+            dists = squareform(pdist(X / length_scale, metric='sqeuclidean'))
+        else:
+            Y = np.atleast_2d(Y)
+            dists = cdist(X / length_scale, Y / length_scale,
+                          metric='sqeuclidean')
+        WK = W * np.exp(-.5 * dists)
+        if not self.anisotropic or length_scale.shape[0] == 1:
+            return np.array([np.sum(WK * dists)])
+        g = np.empty(X.shape[1])
+        for l in range(X.shape[1]):
+            x = X[:, l] / length_scale[l]
+            y = Y[:, l] / length_scale[l]
+            g[l] = np.sum(WK * (x[:, np.newaxis] - y[np.newaxis, :]) ** 2)
+        return g
+
+    def contract_input_gradient(self, X, Y, W):
+        """dk(x, y) / dy[j] = k(x, y) (x[j] - y[j]) / length_scale[j]**2."""
+        X = np.atleast_2d(X)
+        Y = np.atleast_2d(Y)
+        length_scale = _check_length_scale(X, self.length_scale)
+        dists = cdist(X / length_scale, Y / length_scale,
+                      metric='sqeuclidean')
+        return _contract_scaled_differences(X, Y, W * np.exp(-.5 * dists),
+                                            length_scale)
+
     def __repr__(self):
         if self.anisotropic:
             return "{0}(length_scale=[{1}])".format(
@@ -1421,7 +1883,13 @@ class Matern(RBF):
         """
         X = np.atleast_2d(X)
         length_scale = _check_length_scale(X, self.length_scale)
-        if Y is None:
+        D = _training_squared_distances(X) if Y is None else None
+        if D is not None:
+            # scale the cached per-dimension squared distances
+            scale = np.broadcast_to(length_scale ** -2.0,
+                                    (X.shape[1],)).astype(D.dtype)
+            dists = np.sqrt(scale.dot(D))
+        elif Y is None:
             dists = pdist(X / length_scale, metric='euclidean')
         else:
             if eval_gradient:
@@ -1439,7 +1907,8 @@ class Matern(RBF):
             K = dists * math.sqrt(5)
             K = (1. + K + K ** 2 / 3.0) * np.exp(-K)
         else:  # general case; expensive to evaluate
-            K = dists
+            # copy, the distances are needed again for the gradient
+            K = dists.copy()
             K[K == 0.0] += np.finfo(float).eps  # strict zeros result in nan
             tmp = (math.sqrt(2 * self.nu) * K)
             K.fill((2 ** (1. - self.nu)) / gamma(self.nu))
@@ -1458,7 +1927,10 @@ class Matern(RBF):
                 return K, K_gradient
 
             # We need to recompute the pairwise dimension-wise distances
-            if self.anisotropic:
+            if self.anisotropic and D is not None:
+                D = np.dstack([squareform(D[l]) * scale[l]
+                               for l in range(X.shape[1])])
+            elif self.anisotropic:
                 D = (X[:, np.newaxis, :] - X[np.newaxis, :, :])**2 \
                     / (length_scale ** 2)
             else:
@@ -1475,10 +1947,9 @@ class Matern(RBF):
                 tmp = np.sqrt(5 * D.sum(-1))[..., np.newaxis]
                 K_gradient = 5.0 / 3.0 * D * (tmp + 1) * np.exp(-tmp)
             else:
-                # approximate gradient numerically
-                def f(theta):  # helper function
-                    return self.clone_with_theta(theta)(X, Y)
-                return K, _approx_fprime(self.theta, f, 1e-10)
+                K_gradient = \
+                    self._gradient_factor(squareform(dists))[..., np.newaxis] \
+                    * D
 
             if not self.anisotropic:
                 return K, K_gradient[:, :].sum(-1)[:, :, np.newaxis]
@@ -1487,6 +1958,77 @@ class Matern(RBF):
         else:
             return K
 
+    def contract_gradient(self, X, W, Y=None):
+        """As RBF.contract_gradient, one dimension at a time."""
+        if self.hyperparameter_length_scale.fixed:
+            return np.empty(0)
+        X = np.atleast_2d(X)
+        length_scale = _check_length_scale(X, self.length_scale)
+        D = _training_squared_distances(X) if Y is None else None
+        if D is not None:
+            # on the pairs i < j of the cached squared distances
+            scale = np.broadcast_to(length_scale ** -2.0,
+                                    (X.shape[1],)).astype(D.dtype)
+            dists = np.sqrt(scale.dot(D))
+        elif Y is None:
+            Y = X
+            dists = squareform(pdist(X / length_scale, metric='euclidean'))
+        else:
+            Y = np.atleast_2d(Y)
+            dists = cdist(X / length_scale, Y / length_scale,
+                          metric='euclidean')
+        F = self._gradient_factor(dists)
+        if D is not None:
+            wf = squareform(W + W.T, checks=False) * F
+            if not self.anisotropic:
+                return np.array([wf.dot(dists ** 2)])
+            return D.dot(wf) * scale
+        WF = W * F
+        if not self.anisotropic:
+            return np.array([np.sum(WF * dists ** 2)])
+        g = np.empty(X.shape[1])
+        for l in range(X.shape[1]):
+            x = X[:, l] / length_scale[l]
+            y = Y[:, l] / length_scale[l]
+            g[l] = np.sum(WF * (x[:, np.newaxis] - y[np.newaxis, :]) ** 2)
+        return g
+
+    def contract_input_gradient(self, X, Y, W):
+        """dk(x, y) / dy[j] = F (x[j] - y[j]) / length_scale[j]**2, with
+        the factor F of _gradient_factor."""
+        X = np.atleast_2d(X)
+        Y = np.atleast_2d(Y)
+        length_scale = _check_length_scale(X, self.length_scale)
+        dists = cdist(X / length_scale, Y / length_scale, metric='euclidean')
+        return _contract_scaled_differences(
+            X, Y, W * self._gradient_factor(dists), length_scale)
+
+    def _gradient_factor(self, dists):
+        """Factor F of the gradient dK/dlog(length_scale[l]) = F * D[l].
+
+        D[l] is the squared distance in dimension l divided by
+        length_scale[l]**2, and dists the scaled distance r.  With
+        z = sqrt(2 nu) r the kernel is c z^nu K_nu(z), c = 2^(1-nu)/Gamma(nu),
+        and the recurrence d/dz (z^nu K_nu(z)) = -z^nu K_(nu-1)(z) gives
+        F = c 2 nu z^(nu-1) K_(nu-1)(z).  F is set to 0 where r = 0, since
+        D vanishes there.
+        """
+        if self.nu == 0.5:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                F = np.exp(-dists) / dists
+        elif self.nu == 1.5:
+            F = 3 * np.exp(-math.sqrt(3) * dists)
+        elif self.nu == 2.5:
+            tmp = math.sqrt(5) * dists
+            F = 5.0 / 3.0 * (tmp + 1) * np.exp(-tmp)
+        else:
+            z = math.sqrt(2 * self.nu) * dists
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                F = (2 ** (1. - self.nu)) / gamma(self.nu) * 2 * self.nu \
+                    * z ** (self.nu - 1) * kv(self.nu - 1, z)
+        F[~np.isfinite(F)] = 0
+        return F
+
     def __repr__(self):
         if self.anisotropic:
             return "{0}(length_scale=[{1}], nu={2:.3g})".format(
@@ -1851,11 +2393,11 @@ class PairwiseKernel(Kernel):
     A thin wrapper around the functionality of the kernels in
     sklearn.metrics.pairwise.
 
-    Note: Evaluation of eval_gradient is not analytic but numeric and all
-          kernels support only isotropic distances. The parameter gamma is
-          considered to be a hyperparameter and may be optimized. The other
-          kernel parameters are set directly at initialization and are kept
-          fixed.
+    Note: eval_gradient is analytic for the built-in metrics and numeric
+          for a callable metric, and all kernels support only isotropic
+          distances. The parameter gamma is considered to be a
+          hyperparameter and may be optimized. The other kernel parameters
+          are set directly at initialization and are kept fixed.
 
     .. versionadded:: 0.18
 
@@ -1931,6 +2473,9 @@ class PairwiseKernel(Kernel):
         if eval_gradient:
             if self.hyperparameter_gamma.fixed:
                 return K, np.empty((X.shape[0], X.shape[0], 0))
+            K_gradient = self._gamma_gradient(X, K, pairwise_kernels_kwargs)
+            if K_gradient is not None:
+                return K, K_gradient[:, :, np.newaxis]
             else:
                 # approximate gradient numerically
                 def f(gamma):  # helper function
@@ -1941,6 +2486,29 @@ class PairwiseKernel(Kernel):
         else:
             return K
 
+    def _gamma_gradient(self, X, K, pairwise_kernels_kwargs):
+        """Returns dK/dlog(gamma) of K = k(X, X), or None for a callable
+        metric."""
+        metric = self.metric
+        if metric in ("rbf", "laplacian", "chi2"):
+            # K = exp(-gamma * d(x, y)), so dK/dlog(gamma) = K * log(K)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                K_gradient = K * np.log(K)
+            K_gradient[~np.isfinite(K_gradient)] = 0
+            return K_gradient
+        elif metric in ("polynomial", "poly"):
+            degree = pairwise_kernels_kwargs.get("degree", 3)
+            coef0 = pairwise_kernels_kwargs.get("coef0", 1)
+            P = self.gamma * X.dot(X.T)
+            return degree * (P + coef0) ** (degree - 1) * P
+        elif metric == "sigmoid":
+            P = self.gamma * X.dot(X.T)
+            return P * (1 - K ** 2)
+        elif not callable(metric):
+            # linear, cosine, additive_chi2, precomputed: no gamma
+            return np.zeros_like(K)
+        return None
+
     def diag(self, X):
         """Returns the diagonal of the kernel k(X, X).
 
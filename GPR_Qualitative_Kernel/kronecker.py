@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""Kronecker-structured Gaussian process regression on full factorial grids.
+
+Initial designs built with ParameterGrid cover every combination of the
+levels of each parameter exactly once. With a product kernel
+
+    ConstantKernel * Tensor([Projection(columns_1, k_1), ...])
+
+whose blocks of columns are the parameters of the grid, the covariance of
+the training data (with its rows in grid order) is the Kronecker product
+
+    K = c * K_1 (x) K_2 (x) ... (x) K_p
+
+of the small kernels K_b of the n_b distinct values of each block. From the
+eigendecompositions K_b = Q_b diag(lambda_b) Q_b^T,
+
+    K + sigma^2 I = Q diag(c * lambda + sigma^2) Q^T,   Q = Q_1 (x) ... (x) Q_p
+
+so the log-marginal likelihood, its gradient and predictions cost
+O(sum n_b^3 + N * sum n_b) for N = prod n_b instead of O(N^3).
+
+kronecker_grid() recognizes such kernels and training data;
+GaussianProcessRegressor uses it with kronecker=True or "auto".
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.linalg import eigh
+from sklearn.base import clone
+
+from kernels import ConstantKernel, Product, ThetaLayout
+from qualitative_kernels import Projection, Tensor
+
+
+def kronecker_grid(kernel, X):
+    """Returns the KroneckerGrid of kernel on the training data X, or None.
+
+    Parameters
+    ----------
+    kernel : kernel object
+        Products (Tensor or *) of ConstantKernel and of kernels on blocks of
+        columns, i.e. Projection kernels or a single kernel on all columns.
+        Blocks must be equal or disjoint.
+
+    X : array, shape (n_samples, n_features)
+        The training data
+
+    Returns
+    -------
+    grid : KroneckerGrid or None
+        None unless the kernel has this form and the rows of X are every
+        combination of the distinct values of at least two blocks, each
+        exactly once.
+    """
+    X = np.atleast_2d(X)
+    kernel = clone(kernel)
+    constants = []
+    blocks = OrderedDict()
+    if not _flatten(kernel, list(range(X.shape[1])), constants, blocks, [0]):
+        return None
+    columns = list(blocks.keys())
+    for i, a in enumerate(columns):
+        for b in columns[i + 1:]:
+            if set(a) & set(b):
+                return None
+    if len(blocks) < 2:
+        return None
+
+    values = []
+    codes = []
+    for cols in columns:
+        U, inverse = np.unique(X[:, list(cols)], axis=0, return_inverse=True)
+        values.append(U)
+        codes.append(np.ravel(inverse))
+    shape = tuple(len(U) for U in values)
+    if np.prod(shape, dtype=float) != X.shape[0]:
+        return None
+    index = np.ravel_multi_index(codes, shape)
+    if np.bincount(index, minlength=X.shape[0]).max() != 1:
+        return None
+    return KroneckerGrid(kernel, constants,
+                         [(cols, U, blocks[cols])
+                          for cols, U in zip(columns, values)],
+                         shape, np.argsort(index))
+
+
+def _flatten(kernel, columns, constants, blocks, offset):
+    """Sorts the factors of kernel into constants and blocks of columns,
+    with the slice of theta of each, in the order of theta."""
+    if isinstance(kernel, Tensor):
+        return all(_flatten(k, columns, constants, blocks, offset)
+                   for k in kernel.kernels)
+    elif isinstance(kernel, Product):
+        return _flatten(kernel.k1, columns, constants, blocks, offset) and \
+            _flatten(kernel.k2, columns, constants, blocks, offset)
+    n_dims = len(kernel.theta)
+    s = slice(offset[0], offset[0] + n_dims)
+    offset[0] += n_dims
+    if isinstance(kernel, ConstantKernel):
+        constants.append((kernel, s))
+    elif isinstance(kernel, Projection):
+        cols = tuple(columns[c] for c in kernel.columns)
+        blocks.setdefault(cols, []).append((kernel.kernel, s))
+    else:
+        blocks.setdefault(tuple(columns), []).append((kernel, s))
+    return True
+
+
+def _kron_apply(matrices, T):
+    """Applies the Kronecker product of matrices to the grid tensor T.
+
+    T has one axis per block, in the order of matrices, and possibly one
+    trailing axis of outputs; matrix b acts along axis b.
+    """
+    for b, M in enumerate(matrices):
+        T = np.moveaxis(np.tensordot(M, T, axes=([1], [b])), 0, b)
+    return T
+
+
+def _outer(vectors):
+    """The outer product of vectors, an array with one axis per vector."""
+    T = np.ones(())
+    for v in vectors:
+        T = np.multiply.outer(T, v)
+    return T
+
+
+def _contract_rows(matrices, T):
+    """For each row i, contracts T along its block axes with the rows
+    matrices[b][i] of each block.
+
+    matrices[b] has shape (n_rows, n_b), T the grid shape and possibly a
+    trailing axis of outputs. Returns shape (n_rows,) + trailing axes.
+    """
+    R = matrices[0].dot(T.reshape(T.shape[0], -1))
+    R = R.reshape((len(R),) + T.shape[1:])
+    for M in matrices[1:]:
+        R = np.einsum("ij,ij...->i...", M, R)
+    return R
+
+
+class KroneckerGrid(object):
+    """A kernel and training data on a full factorial grid of its blocks.
+
+    Use kronecker_grid() to construct it.
+
+    Attributes
+    ----------
+    shape : tuple of int
+        The number of distinct values n_b of each block
+
+    order : array, shape (n_samples,)
+        The row of the training data at each position of the grid, in
+        C order of shape
+    """
+    def __init__(self, kernel, constants, blocks, shape, order):
+        self.kernel = kernel
+        self.layout = ThetaLayout(kernel)
+        self.constants = constants
+        self.blocks = blocks
+        self.shape = shape
+        self.order = order
+
+    def decompose(self, theta, noise, eval_gradient=False):
+        """Eigendecomposition of K + noise * I at theta.
+
+        Parameters
+        ----------
+        theta : array, shape (n_dims,)
+            The hyperparameters of the kernel
+
+        noise : float
+            The value added to the diagonal (GaussianProcessRegressor.alpha)
+
+        eval_gradient : bool
+            Whether the derivatives of each block's kernel are kept for
+            KroneckerDecomposition.log_likelihood_gradient
+
+        Returns
+        -------
+        decomposition : KroneckerDecomposition
+        """
+        self.layout.set_theta(theta)
+        c = 1.0
+        constant_gradients = []
+        for kernel, s in self.constants:
+            # d c_m / d theta_m divided by c_m: 1 for the log-transformed
+            # constant_value
+            k, g = kernel(np.zeros((1, 1)), eval_gradient=True)
+            c *= k[0, 0]
+            constant_gradients.append((s, g[0, 0] / k[0, 0]))
+        Qs = []
+        lambdas = []
+        block_gradients = []
+        for cols, U, kernels in self.blocks:
+            evaluated = [kernel(U, eval_gradient=eval_gradient)
+                         for kernel, s in kernels]
+            if eval_gradient:
+                Ks = [K for K, _ in evaluated]
+            else:
+                Ks = evaluated
+            K_b = np.prod(Ks, axis=0)
+            lam, Q = eigh(K_b)
+            # the eigenvalues of a kernel matrix are >= 0 up to rounding
+            lambdas.append(np.maximum(lam, 0.0))
+            Qs.append(Q)
+            if eval_gradient:
+                gradients = []
+                for m, ((kernel, s), (K, K_gradient)) in \
+                        enumerate(zip(kernels, evaluated)):
+                    if s.start == s.stop:
+                        continue
+                    others = np.prod([Ks[l] for l in range(len(Ks))
+                                      if l != m], axis=0) \
+                        if len(Ks) > 1 else 1.0
+                    # in the eigenbasis of the block
+                    G = np.einsum("ia,ijl,jb->abl", Q,
+                                  K_gradient * np.asarray(others)[
+                                      ..., np.newaxis], Q, optimize=True)
+                    gradients.append((s, G))
+                block_gradients.append(gradients)
+        return KroneckerDecomposition(self, theta, c, Qs, lambdas, noise,
+                                      constant_gradients, block_gradients)
+
+    def _cross_kernels(self, X):
+        """The kernels k_b(X, U_b) of each block, shape (n_rows, n_b)."""
+        X = np.atleast_2d(X)
+        return [np.prod([kernel(X[:, list(cols)], U)
+                         for kernel, s in kernels], axis=0)
+                for cols, U, kernels in self.blocks]
+
+    def _diag(self, X):
+        """The prior variance k(x, x) of each row of X, without c."""
+        X = np.atleast_2d(X)
+        d = np.ones(X.shape[0])
+        for cols, U, kernels in self.blocks:
+            for kernel, s in kernels:
+                d *= kernel.diag(X[:, list(cols)])
+        return d
+
+    def _kernel(self, X):
+        """The prior covariance k(X, X) without c."""
+        X = np.atleast_2d(X)
+        K = np.ones((X.shape[0], X.shape[0]))
+        for cols, U, kernels in self.blocks:
+            for kernel, s in kernels:
+                K *= kernel(X[:, list(cols)])
+        return K
+
+
+class KroneckerDecomposition(object):
+    """K + noise * I of a KroneckerGrid at one theta, in its eigenbasis.
+
+    Vectors over the training data are taken and returned in the order of
+    its rows; internally they are reordered into grid tensors.  The grid's
+    kernel is shared by all decompositions, so predictions set it back to
+    this theta first.
+    """
+    def __init__(self, grid, theta, c, Qs, lambdas, noise,
+                 constant_gradients, block_gradients):
+        self.grid = grid
+        self.theta = np.array(theta, dtype=np.float64)
+        self.c = c
+        self.Qs = Qs
+        self.lambdas = lambdas
+        self.noise = noise
+        self.constant_gradients = constant_gradients
+        self.block_gradients = block_gradients
+        # eigenvalues of the kernel and of K + noise * I, as grid tensors
+        self.S = c * _outer(lambdas)
+        self.D = self.S + noise
+
+    @property
+    def log_det(self):
+        """log |K + noise * I|, or inf if it is singular."""
+        if np.any(self.D <= 0.0):
+            return np.inf
+        return np.sum(np.log(self.D))
+
+    def _to_grid(self, y):
+        y = y[self.grid.order]
+        return y.reshape(self.grid.shape + y.shape[1:])
+
+    def _from_grid(self, T, n_outputs_shape):
+        a = np.empty((len(self.grid.order),) + n_outputs_shape)
+        a[self.grid.order] = T.reshape((-1,) + n_outputs_shape)
+        return a
+
+    def _eigen_solve(self, y):
+        """(K + noise * I)^-1 y in the eigenbasis, as a grid tensor."""
+        Y = _kron_apply([Q.T for Q in self.Qs], self._to_grid(y))
+        D = self.D.reshape(self.D.shape + (1,) * (y.ndim - 1))
+        return Y / D
+
+    def solve(self, y):
+        """Returns (K + noise * I)^-1 y.
+
+        Parameters
+        ----------
+        y : array, shape (n_samples, [n_outputs])
+
+        Returns
+        -------
+        alpha : array, shape (n_samples, [n_outputs])
+        """
+        return self._from_grid(_kron_apply(self.Qs, self._eigen_solve(y)),
+                               y.shape[1:])
+
+    def log_likelihood_gradient(self, y, weights):
+        """Gradient of the log-marginal likelihood with respect to theta.
+
+        0.5 * sum_k weights_k alpha_k^T dK alpha_k
+            - 0.5 * n_outputs * trace((K + noise * I)^-1 dK)
+        for alpha = (K + noise * I)^-1 y, computed in the eigenbasis, where
+        the derivative of K with respect to a hyperparameter of block b is
+        c * diag(lambda_1) (x) ... (x) Q_b^T dK_b Q_b (x) ... diag(lambda_p).
+
+        Parameters
+        ----------
+        y : array, shape (n_samples, n_outputs)
+
+        weights : array, shape (n_outputs,)
+            1, or 1 / s_k^2 with profiled output scales
+        """
+        A = self._eigen_solve(y)                  # Q^T alpha, grid tensor
+        n_outputs = y.shape[1]
+        gradient = np.zeros(self.grid.layout.n_dims)
+        WA = A * weights
+        for s, ratio in self.constant_gradients:
+            # dK = ratio * K
+            quad = np.sum(WA * A * self.S[..., np.newaxis])
+            trace = np.sum(self.S / self.D)
+            gradient[s] = 0.5 * ratio * (quad - n_outputs * trace)
+        inverse_D = 1.0 / self.D
+        for b, gradients in enumerate(self.block_gradients):
+            if not gradients:
+                continue
+            # the eigenvalues of every block but b, times c
+            others = self.c * _outer(
+                [np.ones_like(lam) if l == b else lam
+                 for l, lam in enumerate(self.lambdas)])
+            B = A * others[..., np.newaxis]
+            # inverse_D * others summed over every axis but b
+            axes = tuple(l for l in range(len(self.lambdas)) if l != b)
+            trace_weights = np.sum(inverse_D * others, axis=axes)
+            for s, G in gradients:
+                for l in range(G.shape[2]):
+                    GB = np.moveaxis(np.tensordot(G[:, :, l], B,
+                                                  axes=([1], [b])), 0, b)
+                    quad = np.sum(WA * GB)
+                    trace = trace_weights.dot(np.diag(G[:, :, l]))
+                    gradient[s.start + l] = 0.5 * (quad - n_outputs * trace)
+        return gradient
+
+    def predict_mean(self, X, alpha):
+        """Returns k(X, X_train).dot(alpha) for alpha = solve(y)."""
+        self.grid.layout.set_theta(self.theta)
+        A = self._to_grid(alpha)
+        return self.c * _contract_rows(self.grid._cross_kernels(X), A)
+
+    def predict_var(self, X):
+        """Returns the posterior variance of the latent function at X."""
+        self.grid.layout.set_theta(self.theta)
+        V = [K.dot(Q) for K, Q in zip(self.grid._cross_kernels(X), self.Qs)]
+        quad = self.c ** 2 * _contract_rows([v ** 2 for v in V],
+                                            1.0 / self.D)
+        return self.c * self.grid._diag(X) - quad
+
+    def predict_cov(self, X):
+        """Returns the posterior covariance of the latent function at X.
+
+        Forms the (n_rows, n_samples) cross-covariance in the eigenbasis.
+        """
+        self.grid.layout.set_theta(self.theta)
+        V = [K.dot(Q) for K, Q in zip(self.grid._cross_kernels(X), self.Qs)]
+        F = V[0]
+        for v in V[1:]:
+            F = (F[:, :, np.newaxis] * v[:, np.newaxis, :]).reshape(
+                len(F), -1)
+        F *= self.c
+        return self.c * self.grid._kernel(X) - (F / self.D.ravel()).dot(F.T)
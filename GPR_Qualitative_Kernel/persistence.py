@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Saving fitted models for prediction in other processes.
+
+fit() is the expensive part of a surrogate model, while LCB, optimize and
+the plots only need its fitted state.  save_regressor() writes that state
+to a directory: every large array (X_train_, L_, alpha_, ...) as a raw .npy
+file and the rest (parameters, kernel_ with its theta, small attributes)
+pickled into estimator.pkl.  load_regressor() memory-maps the arrays, so
+any number of worker processes share one copy of them through the page
+cache, without refitting or unpickling large arrays.
+
+A directory of .npy files is used rather than an .npz archive because
+np.load cannot memory-map the members of an archive.
+
+Regressors get save() and load() from PersistenceMixin.  Each lists its
+arrays in _saved_arrays and the private attributes to pickle with the rest
+in _saved_private, and rebuilds what is not saved (the caches of
+log_marginal_likelihood) in _restore().
+"""
+from __future__ import print_function
+
+import copy
+import os
+import pickle
+
+import numpy as np
+
+ESTIMATOR_FILE = "estimator.pkl"
+
+
+def save_regressor(gpr, path):
+    """Saves the fitted regressor gpr to the directory path.
+
+    Private attributes other than those in gpr._saved_arrays and
+    gpr._saved_private are caches and are not saved.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in gpr._saved_arrays:
+        value = getattr(gpr, name, None)
+        filename = os.path.join(path, name + ".npy")
+        if value is not None:
+            np.save(filename, np.ascontiguousarray(value))
+        elif os.path.exists(filename):
+            # e.g. L_ of an earlier Cholesky fit saved to the same path
+            os.remove(filename)
+    state = {}
+    for name, value in vars(gpr).items():
+        if name in gpr._saved_arrays:
+            continue
+        if not name.startswith("_") or name in gpr._saved_private:
+            state[name] = value
+    stripped = copy.copy(gpr)
+    stripped.__dict__ = state
+    with open(os.path.join(path, ESTIMATOR_FILE), "wb") as f:
+        pickle.dump(stripped, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_regressor(path, mmap_mode="r"):
+    """Loads a regressor saved by save_regressor.
+
+    Parameters
+    ----------
+    path : str
+        The directory the regressor was saved to
+
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional (default: 'r')
+        Passed on to np.load for the arrays; the default maps them
+        read-only, None reads them into memory.
+
+    Returns
+    -------
+    gpr : the regressor, ready for predict
+    """
+    with open(os.path.join(path, ESTIMATOR_FILE), "rb") as f:
+        gpr = pickle.load(f)
+    if not os.path.exists(os.path.join(path, "X_train_.npy")):
+        # saved before fit
+        return gpr
+    for name in gpr._saved_arrays:
+        filename = os.path.join(path, name + ".npy")
+        if os.path.exists(filename):
+            setattr(gpr, name, np.load(filename, mmap_mode=mmap_mode))
+        else:
+            setattr(gpr, name, None)
+    gpr._restore()
+    return gpr
+
+
+class PersistenceMixin(object):
+    """Mixin for regressors, adding save and load (see the module)."""
+    _saved_arrays = ()
+    _saved_private = ()
+
+    def save(self, path):
+        """Saves the fitted model to the directory path.
+
+        load(path) memory-maps the training data and factors back, e.g. in
+        worker processes that only predict.
+        """
+        save_regressor(self, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Loads a model saved with save(); the arrays are memory-mapped
+        with mmap_mode (None reads them into memory)."""
+        gpr = load_regressor(path, mmap_mode)
+        if not isinstance(gpr, cls):
+            raise TypeError("%s holds a %s, not a %s"
+                            % (path, type(gpr).__name__, cls.__name__))
+        return gpr
+
+    def _restore(self):
+        """Nothing is cached beyond the saved state."""
@@ -7,12 +7,53 @@ Created on Mon Oct  9 09:09:33 2017
 """
 from __future__ import print_function
 
+from collections import OrderedDict
+import os
+
+import hypersphere_numpy
+import hypersphere_pure
+
+# HyperSphere implementations by name, fastest first; the Cython one only
+# if the extension has been compiled (python setup.py build_ext --inplace)
+HYPERSPHERE_BACKENDS = OrderedDict()
 try:
-    from hypersphere import HyperSphere
-    print("HyperSphere: using Cython version")
-except:
-    from hypersphere_pure import HyperSphere
-    print("HyperSphere: using pure Python version")
+    import hypersphere
+    HYPERSPHERE_BACKENDS["cython"] = hypersphere.HyperSphere
+except ImportError:
+    pass
+HYPERSPHERE_BACKENDS["numpy"] = hypersphere_numpy.HyperSphere
+HYPERSPHERE_BACKENDS["python"] = hypersphere_pure.HyperSphere
+
+_BACKEND_NAMES = {"cython": "Cython", "numpy": "NumPy",
+                  "python": "pure Python"}
+
+
+def set_hypersphere_backend(name=None):
+    """Selects the HyperSphere implementation of UnrestrictiveCorrelation.
+
+    name is one of HYPERSPHERE_BACKENDS ("cython", "numpy", "python"), or
+    None for the environment variable HYPERSPHERE_BACKEND if it is set,
+    else the fastest available.  Returns the name of the active backend.
+    """
+    global HyperSphere, _hypersphere_backend
+    if name is None:
+        name = os.environ.get("HYPERSPHERE_BACKEND",
+                              next(iter(HYPERSPHERE_BACKENDS)))
+    if name not in HYPERSPHERE_BACKENDS:
+        raise ValueError("HyperSphere backend {} is not available, choose "
+                         "from {}".format(name, list(HYPERSPHERE_BACKENDS)))
+    HyperSphere = HYPERSPHERE_BACKENDS[name]
+    _hypersphere_backend = name
+    print("HyperSphere: using {} version".format(_BACKEND_NAMES[name]))
+    return name
+
+
+def hypersphere_backend():
+    """Returns the name of the active HyperSphere implementation."""
+    return _hypersphere_backend
+
+
+set_hypersphere_backend()
 
 
 from functools import reduce
@@ -27,11 +68,80 @@ from kernels import Kernel
 from kernels import RBF, CompoundKernel
 from kernels import Hyperparameter
 from kernels import NormalizedKernelMixin
+from kernels import training_data_cache
+from kernels import ThetaLayout
 from scipy.linalg import cholesky
 
 import logging
 logging.basicConfig(filename='CategoricalKernel.log',level=logging.DEBUG)
 
+# =============================================================================
+# Kernels on a single dummy-coded factor depend on X only through their
+# (dim, dim) correlation matrix C: k(x_i, x_j) = x_i.dot(C).dot(x_j).
+# For one-hot rows that is the lookup C[code_i, code_j], so they also accept
+# a 1-d array of integer level codes, which Projection builds once per X.
+# =============================================================================
+class CategoricalKernelMixin(object):
+    """Mixin for kernels on the dummy-coded columns of a single factor.
+
+    X may be given either dummy-coded, shape (n_samples, dim), or as a 1-d
+    integer array of level codes, shape (n_samples,).
+    """
+    def level_codes(self, X):
+        """Returns the level code of each row of X, or None if X has rows
+        which are not one-hot (e.g. inducing inputs inside the simplex)."""
+        X = np.asarray(X)
+        if X.ndim == 1:
+            return X.astype(np.intp)
+        X = np.atleast_2d(X)
+        assert X.shape[1] == self.dim, "Dimension mismatch"
+        if not (np.all((X == 0.0) | (X == 1.0)) and
+                np.all(X.sum(axis=1) == 1.0)):
+            return None
+        return np.argmax(X, axis=1)
+
+    def dummies(self, X):
+        """Returns the dummy-coded representation of X."""
+        X = np.asarray(X)
+        if X.ndim == 1:
+            return np.eye(self.dim)[X]
+        X = np.atleast_2d(X)
+        assert X.shape[1] == self.dim, "Dimension mismatch"
+        return X
+
+    def _level_codes_pair(self, X, Y=None):
+        """Level codes of X and Y (Y=None means X), or (None, None) unless
+        both are one-hot."""
+        cx = self.level_codes(X)
+        if Y is None:
+            return cx, cx
+        cy = self.level_codes(Y)
+        if cx is None or cy is None:
+            return None, None
+        return cx, cy
+
+    def _level_sums(self, X, W, Y=None):
+        """Returns the (dim, dim) matrix X.T.dot(W).dot(Y) (Y=None means X),
+        i.e. the entries of W summed over each pair of levels."""
+        cx, cy = self._level_codes_pair(X, Y)
+        if cx is None:
+            X = self.dummies(X)
+            Y = self.dummies(Y) if Y is not None else X
+            return X.T.dot(W).dot(Y)
+        dim = self.dim
+        index = cx[:, np.newaxis] * dim + cy[np.newaxis, :]
+        M = np.bincount(index.ravel(), weights=np.ravel(W),
+                        minlength=dim * dim)
+        return M.reshape(dim, dim)
+
+    def contract_diag_gradient(self, X, w):
+        """The diagonal C[c, c] = 1 of one-hot rows is constant."""
+        return np.zeros(self.n_dims)
+
+    def contract_input_gradient(self, X, Y, W):
+        """k(x, y) = x C y^T is linear in y, so the gradient is W^T X C."""
+        return W.T.dot(self.dummies(X)).dot(self.correlation)
+
 # =============================================================================
 # TODO: should this be a (Unary)KernelOperator?  If so, ExponentialKernel
 # probably should be as well...
@@ -97,10 +207,65 @@ class Projection(Kernel):
             hyperparameters of the kernel. Only returned when eval_gradient
             is True.
         """
-        X1 = np.atleast_2d(X)[:,self.columns] 
-        Y1 = np.atleast_2d(Y)[:,self.columns] if Y is not None else None
+        X1 = self._project(X)
+        Y1 = self._project(Y) if Y is not None else None
         
         return self.kernel(X1, Y1, eval_gradient=eval_gradient)
+
+    def _gradient_into(self, X, out=None):
+        """The wrapped Tensor's or DirectSum's, on the projected columns."""
+        return self.kernel._gradient_into(self._project(X), out)
+
+    def _project(self, X):
+        """Restricts X to the projected columns.
+        
+        For a categorical kernel, one-hot columns are replaced by their
+        integer level codes; those of training data are computed once and
+        kept in its TrainingDataCache.  Otherwise the cached projection of
+        training data is returned, the same array every time, so the kernel
+        finds its own cache."""
+        cache = training_data_cache(X)
+        if (isinstance(self.kernel, CategoricalKernelMixin) and
+                isinstance(X, np.ndarray) and X.ndim == 2):
+            if cache is not None:
+                codes = cache.level_codes(self.columns, self.kernel)
+            else:
+                codes = self.kernel.level_codes(X[:,self._column_index()])
+            if codes is not None:
+                return codes
+        if cache is not None:
+            return cache.project(self.columns)
+        return np.atleast_2d(X)[:,self._column_index()]
+
+    def _column_index(self):
+        """Returns the columns as a slice if they are consecutive, so that
+        X[:, index] is a view of X rather than a copy.  GPR_Model orders the
+        dummy-coded data so that every factor's columns are."""
+        c = self.columns
+        if len(c) > 0 and list(c) == list(range(c[0], c[0] + len(c))):
+            return slice(c[0], c[0] + len(c))
+        return c
+
+    def _theta_leaves(self):
+        """Returns the kernels holding the hyperparameters, in theta order."""
+        return self.kernel._theta_leaves()
+
+    def contract_gradient(self, X, W, Y=None):
+        """The wrapped kernel's, on the projected columns."""
+        Y1 = self._project(Y) if Y is not None else None
+        return self.kernel.contract_gradient(self._project(X), W, Y1)
+
+    def contract_diag_gradient(self, X, w):
+        """The wrapped kernel's, on the projected columns."""
+        return self.kernel.contract_diag_gradient(self._project(X), w)
+
+    def contract_input_gradient(self, X, Y, W):
+        """The wrapped kernel's in the projected columns, 0 elsewhere."""
+        Y = np.atleast_2d(Y)
+        G = np.zeros(Y.shape)
+        G[:, self._column_index()] = self.kernel.contract_input_gradient(
+            self._project(X), self._project(Y), W)
+        return G
     
     def get_params(self, deep=True):
         """Get parameters of this kernel.
@@ -202,8 +367,7 @@ class Projection(Kernel):
         K_diag : array, shape (n_samples_X,)
             Diagonal of kernel k(X, X)
         """
-        X1 = np.atleast_2d(X)[:,self.columns]
-        return self.kernel.diag(X1)
+        return self.kernel.diag(self._project(X))
     
     def __repr__(self):
         if self.name:
@@ -215,12 +379,201 @@ class Projection(Kernel):
         """Returns whether the kernel is stationary. """
         return self.kernel.is_stationary()
 
+# =============================================================================
+# HyperSphere objects are cached by value: the key is the zeta bytes (and dim
+# and backend), so a kernel from clone_with_theta() or a theta setter simply
+# looks up different angles, and nothing can go stale.
+# =============================================================================
+def _read_only(a):
+    """A view of a which cannot be written to."""
+    a = np.asarray(a).view()
+    a.setflags(write=False)
+    return a
+
+
+class _HyperSphereEntry(object):
+    """A HyperSphere with the quantities UnrestrictiveCorrelation needs,
+    each computed on first use.  The arrays are shared, so read-only."""
+    def __init__(self, hypersphere):
+        self.hypersphere = hypersphere
+        self._correlation = None
+        self._lower_triangular = None
+        self._derivative_rows = None
+        self._gradient_rows = None
+
+    @property
+    def correlation(self):
+        if self._correlation is None:
+            self._correlation = _read_only(self.hypersphere.correlation)
+        return self._correlation
+
+    @property
+    def lower_triangular(self):
+        if self._lower_triangular is None:
+            self._lower_triangular = \
+                _read_only(self.hypersphere._lower_triangular())
+        return self._lower_triangular
+
+    @property
+    def derivative_rows(self):
+        if self._derivative_rows is None:
+            self._derivative_rows = _read_only(
+                self.hypersphere._lower_triangular_derivative_rows())
+        return self._derivative_rows
+
+    @property
+    def gradient_rows(self):
+        if self._gradient_rows is None:
+            rows, W = self.hypersphere.gradient_rows
+            self._gradient_rows = _read_only(rows), _read_only(W)
+        return self._gradient_rows
+
+
+class _HyperSphereBatchArrays(object):
+    """The arrays of a HyperSphereBatch, each computed for all vectors on
+    first use by any _BatchedHyperSphereEntry, and read-only."""
+    def __init__(self, batch):
+        self.batch = batch
+        self._correlation = None
+        self._lower_triangular = None
+        self._derivative_rows = None
+        self._W = None
+        self.rows = _read_only(batch._tables.rows)
+
+    @property
+    def correlation(self):
+        if self._correlation is None:
+            self._correlation = _read_only(self.batch.correlation)
+        return self._correlation
+
+    @property
+    def lower_triangular(self):
+        if self._lower_triangular is None:
+            self._lower_triangular = \
+                _read_only(self.batch._lower_triangular())
+        return self._lower_triangular
+
+    @property
+    def derivative_rows(self):
+        if self._derivative_rows is None:
+            self._derivative_rows = \
+                _read_only(self.batch._lower_triangular_derivative_rows())
+        return self._derivative_rows
+
+    @property
+    def W(self):
+        if self._W is None:
+            L = self.batch._lower_triangular()
+            W = np.matmul(self.derivative_rows, L.transpose(0, 2, 1))
+            t = self.batch._tables
+            W[:, t.params, t.rows] = 0.0
+            self._W = _read_only(W)
+        return self._W
+
+
+class _BatchedHyperSphereEntry(_HyperSphereEntry):
+    """Vector i of a HyperSphereBatch, in place of a _HyperSphereEntry; the
+    HyperSphere itself is only built if asked for."""
+    def __init__(self, arrays, i):
+        self._arrays = arrays
+        self._i = i
+
+    @property
+    def hypersphere(self):
+        batch = self._arrays.batch
+        return HyperSphere(batch.dim, batch.zeta[self._i])
+
+    @property
+    def correlation(self):
+        return self._arrays.correlation[self._i]
+
+    @property
+    def lower_triangular(self):
+        return self._arrays.lower_triangular[self._i]
+
+    @property
+    def derivative_rows(self):
+        return self._arrays.derivative_rows[self._i]
+
+    @property
+    def gradient_rows(self):
+        return self._arrays.rows, self._arrays.W[self._i]
+
+
+class _HyperSphereCache(object):
+    """Least recently used cache of _HyperSphereEntry, keyed on
+    (backend, dim, zeta bytes)."""
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dim, zeta):
+        zeta = np.ascontiguousarray(zeta, dtype=np.float64)
+        key = (_hypersphere_backend, dim, zeta.tobytes())
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = _HyperSphereEntry(HyperSphere(dim, zeta))
+        else:
+            self.hits += 1
+        self._insert(key, entry)
+        return entry
+
+    def put(self, dim, zeta, entry):
+        """Stores entry as the most recently used one for zeta."""
+        zeta = np.ascontiguousarray(zeta, dtype=np.float64)
+        key = (_hypersphere_backend, dim, zeta.tobytes())
+        self._entries.pop(key, None)
+        self._insert(key, entry)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_hypersphere_cache = _HyperSphereCache()
+
+
+def prefetch_hyperspheres(kernel, thetas):
+    """Computes the HyperSphere of every UnrestrictiveCorrelation in kernel
+    for all rows of thetas at once, one HyperSphereBatch per factor.
+
+    Returns a function prefetch(i) which puts the entries of thetas[i] into
+    the HyperSphere cache, so that evaluating kernel at thetas[i] right
+    after builds no HyperSphere.  The batched entries are computed with
+    NumPy whatever the backend, and agree with it to rounding.
+    """
+    batches = []
+    for leaf, name, index, log, vector in ThetaLayout(kernel).entries:
+        if isinstance(leaf, UnrestrictiveCorrelation) and name == "zeta":
+            zetas = np.asarray(thetas, dtype=np.float64)[:, index]
+            zetas = np.ascontiguousarray(np.exp(zetas) if log else zetas)
+            arrays = _HyperSphereBatchArrays(
+                hypersphere_numpy.HyperSphereBatch(leaf.dim, zetas))
+            batches.append((leaf.dim, zetas, arrays))
+
+    def prefetch(i):
+        for dim, zetas, arrays in batches:
+            _hypersphere_cache.put(dim, zetas[i],
+                                   _BatchedHyperSphereEntry(arrays, i))
+    return prefetch
+
+
 # =============================================================================
 # Assumes X includes a factor f which has been dummy coded into columns
 # F = (f_0, f_1, ... f_dim-1)
 # Use with Projection to extract the columns
 # =============================================================================
-class  UnrestrictiveCorrelation(NormalizedKernelMixin, Kernel):
+class  UnrestrictiveCorrelation(CategoricalKernelMixin, NormalizedKernelMixin,
+                                Kernel):
     """Unrestrictive Correlation kernel for use with qualitative factors.
 
     Uses a hypersphere coordinate system to model the correlations
@@ -285,38 +638,72 @@ class  UnrestrictiveCorrelation(NormalizedKernelMixin, Kernel):
             hyperparameters of the kernel. Only returned when eval_gradient
             is True.
         """
-        assert X.shape[1] == self.dim, "Wrong dimension for X"
-        if Y is not None:
-            assert Y.shape[1] == self.dim, "Wrong dimension for Y"
-
-        Y1 = Y if Y is not None else X
+        cx, cy = self._level_codes_pair(X, Y)
+        if cx is None:
+            X = self.dummies(X)
+            Y1 = self.dummies(Y) if Y is not None else X
         
-        h = self.hypersphere
+        h = self._hypersphere_entry()
         
-        K = X.dot(h.correlation).dot(Y1.T)
+        if cx is not None:
+            K = h.correlation[cx[:, np.newaxis], cy]
+        else:
+            K = X.dot(h.correlation).dot(Y1.T)
 
         if eval_gradient:
             if Y is not None:
                 raise ValueError("Gradient can only be evaluated when Y is None.")
-            G = h.gradient
-            # G is a list of arrays
-            assert all(g.shape[0] == X.shape[1] for g in G), "Incompatible dimensions"
-            grad = []
-            for g in G:
-                grad.append(X.dot(g).dot(X.T))
-            grad_stack = np.dstack(grad)
+            # the gradient for each zeta is e_r w^T + w e_r^T
+            rows, W = h.gradient_rows
+            m = len(rows)
+            if cx is not None:
+                G = np.zeros((self.dim, self.dim, m))
+                G[rows, :, np.arange(m)] = W
+                G[:, rows, np.arange(m)] += W.T
+                grad_stack = G[cx[:, np.newaxis], cx]
+            else:
+                # X (e_r w^T + w e_r^T) X^T = x_r (X w)^T + (X w) x_r^T
+                XW = X.dot(W.T)
+                grad_stack = np.einsum("ik,jk->ijk", X[:, rows], XW)
+                grad_stack += grad_stack.transpose(1, 0, 2)
             return K, grad_stack
         else:
             return K
+
+    def contract_gradient(self, X, W, Y=None):
+        """sum(g * M) for each gradient slice g, with M = X.T.dot(W).dot(Y)."""
+        return self.contract_level_sums(self._level_sums(X, W, Y))
+
+    def contract_level_sums(self, M):
+        """Returns the gradient contracted with W, given the (dim, dim)
+        level sums M = X.T.dot(W).dot(X).
+
+        With the gradient e_r w^T + w e_r^T, w = L v for the row v of
+        d L / d zeta, and w[r] = 0, the contraction is v.dot(L.T).dot(N[r])
+        for N = M + M.T with zero diagonal.  So only N.dot(L) is formed,
+        O(dim^3), rather than a (dim, dim) gradient for each zeta.
+        """
+        h = self._hypersphere_entry()
+        N = M + M.T
+        np.fill_diagonal(N, 0.0)
+        Z = N.dot(h.lower_triangular)
+        rows = np.tril_indices(self.dim, -1)[0]
+        return np.einsum("kj,kj->k", h.derivative_rows, Z[rows])
+
+    def _hypersphere_entry(self):
+        """The cached HyperSphere of the current zeta, with its correlation
+        and gradients (shared arrays, see _HyperSphereCache)."""
+        return _hypersphere_cache.get(self.dim, self.zeta)
         
     @property
     def hypersphere(self):
         """Handles details of parameterization of the correlation matrix.
         
-        DO NOT cache this object, clone_with_theta() will not
-        update it properly with new zeta values."""
+        Cached by the value of zeta, so repeated evaluations at the same
+        angles share one object; a new zeta (e.g. from clone_with_theta())
+        looks up another one."""
 
-        return HyperSphere(self.dim, self.zeta)
+        return self._hypersphere_entry().hypersphere
     
     @property
     def correlation(self):
@@ -326,7 +713,7 @@ class  UnrestrictiveCorrelation(NormalizedKernelMixin, Kernel):
         -------
         K : array, shape (dim, dim)
         """
-        return self.hypersphere.correlation
+        return self._hypersphere_entry().correlation.copy()
         
     def is_stationary(self):
         return False
@@ -349,7 +736,7 @@ class  UnrestrictiveCorrelation(NormalizedKernelMixin, Kernel):
                                n_elements=m,
                                log=False)
 
-class ExchangeableCorrelation(Kernel):
+class ExchangeableCorrelation(CategoricalKernelMixin, Kernel):
     """The d * d correlation matrix C is modelled by a single correlation.
     
     C[i,j] = zeta (i != j), C[i,i] = 1"""
@@ -359,20 +746,17 @@ class ExchangeableCorrelation(Kernel):
         self.zeta_bounds = zeta_bounds
         
     def __call__(self, X, Y=None, eval_gradient=False):
-        X = np.atleast_2d(X)
-        dim = self.dim
-        assert dim == X.shape[1], "Dimension mismatch"
-
-        if Y is None:
-            Y = X
-        elif eval_gradient:
+        if Y is not None and eval_gradient:
             raise ValueError("Gradient can only be evaluated when Y is None.")
-        assert X.shape[1] == Y.shape[1], "Dimension mismatch for X and Y"
+        cx, cy = self._level_codes_pair(X, Y)
+        if cx is None:
+            X = self.dummies(X)
+            Y = self.dummies(Y) if Y is not None else X
                 
         # correlation zeta is a single number between 0 and 1
         C = self.correlation
         
-        K = X.dot(C).dot(Y.T)
+        K = C[cx[:, np.newaxis], cy] if cx is not None else X.dot(C).dot(Y.T)
         
         if eval_gradient:
             if not self.hyperparameter_zeta.fixed:
@@ -384,13 +768,29 @@ class ExchangeableCorrelation(Kernel):
                 # n.b. don't bother copying C since we're done with it otherwise
                 K_gradient = C
                 np.fill_diagonal(K_gradient, 0.0)
-                K_gradient = X.dot(K_gradient).dot(X.T)
+                if cx is not None:
+                    K_gradient = K_gradient[cx[:, np.newaxis], cx]
+                else:
+                    K_gradient = X.dot(K_gradient).dot(X.T)
                 return (K, np.dstack([K_gradient]))
             else:
-                return K, np.empty((X.shape[0], X.shape[0], 0))
+                return K, np.empty((K.shape[0], K.shape[0], 0))
         else:
             return K
 
+    def contract_gradient(self, X, W, Y=None):
+        """Computed on the (dim, dim) matrix X.T.dot(W).dot(Y)."""
+        return self.contract_level_sums(self._level_sums(X, W, Y))
+
+    def contract_level_sums(self, M):
+        """Returns the gradient contracted with W, given the (dim, dim)
+        level sums M = X.T.dot(W).dot(X)."""
+        if self.hyperparameter_zeta.fixed:
+            return np.empty(0)
+        C = self.correlation
+        np.fill_diagonal(C, 0.0)
+        return np.array([np.sum(C * M)])
+
     @property
     def correlation(self):
         # correlation zeta is a single number between 0 and 1
@@ -459,27 +859,27 @@ class ExchangeableCorrelation(Kernel):
 # TODO: decide if dim should be removed as a parameter for all these kernels
 # use quadratic formula d = (sqrt(8*m + 1) + 1) // 2 to assert validity
 # =============================================================================
-class MultiplicativeCorrelation(NormalizedKernelMixin, Kernel):
+class MultiplicativeCorrelation(CategoricalKernelMixin, NormalizedKernelMixin,
+                                Kernel):
     def __init__(self, dim, zeta, zeta_bounds=(0.0, 1.e6)):
         self.dim = dim
         self.zeta = np.array(zeta, dtype=np.float64)
         self.zeta_bounds = zeta_bounds
         
     def __call__(self, X, Y=None, eval_gradient=False):
-        X = np.atleast_2d(X)
-        if Y is None:
-            Y = X
-        elif eval_gradient:
+        if Y is not None and eval_gradient:
             raise ValueError("Gradient can only be evaluated when Y is None.")
-        assert X.shape[1] == Y.shape[1], "Dimension mismatch for X and Y"
+        cx, cy = self._level_codes_pair(X, Y)
+        if cx is None:
+            X = self.dummies(X)
+            Y = self.dummies(Y) if Y is not None else X
         
         dim = self.dim
-        assert dim == X.shape[1], "Dimension mismatch"
         assert dim == len(self.zeta), "Wrong number of parameters given"
         
         C = self.correlation
         
-        K = X.dot(C).dot(Y.T)
+        K = C[cx[:, np.newaxis], cy] if cx is not None else X.dot(C).dot(Y.T)
         
         if eval_gradient:
             if not self.hyperparameter_zeta.fixed:
@@ -491,13 +891,29 @@ class MultiplicativeCorrelation(NormalizedKernelMixin, Kernel):
                 # n.b. don't bother copying C since we're done with it otherwise
                 K_gradient = -C
                 np.fill_diagonal(K_gradient, 0.0)
-                K_gradient = X.dot(K_gradient).dot(X.T)
+                if cx is not None:
+                    K_gradient = K_gradient[cx[:, np.newaxis], cx]
+                else:
+                    K_gradient = X.dot(K_gradient).dot(X.T)
                 return (K, np.tile(K_gradient[:,:,np.newaxis], (1, 1, dim)))
             else:
-                return K, np.empty((X.shape[0], X.shape[0], 0))
+                return K, np.empty((K.shape[0], K.shape[0], 0))
         else:
             return K
 
+    def contract_gradient(self, X, W, Y=None):
+        """Computed on the (dim, dim) matrix X.T.dot(W).dot(Y)."""
+        return self.contract_level_sums(self._level_sums(X, W, Y))
+
+    def contract_level_sums(self, M):
+        """Returns the gradient contracted with W, given the (dim, dim)
+        level sums M = X.T.dot(W).dot(X)."""
+        if self.hyperparameter_zeta.fixed:
+            return np.empty(0)
+        C = -self.correlation
+        np.fill_diagonal(C, 0.0)
+        return np.repeat(np.sum(C * M), self.dim)
+
     @property
     def correlation(self):
         """Correlation parameterized as: C[i,j] = exp(-(zeta[i]+zeta[j])"""
@@ -570,6 +986,69 @@ class MultiplicativeCorrelation(NormalizedKernelMixin, Kernel):
         return np.arccos(C[np.tril_indices(dim, -1)])
 
 
+def _assemble_gradients(kernels, X, out=None):
+    """Evaluates each kernel with its gradient on X.
+    
+    The gradients are written into their slabs of a single array, instead
+    of growing a stack with dstack: into out if it is given, else into one
+    allocated with the dtype of the first kernel's result and widened if a
+    later kernel's gradient needs more.  Tensor and DirectSum kernels, also
+    projected, write into their slab directly (cast to its dtype), so a
+    whole tree of them fills one array.
+    
+    Returns
+    -------
+    K_gradient : array, shape (n_samples_X, n_samples_X, total n_dims)
+    Ks : list of arrays, the kernels k(X, X)
+    slabs : list of slices, the columns of K_gradient of each kernel
+    """
+    widths = [k.n_dims for k in kernels]
+    offsets = np.cumsum([0] + widths)
+    slabs = [slice(offsets[i], offsets[i + 1]) for i in range(len(kernels))]
+    owned = out is None
+    Ks = []
+    for k, slab in zip(kernels, slabs):
+        if out is not None and _writes_gradient_into(k):
+            K = k._gradient_into(X, out[:, :, slab])[0]
+        else:
+            K, G = k(X, eval_gradient=True)
+            if G.shape[2] != slab.stop - slab.start:
+                raise ValueError("Gradient of {} has {} columns, expected "
+                                 "{}".format(k, G.shape[2],
+                                             slab.stop - slab.start))
+            if out is None:
+                out = np.empty(K.shape + (offsets[-1],),
+                               dtype=np.result_type(K, G))
+            elif owned and not np.can_cast(G.dtype, out.dtype):
+                out = out.astype(np.result_type(out, G))
+            out[:, :, slab] = G
+        Ks.append(K)
+    return out, Ks, slabs
+
+
+def _writes_gradient_into(kernel):
+    """Whether kernel is a Tensor or DirectSum, possibly projected."""
+    while isinstance(kernel, Projection):
+        kernel = kernel.kernel
+    return isinstance(kernel, (Tensor, DirectSum))
+
+
+def _products_of_others(Ks):
+    """Returns, for each array in Ks, the product of all the others,
+    from products of the arrays before and after it (no division)."""
+    suffix = [None] * len(Ks)
+    P = np.ones_like(Ks[0])
+    for i in range(len(Ks) - 1, -1, -1):
+        suffix[i] = P
+        P = P * Ks[i]
+    others = []
+    prefix = np.ones_like(Ks[0])
+    for i in range(len(Ks)):
+        others.append(prefix * suffix[i])
+        prefix = prefix * Ks[i]
+    return others
+
+
 class Tensor(CompoundKernel):
     def __init__(self, kernels):
         """Extends the product to a list of kernels.
@@ -584,17 +1063,49 @@ class Tensor(CompoundKernel):
         """Computes the product of a list of kernels (and their gradients)."""
         
         if eval_gradient:
-            def _k_g_mul_(kg0, kg1):
-                k0, g0 = kg0
-                k1, g1 = kg1
-                return k0 * k1,\
-                    np.dstack((g0 * k1[:, :, np.newaxis],
-                               g1 * k0[:, :, np.newaxis]))
-            return reduce(_k_g_mul_,
-                          (k(X, Y, eval_gradient=True) for k in self.kernels))            
+            if Y is not None:
+                raise ValueError("Gradient can only be evaluated when Y is None.")
+            return self._gradient_into(X)
         else:
             return reduce(lambda k0, k1 : k0 * k1,
                           (k(X, Y, eval_gradient=False) for k in self.kernels))
+
+    def _gradient_into(self, X, out=None):
+        """Returns k(X, X) and its gradient, written into out if given.
+
+        Each factor's gradient is written into its slab of the final
+        (n, n, n_dims) array, which is allocated once, then scaled in
+        place by the product of all the other factors."""
+        K_gradient, Ks, slabs = _assemble_gradients(self.kernels, X, out)
+        suffix = [None] * len(Ks)
+        P = np.ones_like(Ks[0])
+        for i in range(len(Ks) - 1, -1, -1):
+            suffix[i] = P
+            P = P * Ks[i]
+        prefix = np.ones_like(Ks[0])
+        for i, slab in enumerate(slabs):
+            if slab.start < slab.stop:
+                K_gradient[:, :, slab] *= (prefix * suffix[i])[:, :, np.newaxis]
+            prefix = prefix * Ks[i]
+        return P, K_gradient
+
+    def contract_gradient(self, X, W, Y=None):
+        """Product rule, accumulated one factor at a time in (n, n) arrays."""
+        others = _products_of_others([k(X, Y) for k in self.kernels])
+        return np.hstack([k.contract_gradient(X, W * P, Y)
+                          for k, P in zip(self.kernels, others)])
+
+    def contract_diag_gradient(self, X, w):
+        """Product rule on the diagonals."""
+        others = _products_of_others([k.diag(X) for k in self.kernels])
+        return np.hstack([k.contract_diag_gradient(X, w * p)
+                          for k, p in zip(self.kernels, others)])
+
+    def contract_input_gradient(self, X, Y, W):
+        """Product rule, summed over the factors."""
+        others = _products_of_others([k(X, Y) for k in self.kernels])
+        return sum(k.contract_input_gradient(X, Y, W * P)
+                   for k, P in zip(self.kernels, others))
             
     def diag(self, X):
         return reduce(lambda d0, d1 : d0 * d1, (k.diag(X) for k in self.kernels))
@@ -614,16 +1125,31 @@ class DirectSum(CompoundKernel):
         """Computes the sum of a list of kernels (and their gradients)."""
         
         if eval_gradient:
-            def _k_g_add_(kg0, kg1):
-                k0, g0 = kg0
-                k1, g1 = kg1
-                return k0 + k1, np.dstack((g0, g1))
-            return reduce(_k_g_add_,
-                          (k(X, Y, eval_gradient=True) for k in self.kernels))            
+            if Y is not None:
+                raise ValueError("Gradient can only be evaluated when Y is None.")
+            return self._gradient_into(X)
         else:
             return reduce(lambda k0, k1 : k0 + k1,
                           (k(X, Y, eval_gradient=False) for k in self.kernels))
 
+    def _gradient_into(self, X, out=None):
+        """Returns k(X, X) and its gradient, written into out if given."""
+        K_gradient, Ks, slabs = _assemble_gradients(self.kernels, X, out)
+        return reduce(lambda k0, k1 : k0 + k1, Ks), K_gradient
+
+    def contract_gradient(self, X, W, Y=None):
+        """The contracted gradients of the summands, concatenated."""
+        return np.hstack([k.contract_gradient(X, W, Y) for k in self.kernels])
+
+    def contract_diag_gradient(self, X, w):
+        """The contracted gradients of the summands, concatenated."""
+        return np.hstack([k.contract_diag_gradient(X, w)
+                          for k in self.kernels])
+
+    def contract_input_gradient(self, X, Y, W):
+        """The sum of those of the summands."""
+        return sum(k.contract_input_gradient(X, Y, W) for k in self.kernels)
+
     def diag(self, X):
         return reduce(lambda d0, d1 : d0 + d1, (k.diag(X) for k in self.kernels))
 
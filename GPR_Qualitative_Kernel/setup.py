@@ -1,18 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
 
 import numpy
 
+ext_modules = [
+    Extension(
+        "hypersphere_cython",
+        ["hypersphere_cython.pyx"],
+        include_dirs=[numpy.get_include()],
+    ),
+    # the OpenMP derivative rows used by hypersphere.py when importable
+    Extension(
+        "hypersphere_parallel",
+        [os.path.join("..", "hypersphere", "hypersphere_parallel.pyx")],
+        include_dirs=[numpy.get_include()],
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp'],
+    ),
+]
+
 setup(
-    ext_modules = cythonize("hypersphere_cython.pyx"),
-                   include_dirs=[numpy.get_include()]
+    ext_modules = cythonize(ext_modules),
 )
 
 # =============================================================================
 # To understand the setup.py more fully look at the official distutils
-# documentation. To compile the extension for use in the current directory use:
-# 
+# documentation. To compile the extensions for use in the current directory
+# use:
+#
 # $ python setup.py build_ext --inplace
 # =============================================================================
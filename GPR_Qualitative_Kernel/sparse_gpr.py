@@ -0,0 +1,597 @@
+# -*- coding: utf-8 -*-
+"""Sparse Pseudo-input Gaussian process regression (SPGP / FITC).
+
+Snelson and Ghahramani, Sparse Gaussian Processes using Pseudo-inputs,
+NIPS 2006.  <http://www.gatsby.ucl.ac.uk/~snelson/SPGP_up.pdf>
+
+The N*N kernel matrix used by GaussianProcessRegressor is replaced by a
+rank-M approximation through M inducing (pseudo-) inputs plus an exact
+diagonal, so fitting and prediction cost O(N*M^2) instead of O(N^3).
+"""
+from __future__ import print_function
+
+import warnings
+from operator import itemgetter
+
+import numpy as np
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from scipy.optimize import fmin_l_bfgs_b
+
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from kernels import RBF, ConstantKernel as C, ThetaLayout, \
+    TrainingDataCache
+from chunked import ChunkedPredictionMixin
+from persistence import PersistenceMixin
+from sklearn.utils import check_random_state
+from sklearn.utils.validation import check_X_y, check_array
+
+
+class SparseGaussianProcessRegressor(ChunkedPredictionMixin,
+                                     PersistenceMixin,
+                                     BaseEstimator, RegressorMixin):
+    """Sparse pseudo-input Gaussian process regression (SPGP/FITC).
+
+    The covariance of the training data is approximated by
+    Q + diag(K - Q) + alpha * I, where Q = K_nm K_mm^-1 K_mn is the Nystrom
+    approximation through the inducing inputs Z.  The kernel
+    hyperparameters and the inducing inputs are chosen together by
+    maximizing the log-marginal likelihood.
+
+    Any kernel usable with GaussianProcessRegressor can be used, including
+    Tensor products of Projection and qualitative kernels.  The columns
+    listed in simplex_columns (typically the dummy-coded columns of each
+    factor) are parameterized by a softmax, so the inducing inputs always
+    stay on the simplex spanned by the one-hot codes.
+
+    The gradients with respect to the kernel hyperparameters and the
+    inducing inputs contract the derivatives of K_nm, K_mm and diag(K_nn)
+    with (N, M), (M, M) and (N,) weights (contract_gradient,
+    contract_diag_gradient and contract_input_gradient of the kernel), so
+    no N*N matrix and no (N, M, p) gradient is formed.
+
+    Parameters
+    ----------
+    kernel : kernel object
+        The kernel specifying the covariance function of the GP. If None is
+        passed, the kernel "1.0 * RBF(1.0)" is used as default.
+
+    n_inducing : int, optional (default: 100)
+        The number M of inducing inputs.  They are initialized from a random
+        subset of the training data.
+
+    alpha : float, optional (default: 1e-2)
+        Noise variance added to the diagonal of the approximate covariance.
+        Unlike in GaussianProcessRegressor this should not be negligible,
+        since the diagonal correction diag(K - Q) vanishes at the inducing
+        inputs.
+
+    optimizer : string or callable, optional (default: "fmin_l_bfgs_b")
+        As for GaussianProcessRegressor.  If None, the kernel's parameters
+        and the initial inducing inputs are kept fixed.
+
+    n_restarts_optimizer : int, optional (default: 0)
+        The number of restarts of the optimizer from thetas sampled uniformly
+        from the bounds; the inducing inputs always start from their initial
+        values.
+
+    normalize_y : boolean, optional (default: False)
+        Whether the target values y are normalized to have mean zero.
+
+    simplex_columns : list of lists of int, optional (default: None)
+        Groups of columns whose inducing input values are kept on the
+        simplex, e.g. the dummy-coded columns of each categorical factor.
+
+    optimize_inducing : boolean, optional (default: False)
+        If True, the inducing inputs are optimized together with the kernel
+        hyperparameters, which adds n_inducing * n_features parameters.
+        Otherwise they keep their initial values.
+
+    jitter : float, optional (default: 1e-8)
+        Value added to the diagonal of K_mm for numerical stability.
+
+    max_iter : int, optional (default: 200)
+        Maximum number of iterations of each run of fmin_l_bfgs_b.
+
+    random_state : integer or numpy.RandomState, optional
+        The generator used to select the initial inducing inputs and the
+        restarts of the optimizer.
+
+    Attributes
+    ----------
+    X_train_ : array-like, shape = (n_samples, n_features)
+        Feature values in training data
+
+    y_train_ : array-like, shape = (n_samples, [n_output_dims])
+        Target values in training data
+
+    kernel_ : kernel object
+        The kernel used for prediction, with optimized hyperparameters
+
+    inducing_points_ : array, shape = (n_inducing, n_features)
+        The inducing inputs Z
+
+    log_marginal_likelihood_value_ : float
+        The (approximate) log-marginal-likelihood of ``self.kernel_.theta``
+        and ``self.inducing_points_``
+    """
+    # written to .npy files by save(), see persistence
+    _saved_arrays = ("X_train_", "y_train_", "inducing_points_", "L_m_",
+                     "L_a_", "w_mean_")
+    _saved_private = ("_n_added", "_lml_per_sample", "_simplex_blocks",
+                      "_free_columns")
+
+    def __init__(self, kernel=None, n_inducing=100, alpha=1e-2,
+                 optimizer="fmin_l_bfgs_b", n_restarts_optimizer=0,
+                 normalize_y=False, simplex_columns=None,
+                 optimize_inducing=False, jitter=1e-8, max_iter=200,
+                 random_state=None):
+        self.kernel = kernel
+        self.n_inducing = n_inducing
+        self.alpha = alpha
+        self.optimizer = optimizer
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.normalize_y = normalize_y
+        self.simplex_columns = simplex_columns
+        self.optimize_inducing = optimize_inducing
+        self.jitter = jitter
+        self.max_iter = max_iter
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Fit the sparse Gaussian process regression model
+
+        Parameters
+        ----------
+        X : array-like, shape = (n_samples, n_features)
+            Training data
+
+        y : array-like, shape = (n_samples, [n_output_dims])
+            Target values
+
+        Returns
+        -------
+        self : returns an instance of self.
+        """
+        if self.kernel is None:  # Use an RBF kernel as default
+            self.kernel_ = C(1.0, constant_value_bounds="fixed") \
+                * RBF(1.0, length_scale_bounds="fixed")
+        else:
+            self.kernel_ = clone(self.kernel)
+
+        self.rng = check_random_state(self.random_state)
+
+        X, y = check_X_y(X, y, multi_output=True, y_numeric=True)
+
+        # Normalize target value
+        if self.normalize_y:
+            self.y_train_mean = np.mean(y, axis=0)
+            y = y - self.y_train_mean
+        else:
+            self.y_train_mean = np.zeros(1)
+
+        self.X_train_ = np.copy(X)
+        self.y_train_ = np.copy(y)
+        # e.g. the level codes of the factors, computed once per fit
+        self._training_data_cache = TrainingDataCache(self.X_train_)
+
+        # initial inducing inputs: a random subset of the training data,
+        # moved off the vertices into the interior of each simplex
+        n_inducing = min(self.n_inducing, X.shape[0])
+        index = self.rng.choice(X.shape[0], n_inducing, replace=False)
+        Z = np.array(X[index], dtype=np.float64)
+        blocks = [list(columns) for columns in (self.simplex_columns or [])]
+        for columns in blocks:
+            Z[:, columns] = 0.9 * Z[:, columns] + 0.1 / len(columns)
+        self._simplex_blocks = blocks
+        simplex = set(c for columns in blocks for c in columns)
+        self._free_columns = [c for c in range(X.shape[1])
+                              if c not in simplex]
+
+        n_theta = self.kernel_.n_dims
+        if self.optimizer is not None and \
+                (n_theta > 0 or self.optimize_inducing):
+            # the optimizer works on theta followed by the packed inducing
+            # inputs (if they are optimized)
+            if self.optimize_inducing:
+                z_packed = self._pack_inducing(Z)
+            else:
+                z_packed = np.empty(0)
+            z_bounds = np.tile([[-np.inf, np.inf]], (len(z_packed), 1))
+            theta_bounds = np.reshape(self.kernel_.bounds, (-1, 2))
+            bounds = np.vstack((theta_bounds, z_bounds))
+
+            def obj_func(params, eval_gradient=True):
+                theta = params[:n_theta]
+                if self.optimize_inducing:
+                    Z_ = self._unpack_inducing(params[n_theta:], Z)
+                else:
+                    Z_ = Z
+                kernel = self._kernel_with_theta(theta)
+                if eval_gradient:
+                    lml, grad_theta, grad_Z = self._fitc_gradient(
+                        kernel, Z_, self.optimize_inducing)
+                    if self.optimize_inducing:
+                        grad_z = self._pack_gradient(grad_Z, Z_)
+                        grad = np.hstack((grad_theta, grad_z))
+                    else:
+                        grad = grad_theta
+                    return -lml, -grad
+                else:
+                    return -self._fitc(kernel, Z_)[0]
+
+            initial = [np.hstack((self.kernel_.theta, z_packed))]
+            if self.n_restarts_optimizer > 0:
+                if not np.isfinite(theta_bounds).all():
+                    raise ValueError(
+                        "Multiple optimizer restarts (n_restarts_optimizer>0) "
+                        "requires that all bounds are finite.")
+                for iteration in range(self.n_restarts_optimizer):
+                    theta_initial = self.rng.uniform(theta_bounds[:, 0],
+                                                     theta_bounds[:, 1])
+                    initial.append(np.hstack((theta_initial, z_packed)))
+            optima = [self._constrained_optimization(obj_func,
+                                                     params_initial,
+                                                     bounds)
+                      for params_initial in initial]
+
+            lml_values = list(map(itemgetter(1), optima))
+            params_opt = optima[np.argmin(lml_values)][0]
+            self.kernel_.theta = params_opt[:n_theta]
+            if self.optimize_inducing:
+                Z = self._unpack_inducing(params_opt[n_theta:], Z)
+
+        self.inducing_points_ = Z
+        self._precompute()
+
+        # reference point for add_observations
+        self._n_added = 0
+        self._lml_per_sample = \
+            self.log_marginal_likelihood_value_ / self.X_train_.shape[0]
+
+        return self
+
+    def add_observations(self, X, y, refit_interval=None,
+                         lml_tolerance=None):
+        """Add training data without refitting the hyperparameters
+
+        The kernel hyperparameters and inducing inputs are kept fixed and
+        only the O(N*M^2) posterior is recomputed, unless refit_interval or
+        lml_tolerance trigger a full fit (see
+        GaussianProcessRegressor.add_observations).
+
+        Parameters
+        ----------
+        X : array-like, shape = (n_new_samples, n_features)
+            New training data
+
+        y : array-like, shape = (n_new_samples, [n_output_dims])
+            New target values
+
+        refit_interval : int, optional (default: None)
+            Refit once this many observations have been added since the last
+            call to fit.
+
+        lml_tolerance : float, optional (default: None)
+            Refit when the log-marginal likelihood per sample differs from its
+            value after the last fit by more than this.
+
+        Returns
+        -------
+        self : returns an instance of self.
+        """
+        if not hasattr(self, "X_train_"):
+            return self.fit(X, y)
+
+        X, y = check_X_y(X, y, multi_output=True, y_numeric=True)
+        y_all = np.concatenate((self.y_train_ + self.y_train_mean, y))
+        X_all = np.vstack((self.X_train_, X))
+        self._n_added += X.shape[0]
+
+        if refit_interval is not None and self._n_added >= refit_interval:
+            return self.fit(X_all, y_all)
+
+        if self.normalize_y:
+            self.y_train_mean = np.mean(y_all, axis=0)
+        self.X_train_ = X_all
+        self._training_data_cache = TrainingDataCache(self.X_train_)
+        self.y_train_ = y_all - self.y_train_mean
+        self._precompute()
+
+        if lml_tolerance is not None:
+            drift = abs(self.log_marginal_likelihood_value_ / X_all.shape[0]
+                        - self._lml_per_sample)
+            if drift > lml_tolerance:
+                return self.fit(X_all, y_all)
+
+        return self
+
+    def predict(self, X, return_std=False, return_cov=False):
+        """Predict using the sparse Gaussian process regression model
+
+        Parameters
+        ----------
+        X : array-like, shape = (n_samples, n_features)
+            Query points where the GP is evaluated
+
+        return_std : bool, default: False
+            If True, the standard-deviation of the predictive distribution at
+            the query points is returned along with the mean.
+
+        return_cov : bool, default: False
+            If True, the covariance of the joint predictive distribution at
+            the query points is returned along with the mean
+
+        Returns
+        -------
+        y_mean : array, shape = (n_samples, [n_output_dims])
+            Mean of predictive distribution a query points
+
+        y_std : array, shape = (n_samples,), optional
+            Standard deviation of predictive distribution at query points.
+            Only returned when return_std is True.
+
+        y_cov : array, shape = (n_samples, n_samples), optional
+            Covariance of joint predictive distribution a query points.
+            Only returned when return_cov is True.
+        """
+        if return_std and return_cov:
+            raise RuntimeError(
+                "Not returning standard deviation of predictions when "
+                "returning full covariance.")
+
+        X = check_array(X)
+
+        if not hasattr(self, "X_train_"):  # Unfitted;predict based on GP prior
+            kernel = self.kernel
+            if kernel is None:
+                kernel = C(1.0, constant_value_bounds="fixed") \
+                    * RBF(1.0, length_scale_bounds="fixed")
+            y_mean = np.zeros(X.shape[0])
+            if return_cov:
+                return y_mean, kernel(X)
+            elif return_std:
+                return y_mean, np.sqrt(kernel.diag(X))
+            else:
+                return y_mean
+
+        K_trans = self.kernel_(X, self.inducing_points_)
+        y_mean = K_trans.dot(self.w_mean_)
+        y_mean = self.y_train_mean + y_mean  # undo normal.
+        if not (return_std or return_cov):
+            return y_mean
+
+        # K_** - Q_** + K_*m B^-1 K_m*, with B = L_m A L_m^T
+        V = solve_triangular(self.L_m_, K_trans.T, lower=True,
+                             check_finite=False)
+        W = solve_triangular(self.L_a_, V, lower=True, check_finite=False)
+        if return_cov:
+            y_cov = self.kernel_(X) - V.T.dot(V) + W.T.dot(W)
+            return y_mean, y_cov
+
+        y_var = self.kernel_.diag(X)
+        y_var -= np.einsum("ij,ij->j", V, V)
+        y_var += np.einsum("ij,ij->j", W, W)
+        y_var_negative = y_var < 0
+        if np.any(y_var_negative):
+            warnings.warn("Predicted variances smaller than 0. "
+                          "Setting those variances to 0.")
+            y_var[y_var_negative] = 0.0
+        return y_mean, np.sqrt(y_var)
+
+    def log_marginal_likelihood(self, theta=None, eval_gradient=False):
+        """Returns the approximate log-marginal likelihood of theta.
+
+        The inducing inputs are held at ``self.inducing_points_``.
+
+        Parameters
+        ----------
+        theta : array-like, shape = (n_kernel_params,) or None
+            Kernel hyperparameters for which the log-marginal likelihood is
+            evaluated. If None, the precomputed log_marginal_likelihood
+            of ``self.kernel_.theta`` is returned.
+
+        eval_gradient : bool, default: False
+            If True, the gradient with respect to the kernel hyperparameters
+            at position theta is returned additionally.
+
+        Returns
+        -------
+        log_likelihood : float
+            Log-marginal likelihood of theta for training data.
+
+        log_likelihood_gradient : array, shape = (n_kernel_params,), optional
+            Gradient of the log-marginal likelihood with respect to the kernel
+            hyperparameters at position theta.
+        """
+        if theta is None:
+            if eval_gradient:
+                raise ValueError(
+                    "Gradient can only be evaluated for theta!=None")
+            return self.log_marginal_likelihood_value_
+
+        kernel = self._kernel_with_theta(theta)
+        if eval_gradient:
+            lml, grad, _ = self._fitc_gradient(kernel, self.inducing_points_,
+                                               False)
+            return lml, grad
+        else:
+            return self._fitc(kernel, self.inducing_points_)[0]
+
+    def _restore(self):
+        """Rebuilds the cache of the training data of a loaded model."""
+        self._training_data_cache = TrainingDataCache(self.X_train_)
+
+    def _kernel_with_theta(self, theta):
+        """Returns a private copy of kernel_ with hyperparameters theta.
+
+        Cloned once per kernel_ and then updated in place through a
+        ThetaLayout; overwritten by the next call.
+        """
+        layout = getattr(self, "_theta_layout", None)
+        if layout is None or layout[0] is not self.kernel_:
+            layout = (self.kernel_, ThetaLayout(clone(self.kernel_)))
+            self._theta_layout = layout
+        return layout[1].set_theta(theta)
+
+    def _precompute(self):
+        """Quantities required for predictions, at the fitted parameters."""
+        lml, L_m, L_a, V, Lam, b = self._fitc(self.kernel_,
+                                               self.inducing_points_)
+        if not np.isfinite(lml):
+            raise np.linalg.LinAlgError(
+                "Inducing kernel matrix is not positive definite")
+        self.log_marginal_likelihood_value_ = lml
+        self.L_m_ = L_m
+        self.L_a_ = L_a
+        # y_mean = K_*m B^-1 K_mn Lam^-1 y = K_*m w_mean_
+        w_mean = solve_triangular(L_a, b, trans='T', lower=True)
+        w_mean = solve_triangular(L_m, w_mean, trans='T', lower=True)
+        if self.y_train_.ndim == 1:
+            w_mean = w_mean[:, 0]
+        self.w_mean_ = w_mean
+
+    def _fitc(self, kernel, Z):
+        """FITC log-marginal likelihood and the factors it is built from.
+
+        With L_m L_m^T = K_mm, V = L_m^-1 K_mn, Lam the diagonal of
+        K_nn - V^T V + alpha and L_a L_a^T = A = I + V Lam^-1 V^T,
+        the covariance V^T V + Lam has log-determinant
+        sum(log Lam) + 2 sum(log diag L_a), and its inverse applied to y is
+        Lam^-1 y - Lam^-1 V^T A^-1 V Lam^-1 y.
+        """
+        y_train = self.y_train_
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+        X = self.X_train_
+
+        K_mm = kernel(Z)
+        K_mm[np.diag_indices_from(K_mm)] += self.jitter
+        try:
+            L_m = cholesky(K_mm, lower=True)
+        except np.linalg.LinAlgError:
+            return (-np.inf,) + (None,) * 5
+        V = solve_triangular(L_m, kernel(X, Z).T, lower=True,
+                             check_finite=False)
+        # diag(K_nn - Q_nn) is nonnegative up to rounding
+        Lam = np.maximum(kernel.diag(X) - np.einsum("ij,ij->j", V, V), 0.0)
+        Lam += self.alpha
+        A = V.dot((V / Lam).T)
+        A[np.diag_indices_from(A)] += 1.0
+        try:
+            L_a = cholesky(A, lower=True)
+        except np.linalg.LinAlgError:
+            return (-np.inf,) + (None,) * 5
+        b = solve_triangular(L_a, (V / Lam).dot(y_train), lower=True,
+                             check_finite=False)
+
+        log_likelihood_dims = \
+            -0.5 * np.einsum("ik,ik->k", y_train, y_train / Lam[:, np.newaxis])
+        log_likelihood_dims += 0.5 * np.einsum("ik,ik->k", b, b)
+        log_likelihood_dims -= 0.5 * np.log(Lam).sum()
+        log_likelihood_dims -= np.log(np.diag(L_a)).sum()
+        log_likelihood_dims -= X.shape[0] / 2.0 * np.log(2 * np.pi)
+        log_likelihood = log_likelihood_dims.sum(-1)
+
+        return log_likelihood, L_m, L_a, V, Lam, b
+
+    def _fitc_gradient(self, kernel, Z, eval_inducing=True):
+        """FITC log-marginal likelihood with its gradient.
+
+        Returns the log-marginal likelihood, its gradient with respect to
+        the kernel's theta and (if eval_inducing) with respect to Z.
+
+        The likelihood depends on the kernel only through K_nm, K_mm and
+        diag(K_nn); with R = beta beta^T - Sigma^-1, R' = R - diag(R) and
+        U = K_mm^-1 K_mn its derivatives are
+            dL/dK_nm = R' U^T
+            dL/dK_mm = -1/2 U R' U^T
+            dL/dK_nn_ii = 1/2 R_ii
+        which are assembled in O(N*M^2) without forming any N*N matrix.
+        """
+        lml, L_m, L_a, V, Lam, b = self._fitc(kernel, Z)
+        theta = kernel.theta
+        if not np.isfinite(lml):
+            return -np.inf, np.zeros_like(theta), np.zeros_like(Z)
+
+        y_train = self.y_train_
+        if y_train.ndim == 1:
+            y_train = y_train[:, np.newaxis]
+        n_outputs = y_train.shape[1]
+        X = self.X_train_
+
+        VL = V / Lam                                          # V Lam^-1
+        # beta = Sigma^-1 y
+        beta = y_train / Lam[:, np.newaxis] - VL.T.dot(
+            solve_triangular(L_a, b, trans='T', lower=True))
+        U = solve_triangular(L_m, V, trans='T', lower=True)   # K_mm^-1 K_mn
+        # Sigma^-1 U^T
+        SU = U.T / Lam[:, np.newaxis] - VL.T.dot(cho_solve((L_a, True),
+                                                          VL.dot(U.T)))
+        RU = beta.dot(U.dot(beta).T) - n_outputs * SU
+        WL = solve_triangular(L_a, VL, lower=True)
+        r = np.einsum("ik,ik->i", beta, beta) \
+            - n_outputs * (1.0 / Lam - np.einsum("ij,ij->j", WL, WL))
+
+        G_nm = RU - r[:, np.newaxis] * U.T
+        G_mm = -0.5 * (U.dot(RU) - (U * r).dot(U.T))
+        g_nn = 0.5 * r
+
+        grad_theta = kernel.contract_gradient(Z, G_mm) \
+            + kernel.contract_gradient(X, G_nm, Z) \
+            + kernel.contract_diag_gradient(X, g_nn)
+        if not eval_inducing:
+            return lml, grad_theta, None
+
+        # Z enters K_mm on both sides, and k is symmetric
+        grad_Z = kernel.contract_input_gradient(X, Z, G_nm) \
+            + kernel.contract_input_gradient(Z, Z, G_mm + G_mm.T)
+        return lml, grad_theta, grad_Z
+
+    def _pack_inducing(self, Z):
+        """Free columns as is, simplex columns as log-weights of a softmax."""
+        packed = [Z[:, self._free_columns].ravel()]
+        for columns in self._simplex_blocks:
+            packed.append(np.log(Z[:, columns]).ravel())
+        return np.hstack(packed)
+
+    def _unpack_inducing(self, packed, Z):
+        Z = np.array(Z, dtype=np.float64)
+        m = Z.shape[0]
+        start = m * len(self._free_columns)
+        Z[:, self._free_columns] = packed[:start].reshape(m, -1)
+        for columns in self._simplex_blocks:
+            end = start + m * len(columns)
+            w = packed[start:end].reshape(m, -1)
+            w = np.exp(w - w.max(axis=1)[:, np.newaxis])
+            Z[:, columns] = w / w.sum(axis=1)[:, np.newaxis]
+            start = end
+        return Z
+
+    def _pack_gradient(self, grad_Z, Z):
+        """Chain rule through the softmax of each simplex block."""
+        packed = [grad_Z[:, self._free_columns].ravel()]
+        for columns in self._simplex_blocks:
+            s = Z[:, columns]
+            g = grad_Z[:, columns]
+            g = s * (g - np.sum(s * g, axis=1)[:, np.newaxis])
+            packed.append(g.ravel())
+        return np.hstack(packed)
+
+    def _constrained_optimization(self, obj_func, initial_theta, bounds):
+        if self.optimizer == "fmin_l_bfgs_b":
+            bounds = [(None if not np.isfinite(lower) else lower,
+                       None if not np.isfinite(upper) else upper)
+                      for lower, upper in bounds]
+            theta_opt, func_min, convergence_dict = \
+                fmin_l_bfgs_b(obj_func, initial_theta, bounds=bounds,
+                              maxiter=self.max_iter)
+            if convergence_dict["warnflag"] != 0:
+                warnings.warn("fmin_l_bfgs_b terminated abnormally with the "
+                              " state: %s" % convergence_dict)
+        elif callable(self.optimizer):
+            theta_opt, func_min = \
+                self.optimizer(obj_func, initial_theta, bounds=bounds)
+        else:
+            raise ValueError("Unknown optimizer %s." % self.optimizer)
+
+        return theta_opt, func_min
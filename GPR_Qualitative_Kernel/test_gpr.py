@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from gpr import GaussianProcessRegressor, _conjugate_gradient
+from kernels import RBF, ConstantKernel
+import qualitative_kernels as qk
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+from scipy.optimize import fmin_l_bfgs_b
+from sklearn.exceptions import ConvergenceWarning
+
+# =============================================================================
+# GaussianProcessRegressor
+# =============================================================================
+def make_data(n=40, d=2, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n, d)
+    y = np.sin(3 * X.sum(axis=1))
+    return X, y
+
+def make_kernel(d=2):
+    return ConstantKernel(1.0) * RBF([0.5] * d)
+
+def test_lml_cache_custom_optimizer():
+    # an optimizer which evaluates its result once more
+    def optimizer(obj_func, initial_theta, bounds):
+        theta = fmin_l_bfgs_b(obj_func, initial_theta, bounds=bounds)[0]
+        return theta, obj_func(theta)[0]
+    X, y = make_data()
+    gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-6,
+                                   optimizer=optimizer).fit(X, y)
+    assert gpr.lml_cache_hits_ == 0
+    assert len(gpr._lml_cache) == 0
+    cached = GaussianProcessRegressor(make_kernel(), alpha=1e-6,
+                                      optimizer=optimizer,
+                                      lml_cache_size=8).fit(X, y)
+    assert cached.lml_cache_hits_ == 1
+    assert cached.lml_cache_misses_ == gpr.lml_cache_misses_ - 1
+    np.testing.assert_array_equal(cached.kernel_.theta, gpr.kernel_.theta)
+    assert cached.log_marginal_likelihood_value_ == \
+        gpr.log_marginal_likelihood_value_
+
+def test_cg_heteroscedastic_alpha():
+    # a non-constant diagonal of K + alpha, so the CG is preconditioned
+    X, y = make_data(n=200)
+    alpha = np.random.RandomState(1).uniform(0.01, 2.0, len(y))
+    kernel = ConstantKernel(3.0) * RBF([0.3, 0.8])
+    exact = GaussianProcessRegressor(kernel, alpha=alpha,
+                                     optimizer=None).fit(X, y)
+    cg = GaussianProcessRegressor(kernel, alpha=alpha, optimizer=None,
+                                  solver="cg", n_probes=512,
+                                  random_state=0).fit(X, y)
+    theta = exact.kernel_.theta
+    lml, grad = exact.log_marginal_likelihood(theta, eval_gradient=True)
+    lml_cg, grad_cg = cg.log_marginal_likelihood(theta, eval_gradient=True)
+    assert abs(lml_cg - lml) < 0.01 * abs(lml)
+    assert np.max(np.abs(grad_cg - grad)) < 0.1 * np.max(np.abs(grad))
+    np.testing.assert_allclose(cg.predict(X[:5]), exact.predict(X[:5]),
+                               rtol=1e-4)
+
+def test_cg_iterations():
+    X, y = make_data(n=50)
+    gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-2, optimizer=None,
+                                   solver="cg", random_state=0).fit(X, y)
+    assert 0 < gpr.cg_n_iter_ <= 50
+    # 20 distinct eigenvalues are not resolved in a few iterations
+    A = np.diag(np.logspace(0, 2, 20))
+    B = np.ones((20, 2))
+    with pytest.warns(ConvergenceWarning):
+        S, coefficients, n_iter = _conjugate_gradient(A, B, 1e-10, 3)
+    assert n_iter == 3
+    assert [len(a) for a, b in coefficients] == [3, 3]
+    S, coefficients, n_iter = _conjugate_gradient(A, B, 1e-10, 60)
+    assert 3 < n_iter < 60
+    np.testing.assert_allclose(A.dot(S), B, rtol=1e-8)
+
+def test_save_over_other_solver():
+    X, y = make_data()
+    path = tempfile.mkdtemp()
+    try:
+        gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-2,
+                                       optimizer=None)
+        gpr.fit(X, y).save(path)
+        # a cg fit has no L_, and must not pick up the one saved before
+        gpr.set_params(solver="cg").fit(X, y).save(path)
+        assert not os.path.exists(os.path.join(path, "L_.npy"))
+        loaded = GaussianProcessRegressor.load(path)
+        assert loaded.L_ is None
+        np.testing.assert_array_equal(
+            loaded.predict(X[:5], return_std=True)[1],
+            gpr.predict(X[:5], return_std=True)[1])
+        # and the Cholesky fit after it no cg buffers
+        gpr.set_params(solver="cholesky").fit(X, y).save(path)
+        assert gpr._K is None and gpr._probes is None
+        assert not os.path.exists(os.path.join(path, "_K.npy"))
+    finally:
+        shutil.rmtree(path)
+
+def test_parallel_restarts():
+    X, y = make_data()
+    for solver in ("cholesky", "cg"):
+        theta = {}
+        for n_jobs in (1, 2):
+            gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-2,
+                                           n_restarts_optimizer=2,
+                                           random_state=0, solver=solver,
+                                           n_jobs=n_jobs).fit(X, y)
+            theta[n_jobs] = gpr.kernel_.theta
+        np.testing.assert_array_equal(theta[1], theta[2])
+
+def test_add_observations():
+    X, y = make_data(n=50)
+    alpha = np.random.RandomState(1).uniform(0.01, 0.1, len(y))
+    gpr = GaussianProcessRegressor(make_kernel(), alpha=alpha[:30],
+                                   normalize_y=True).fit(X[:30], y[:30])
+    gpr.add_observations(X[30:40], y[30:40], alpha=alpha[30:40])
+    gpr.add_observations(X[40:], y[40:], alpha=alpha[40:])
+    # the parameter is untouched, the extended noise is fitted state
+    assert gpr.get_params()["alpha"] is not gpr.alpha_train_
+    assert len(gpr.get_params()["alpha"]) == 30
+    np.testing.assert_array_equal(gpr.alpha_train_, alpha)
+    # the same as a fit at the hyperparameters kept fixed
+    fresh = GaussianProcessRegressor(gpr.kernel_, alpha=alpha,
+                                     normalize_y=True,
+                                     optimizer=None).fit(X, y)
+    np.testing.assert_allclose(gpr.L_, fresh.L_, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(gpr.alpha_, fresh.alpha_, rtol=1e-8)
+    np.testing.assert_allclose(gpr.log_marginal_likelihood_value_,
+                               fresh.log_marginal_likelihood_value_)
+    X_test = make_data(n=10, seed=2)[0]
+    for a, b in zip(gpr.predict(X_test, return_std=True),
+                    fresh.predict(X_test, return_std=True)):
+        np.testing.assert_allclose(a, b, rtol=1e-8, atol=1e-10)
+
+def test_kronecker_matches_dense():
+    # a full factorial design of a continuous parameter and a factor, in
+    # shuffled order
+    x = np.array([0.0, 0.3, 0.5, 1.0])
+    codes = np.arange(3)
+    X = np.array([[xi] + list(np.eye(3)[c]) for xi in x for c in codes])
+    X = X[np.random.RandomState(0).permutation(len(X))]
+    y = np.sin(3 * X[:, 0]) + X[:, 1:].dot([0.0, 1.0, 2.5])
+    kernel = ConstantKernel(2.0) * qk.Tensor(
+        [qk.Projection([0], "x", RBF(0.5)),
+         qk.Projection([1, 2, 3], "f",
+                       qk.UnrestrictiveCorrelation(3, [1.0, 1.2, 0.8]))])
+    dense = GaussianProcessRegressor(kernel, alpha=1e-2, normalize_y=True,
+                                     optimizer=None).fit(X, y)
+    kron = GaussianProcessRegressor(kernel, alpha=1e-2, normalize_y=True,
+                                    optimizer=None, kronecker=True).fit(X, y)
+    assert kron.kronecker_ is not None and kron.L_ is None
+    theta = dense.kernel_.theta + 0.1
+    lml, grad = dense.log_marginal_likelihood(theta, eval_gradient=True)
+    lml_kron, grad_kron = kron.log_marginal_likelihood(theta,
+                                                       eval_gradient=True)
+    np.testing.assert_allclose(lml_kron, lml, rtol=1e-10)
+    np.testing.assert_allclose(grad_kron, grad, rtol=1e-8, atol=1e-10)
+    X_test = np.hstack((np.linspace(0, 1, 5)[:, None],
+                        np.eye(3)[[0, 1, 2, 1, 0]]))
+    for a, b in zip(kron.predict(X_test, return_std=True),
+                    dense.predict(X_test, return_std=True)):
+        np.testing.assert_allclose(a, b, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(kron.predict(X_test, return_cov=True)[1],
+                               dense.predict(X_test, return_cov=True)[1],
+                               rtol=1e-8, atol=1e-10)
+
+def test_log_marginal_likelihood_batch():
+    X, y = make_data(n=20)
+    # a negative alpha makes K + alpha * I indefinite at long length scales
+    gpr = GaussianProcessRegressor(ConstantKernel(1.0) * RBF([0.1, 0.1]),
+                                   alpha=-1e-3, optimizer=None).fit(X, y)
+    thetas = np.array([[0.0, np.log(0.1), np.log(0.1)],
+                       [0.5, np.log(0.12), np.log(0.08)],
+                       [-0.3, np.log(0.15), np.log(0.05)],
+                       [0.0, np.log(100.0), np.log(100.0)]])
+    for batch_size in (None, 3):
+        lml, grad = gpr.log_marginal_likelihood_batch(
+            thetas, eval_gradient=True, batch_size=batch_size)
+        # against a fresh cache
+        gpr._reset_lml_cache()
+        for i, theta in enumerate(thetas):
+            lml_i, grad_i = gpr.log_marginal_likelihood(theta,
+                                                        eval_gradient=True)
+            np.testing.assert_allclose(lml[i], lml_i, rtol=1e-10)
+            np.testing.assert_allclose(grad[i], grad_i, rtol=1e-8,
+                                       atol=1e-10)
+            np.testing.assert_allclose(
+                gpr.log_marginal_likelihood_batch(theta)[0], lml_i,
+                rtol=1e-10)
+        assert lml[-1] == -np.inf
+        assert np.all(np.isfinite(lml[:-1]))
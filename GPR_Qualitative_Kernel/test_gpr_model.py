@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from gpr import GaussianProcessRegressor
+from gpr_model import GPR_Model
+
+import numpy as np
+import pandas as pd
+
+# =============================================================================
+# GPR_Model.fit: parallel restarts give the same fit as serial ones
+# =============================================================================
+def make_model(n=40, seed=0):
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({"a": rng.rand(n),
+                       "f": rng.choice(["x", "y", "z"], n)})
+    df["loss"] = df.a**2 + (df.f == "x")
+    return GPR_Model(df, ["a", "f"], "loss", factors=["f"])
+
+def test_fit_n_jobs():
+    theta = {}
+    for n_jobs in (1, 2):
+        model = make_model()
+        model.fit(n_restarts_optimizer=2, n_jobs=n_jobs, random_state=7)
+        assert model.gpr_.n_jobs == n_jobs
+        theta[n_jobs] = model.gpr_.kernel_.theta
+    np.testing.assert_array_equal(theta[1], theta[2])
+
+def test_add_observations():
+    data = make_model(n=50).data
+    model = GPR_Model(data[:35], ["a", "f"], "loss", factors=["f"])
+    model.fit(n_restarts_optimizer=0)
+    model.add_observations(data[35:].reset_index(drop=True))
+    assert len(model.Xd) == 50
+    # the same as a fit on all the data at the hyperparameters kept fixed
+    params = model.gpr_.get_params(deep=False)
+    params.update(kernel=model.gpr_.kernel_, optimizer=None)
+    fresh = GaussianProcessRegressor(**params).fit(model.Xd, model.y)
+    np.testing.assert_allclose(model.predict().values[:, 0],
+                               fresh.predict(model.Xd), rtol=1e-8)
+
+def test_predict_array():
+    model = make_model()
+    model.fit(n_restarts_optimizer=0)
+    Xd = model.Xd.iloc[[3, 1, 4]]
+    mean, std = model.predict(Xd, return_std=True)
+    assert list(mean.index) == [3, 1, 4]
+    mean_array, std_array = model.predict(Xd.values, return_std=True)
+    assert list(mean_array.index) == [0, 1, 2]
+    np.testing.assert_array_equal(mean_array.values, mean.values)
+    np.testing.assert_array_equal(std_array.values, std.values)
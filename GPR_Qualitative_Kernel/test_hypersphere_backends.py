@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import hypersphere_numpy
+import hypersphere_pure
+
+# =============================================================================
+# hypersphere_parallel: the same derivative rows as one hypersphere_cython
+# call per parameter, on the serial and on the prange path
+# =============================================================================
+def test_parallel_derivative_rows():
+    hs = pytest.importorskip("hypersphere_cython")
+    hsp = pytest.importorskip("hypersphere_parallel")
+    rng = np.random.RandomState(0)
+    for dim in (2, 7, 50):
+        zeta = np.zeros((dim, dim))
+        param_rows, param_cols = np.tril_indices(dim, -1)
+        zeta[param_rows, param_cols] = rng.uniform(0, np.pi, len(param_rows))
+        C, S = np.cos(zeta), np.sin(zeta)
+        expected = np.zeros((len(param_rows), dim))
+        for k, (dr, ds) in enumerate(zip(param_rows, param_cols)):
+            hs.HyperSphere_lower_triangular_derivative_row(expected[k], dim,
+                                                           dr, ds, C, S)
+        # dim 50 has more than PARALLEL_MIN_ANGLES parameters
+        for num_threads in (1, 2):
+            rows = np.full((len(param_rows), dim), np.nan)
+            hsp.HyperSphere_lower_triangular_derivative_rows(
+                rows, dim, param_rows.astype(np.intp),
+                param_cols.astype(np.intp), C, S, num_threads)
+            np.testing.assert_allclose(rows, expected, rtol=1e-14,
+                                       atol=1e-15)
+
+# =============================================================================
+# The NumPy (and, when built, Cython) HyperSphere against the pure Python one
+# =============================================================================
+def random_zeta(dim, rng, b=None):
+    m = dim * (dim - 1) // 2
+    return rng.uniform(0.05, np.pi - 0.05, m if b is None else (b, m))
+
+def test_backends_match_python():
+    backends = [hypersphere_numpy.HyperSphere]
+    try:
+        import hypersphere
+        backends.append(hypersphere.HyperSphere)
+    except ImportError:
+        pass
+    rng = np.random.RandomState(0)
+    for dim in (2, 3, 5, 8):
+        zeta = random_zeta(dim, rng)
+        expected = hypersphere_pure.HyperSphere(dim, zeta)
+        rows, W = expected.gradient_rows
+        for HyperSphere in backends:
+            h = HyperSphere(dim, zeta)
+            np.testing.assert_allclose(h.correlation, expected.correlation,
+                                       rtol=1e-12, atol=1e-14)
+            np.testing.assert_allclose(
+                h._lower_triangular_derivative_rows(),
+                expected._lower_triangular_derivative_rows(), rtol=1e-12,
+                atol=1e-14)
+            rows_h, W_h = h.gradient_rows
+            np.testing.assert_array_equal(rows_h, rows)
+            np.testing.assert_allclose(W_h, W, rtol=1e-12, atol=1e-14)
+            np.testing.assert_allclose(h.gradient, expected.gradient,
+                                       rtol=1e-12, atol=1e-14)
+
+# =============================================================================
+# HyperSphereBatch: the per-vector results, stacked
+# =============================================================================
+def test_batch_matches_per_vector():
+    rng = np.random.RandomState(1)
+    for dim in (2, 4, 6):
+        zetas = random_zeta(dim, rng, b=5)
+        batch = hypersphere_numpy.HyperSphereBatch(dim, zetas)
+        spheres = [hypersphere_numpy.HyperSphere(dim, z) for z in zetas]
+        assert len(batch) == 5
+        np.testing.assert_allclose(
+            batch.correlation, [h.correlation for h in spheres], rtol=1e-13,
+            atol=1e-15)
+        np.testing.assert_allclose(
+            batch._lower_triangular_derivative_rows(),
+            [h._lower_triangular_derivative_rows() for h in spheres],
+            rtol=1e-13, atol=1e-15)
+        rows, W = batch.gradient_rows
+        np.testing.assert_array_equal(rows, spheres[0].gradient_rows[0])
+        np.testing.assert_allclose(
+            W, [h.gradient_rows[1] for h in spheres], rtol=1e-13, atol=1e-15)
+        np.testing.assert_allclose(
+            batch.gradient, [h.gradient for h in spheres], rtol=1e-13,
+            atol=1e-15)
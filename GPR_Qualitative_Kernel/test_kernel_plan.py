@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from kernel_plan import compile_kernel
+from kernels import RBF, ConstantKernel
+import qualitative_kernels as qk
+
+import numpy as np
+
+# =============================================================================
+# KernelPlan: K and its contracted gradient equal those of the kernel
+# =============================================================================
+def make_data(n=20, seed=0):
+    rng = np.random.RandomState(seed)
+    X = np.hstack([rng.rand(n, 2), np.eye(3)[rng.randint(3, size=n)],
+                   np.eye(4)[rng.randint(4, size=n)]])
+    W = rng.randn(n, n)
+    return X, W
+
+def uc(dim, seed):
+    zeta = np.random.RandomState(seed).uniform(0.2, 2.5,
+                                               dim * (dim - 1) // 2)
+    return qk.UnrestrictiveCorrelation(dim, zeta)
+
+def test_plan_matches_kernel():
+    X, W = make_data()
+    f = qk.Projection([2, 3, 4], "f", uc(3, 0))
+    g = qk.Projection([5, 6, 7, 8], "g", uc(4, 1))
+    for kernel in (
+            ConstantKernel(2.0) * qk.Tensor(
+                [qk.Projection([0, 1], "x", RBF([0.5, 0.8])), f, g]),
+            qk.Tensor([ConstantKernel(0.5),
+                       qk.Projection([0, 1], "x", RBF(0.6)), g]),
+            # nested products, and a kernel on all the columns
+            ConstantKernel(1.5) * (f * qk.Tensor([g]))
+            * RBF([1.0] * X.shape[1]),
+            qk.Projection([5, 6, 7, 8], "g",
+                          qk.ExchangeableCorrelation(4, 0.3)) * f):
+        plan = compile_kernel(kernel, X)
+        assert plan is not None and plan.n_dims == kernel.n_dims
+        rng = np.random.RandomState(2)
+        for theta in (kernel.theta,
+                      kernel.theta + rng.uniform(-0.3, 0.3, kernel.n_dims)):
+            K, K_gradient = kernel.clone_with_theta(theta)(X,
+                                                           eval_gradient=True)
+            np.testing.assert_allclose(plan(theta), K, rtol=1e-12,
+                                       atol=1e-14)
+            np.testing.assert_allclose(
+                plan.contract_gradient(W),
+                np.einsum("ij,ijl->l", W, K_gradient), rtol=1e-10,
+                atol=1e-12)
+
+def test_unsupported_kernels():
+    X, W = make_data()
+    rbf = qk.Projection([0, 1], "x", RBF([0.5, 0.8]))
+    f = qk.Projection([2, 3, 4], "f", uc(3, 0))
+    for kernel in (rbf + f, rbf ** 2, qk.DirectSum([rbf, f]),
+                   ConstantKernel(2.0) * qk.Tensor([rbf ** 2, f])):
+        assert compile_kernel(kernel, X) is None
+    # inducing inputs inside the simplex are not level codes
+    X[0, 2:5] = 1.0 / 3
+    assert compile_kernel(rbf * f, X) is None
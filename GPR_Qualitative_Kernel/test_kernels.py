@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from kernels import Kernel, Matern, PairwiseKernel, TrainingDataCache
+from kernels import RBF, ConstantKernel, WhiteKernel, ThetaLayout
+from kernels import training_data_cache
+import kernels
+import qualitative_kernels as qk
+
+import gc
+
+import numpy as np
+
+# =============================================================================
+# Analytic gradients, compared to central finite differences in log(theta)
+# =============================================================================
+def numerical_gradient(kernel, X, eps=1e-6):
+    theta = kernel.theta
+    grad = []
+    for i in range(len(theta)):
+        d = np.zeros_like(theta)
+        d[i] = eps
+        grad.append((kernel.clone_with_theta(theta + d)(X) -
+                     kernel.clone_with_theta(theta - d)(X)) / (2 * eps))
+    return np.dstack(grad)
+
+def make_data(n=25, d=3, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n, d)
+    X[3] = X[4]     # a duplicate row, distance 0
+    W = rng.randn(n, n)
+    return X, W
+
+def check_gradient(kernel, X, W):
+    K, K_gradient = kernel(X, eval_gradient=True)
+    np.testing.assert_allclose(K_gradient, numerical_gradient(kernel, X),
+                               rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(kernel.contract_gradient(X, W),
+                               np.einsum("ij,ijl->l", W, K_gradient),
+                               rtol=1e-10, atol=1e-10)
+
+def test_matern_general_nu():
+    X, W = make_data()
+    for nu in (0.3, 0.7, 1.0, 2.0, 3.5):
+        for length_scale in (0.6, [0.5, 0.8, 1.3]):
+            kernel = Matern(length_scale, nu=nu)
+            check_gradient(kernel, X, W)
+            # the same on training data, from the cached distances
+            X_train = X.copy()
+            cache = TrainingDataCache(X_train)
+            check_gradient(kernel, X_train, W)
+
+def test_pairwise_metrics():
+    X, W = make_data()
+    for metric, kwargs in (("rbf", None), ("laplacian", None),
+                           ("chi2", None),
+                           ("polynomial", {"degree": 2, "coef0": 0.5}),
+                           ("poly", None), ("sigmoid", None),
+                           ("linear", None), ("cosine", None),
+                           ("additive_chi2", None)):
+        kernel = PairwiseKernel(gamma=0.7, metric=metric,
+                                pairwise_kernels_kwargs=kwargs)
+        check_gradient(kernel, X, W)
+
+def test_cross_contractions():
+    # the overrides against the defaults of Kernel, which use k(X, X)'s
+    # gradient and finite differences in Y
+    X, W = make_data()
+    Y, w = X[:7] + 0.1, W[0]
+    W = W[:, :7]
+    for kernel in (ConstantKernel(2.0) * RBF([0.5, 0.8, 1.3]) ** 1.5,
+                   Matern(0.7, nu=2.5) + WhiteKernel(0.1),
+                   RBF(0.6) * Matern([0.5, 0.8, 1.3], nu=0.7)):
+        np.testing.assert_allclose(kernel.contract_gradient(X, W, Y),
+                                   Kernel.contract_gradient(kernel, X, W, Y),
+                                   rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(
+            kernel.contract_diag_gradient(X, w),
+            Kernel.contract_diag_gradient(kernel, X, w),
+            rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(
+            kernel.contract_input_gradient(X, Y, W),
+            Kernel.contract_input_gradient(kernel, X, Y, W),
+            rtol=1e-5, atol=1e-7)
+
+def test_theta_layout():
+    X = make_data(n=10)[0]
+    X = np.hstack((X, np.eye(3)[np.arange(10) % 3]))
+    rbf = qk.Projection([0, 1, 2], "x", RBF([0.5, 0.8, 1.3]))
+    uc = qk.Projection([3, 4, 5], "f",
+                       qk.UnrestrictiveCorrelation(3, [1.0, 1.2, 0.7]))
+    for kernel in (ConstantKernel(2.0) * qk.Tensor([rbf, uc]),
+                   rbf + uc ** 2 + WhiteKernel(0.1),
+                   qk.DirectSum([rbf, ConstantKernel(0.5) * uc]),
+                   # vector hyperparameters of length 1
+                   ConstantKernel(2.0) * RBF([0.5]),
+                   Matern([0.5], nu=1.5)
+                   * RBF(0.5, length_scale_bounds="fixed")):
+        layout = ThetaLayout(kernel.clone_with_theta(kernel.theta))
+        assert layout.n_dims == kernel.n_dims
+        np.testing.assert_array_equal(layout.bounds, kernel.bounds)
+        theta = kernel.theta + np.linspace(-0.3, 0.3, kernel.n_dims)
+        expected = kernel.clone_with_theta(theta)
+        # twice, the second time over the values set in place
+        for repeat in range(2):
+            k = layout.set_theta(theta)
+            np.testing.assert_allclose(k.theta, theta, rtol=1e-14)
+            np.testing.assert_allclose(k(X), expected(X), rtol=1e-14)
+        params = expected.get_params()
+        for name, value in k.get_params().items():
+            if isinstance(params[name], (float, np.ndarray)):
+                assert np.shape(value) == np.shape(params[name]), name
+
+# =============================================================================
+# TrainingDataCache: found by the identity and the values of its array
+# =============================================================================
+def test_training_data_cache_lookup():
+    X, W = make_data()
+    X_train = X.copy()
+    cache = TrainingDataCache(X_train)
+    assert training_data_cache(X_train) is cache
+    assert training_data_cache(X) is None
+    K = RBF(0.7)(X_train)
+    # modified in place, the cached distances are no longer used
+    x = X_train[0, 0]
+    X_train[0, 0] = x + 1.0
+    assert training_data_cache(X_train) is None
+    np.testing.assert_allclose(RBF(0.7)(X_train), RBF(0.7)(X_train.copy()),
+                               rtol=1e-14)
+    X_train[0, 0] = x
+    assert training_data_cache(X_train) is cache
+    np.testing.assert_array_equal(RBF(0.7)(X_train), K)
+    # the registry does not keep dead caches
+    key = id(X_train)
+    del cache
+    gc.collect()
+    assert key not in kernels._training_data_caches
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from gpr import GaussianProcessRegressor
+from kernels import ConstantKernel, RBF, TrainingDataCache
+import qualitative_kernels as qk
+
+import numpy as np
+import pytest
+
+# =============================================================================
+# Projection onto a categorical kernel: level codes of one-hot data
+# =============================================================================
+def make_data(n=30, seed=0):
+    rng = np.random.RandomState(seed)
+    codes = rng.randint(3, size=n)
+    X = np.hstack([rng.rand(n, 1), np.eye(3)[codes]])
+    y = X[:, 0] + np.array([0.0, 1.0, 2.5])[codes]
+    return X, y
+
+def make_kernel():
+    uc = qk.UnrestrictiveCorrelation(3, zeta=[1.0, 1.2, 0.8])
+    return ConstantKernel() * qk.Tensor(
+        [qk.Projection([0], name="x"),
+         qk.Projection([1, 2, 3], name="f", kernel=uc)])
+
+def test_codes_match_dummies():
+    X, y = make_data()
+    uc = qk.UnrestrictiveCorrelation(3, zeta=[1.0, 1.2, 0.8])
+    ec = qk.ExchangeableCorrelation(3, zeta=0.5)
+    for kernel in (qk.Projection([1, 2, 3], name="f", kernel=uc),
+                   qk.Projection([1, 2, 3], name="f", kernel=ec)):
+        K = kernel.kernel(X[:, 1:])
+        np.testing.assert_allclose(kernel(X), K, rtol=1e-12)
+        np.testing.assert_allclose(kernel(X[:5], X), K[:5], rtol=1e-12)
+
+def test_predict_reused_buffer():
+    X, y = make_data()
+    gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-6,
+                                   optimizer=None).fit(X, y)
+    buf = np.array([[0.5, 1.0, 0.0, 0.0]])
+    gpr.predict(buf)
+    buf[0, 1:] = [0.0, 0.0, 1.0]
+    np.testing.assert_array_equal(gpr.predict(buf), gpr.predict(buf.copy()))
+    assert abs(gpr.predict(buf)[0] - 3.0) < 0.5
+
+# =============================================================================
+# log_marginal_likelihood_batch takes its HyperSpheres from HyperSphereBatch
+# =============================================================================
+def test_lml_batch_prefetches_hyperspheres():
+    X, y = make_data()
+    gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-6,
+                                   optimizer=None).fit(X, y)
+    rng = np.random.RandomState(0)
+    thetas = np.tile(gpr.kernel_.theta, (40, 1))
+    thetas[:, -3:] = rng.uniform(0.3, 2.8, (40, 3))
+    qk._hypersphere_cache.clear()
+    lml, grad = gpr.log_marginal_likelihood_batch(thetas, eval_gradient=True,
+                                                  batch_size=35)
+    # no HyperSphere built, though 40 thetas overflow the cache
+    assert qk._hypersphere_cache.misses == 0
+    gpr._reset_lml_cache()
+    for i, theta in enumerate(thetas):
+        lml_i, grad_i = gpr.log_marginal_likelihood(theta, eval_gradient=True)
+        np.testing.assert_allclose(lml[i], lml_i, rtol=1e-10)
+        np.testing.assert_allclose(grad[i], grad_i, rtol=1e-8, atol=1e-10)
+
+# =============================================================================
+# HyperSphere cache: keyed on the zeta values and the backend, read-only
+# =============================================================================
+def test_hypersphere_cache():
+    X = np.eye(3)[[0, 1, 2, 1]]
+    uc = qk.UnrestrictiveCorrelation(3, zeta=[1.0, 1.2, 0.8])
+    qk._hypersphere_cache.clear()
+    K = uc(X)
+    assert (qk._hypersphere_cache.hits, qk._hypersphere_cache.misses) == \
+        (0, 1)
+    # the same angles, also in a clone, hit
+    uc(X, eval_gradient=True)
+    clone = uc.clone_with_theta(uc.theta)
+    np.testing.assert_array_equal(clone(X), K)
+    assert (qk._hypersphere_cache.hits, qk._hypersphere_cache.misses) == \
+        (2, 1)
+    uc.zeta = np.array([1.0, 1.2, 0.9])
+    uc(X)
+    assert qk._hypersphere_cache.misses == 2
+
+    # the shared arrays cannot be modified, the public copy can
+    h = uc._hypersphere_entry()
+    for a in (h.correlation, h.lower_triangular, h.derivative_rows,
+              h.gradient_rows[1]):
+        with pytest.raises(ValueError):
+            a[0, 0] = 2.0
+    uc.correlation[0, 0] = 2.0
+
+    # least recently used entries are evicted
+    cache = qk._HyperSphereCache(maxsize=2)
+    for zeta in ([0.5], [0.6], [0.5], [0.7], [0.6]):
+        cache.get(2, np.array(zeta))
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # another backend does not reuse the entries of the previous one
+    backend = qk.hypersphere_backend()
+    try:
+        qk.set_hypersphere_backend("python")
+        misses = qk._hypersphere_cache.misses
+        np.testing.assert_allclose(uc(X), qk.UnrestrictiveCorrelation(
+            3, zeta=[1.0, 1.2, 0.9])(X), rtol=1e-12)
+        assert qk._hypersphere_cache.misses == misses + 1
+        assert isinstance(uc.hypersphere, qk.hypersphere_pure.HyperSphere)
+    finally:
+        qk.set_hypersphere_backend(backend)
+
+# =============================================================================
+# Tensor and DirectSum: nested gradients written into one array
+# =============================================================================
+def test_nested_gradient():
+    X, y = make_data()
+    uc = qk.UnrestrictiveCorrelation(3, zeta=[1.0, 1.2, 0.8])
+    kernel = qk.Tensor(
+        [qk.DirectSum([qk.Projection([0], name="x", kernel=RBF(0.5)),
+                       qk.Projection([1, 2, 3], name="f", kernel=uc)]),
+         qk.Projection([1, 2, 3], name="g", kernel=qk.Tensor(
+             [qk.UnrestrictiveCorrelation(3, zeta=[0.6, 2.0, 1.1])]))])
+    K, K_gradient = kernel(X, eval_gradient=True)
+    np.testing.assert_allclose(K, kernel(X), rtol=1e-14)
+    theta, eps = kernel.theta, 1e-6
+    for i in range(len(theta)):
+        step = np.zeros_like(theta)
+        step[i] = eps
+        numerical = (kernel.clone_with_theta(theta + step)(X) -
+                     kernel.clone_with_theta(theta - step)(X)) / (2 * eps)
+        np.testing.assert_allclose(K_gradient[:, :, i], numerical,
+                                   rtol=1e-5, atol=1e-8)
+
+    # single precision distances stay single, unless a factor is double
+    X_train = X.copy()
+    cache = TrainingDataCache(X_train, dtype=np.float32)
+    rbf = qk.Tensor([qk.Projection([0], name="x", kernel=RBF(0.5)),
+                     qk.Projection([0], name="y", kernel=RBF(0.7))])
+    assert rbf(X_train, eval_gradient=True)[1].dtype == np.float32
+    mixed = qk.Tensor([qk.Projection([0], name="x", kernel=RBF(0.5)),
+                       qk.Projection([1, 2, 3], name="f", kernel=uc)])
+    assert mixed(X_train, eval_gradient=True)[1].dtype == np.float64
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from gpr import GaussianProcessRegressor
+from sparse_gpr import SparseGaussianProcessRegressor
+from kernels import RBF, ConstantKernel
+from qualitative_kernels import Projection, Tensor, UnrestrictiveCorrelation
+
+import numpy as np
+
+# =============================================================================
+# SparseGaussianProcessRegressor (FITC)
+# =============================================================================
+def make_data(n=30, seed=0):
+    """Two continuous columns and a factor with three levels."""
+    rng = np.random.RandomState(seed)
+    codes = rng.randint(3, size=n)
+    X = np.hstack((rng.rand(n, 2), np.eye(3)[codes]))
+    y = np.sin(3 * X[:, 0]) + X[:, 1] + 0.5 * codes
+    return X, y
+
+def make_kernel():
+    return Tensor([ConstantKernel(2.0),
+                   Projection([0, 1], "continuous", RBF([0.4, 0.7])),
+                   Projection([2, 3, 4], "f",
+                              UnrestrictiveCorrelation(3, [1.0, 1.2, 0.7]))])
+
+def test_fitc_gradient():
+    X, y = make_data()
+    sgpr = SparseGaussianProcessRegressor(make_kernel(), n_inducing=8,
+                                          optimizer=None,
+                                          simplex_columns=[[2, 3, 4]],
+                                          random_state=0).fit(X, y)
+    kernel = sgpr.kernel_
+    Z = sgpr.inducing_points_
+    lml, grad_theta, grad_Z = sgpr._fitc_gradient(kernel, Z)
+    assert lml == sgpr.log_marginal_likelihood_value_
+    eps = 1e-6
+    theta = kernel.theta
+    for l in range(len(theta)):
+        step = np.zeros_like(theta)
+        step[l] = eps
+        numerical = (sgpr._fitc(kernel.clone_with_theta(theta + step), Z)[0]
+                     - sgpr._fitc(kernel.clone_with_theta(theta - step),
+                                  Z)[0]) / (2 * eps)
+        np.testing.assert_allclose(grad_theta[l], numerical, rtol=1e-5,
+                                   atol=1e-6)
+    for a in range(Z.shape[0]):
+        for j in range(Z.shape[1]):
+            Z_plus, Z_minus = Z.copy(), Z.copy()
+            Z_plus[a, j] += eps
+            Z_minus[a, j] -= eps
+            numerical = (sgpr._fitc(kernel, Z_plus)[0]
+                         - sgpr._fitc(kernel, Z_minus)[0]) / (2 * eps)
+            np.testing.assert_allclose(grad_Z[a, j], numerical, rtol=1e-5,
+                                       atol=1e-6)
+
+def test_all_inducing_points_match_dense():
+    # with Z = X the FITC covariance is K + alpha * I
+    X, y = make_data()
+    X_test = make_data(n=10, seed=1)[0]
+    sgpr = SparseGaussianProcessRegressor(make_kernel(), n_inducing=len(y),
+                                          alpha=1e-2, optimizer=None,
+                                          random_state=0).fit(X, y)
+    gpr = GaussianProcessRegressor(make_kernel(), alpha=1e-2,
+                                   optimizer=None).fit(X, y)
+    np.testing.assert_allclose(sgpr.log_marginal_likelihood_value_,
+                               gpr.log_marginal_likelihood_value_,
+                               rtol=1e-6)
+    for a, b in zip(sgpr.predict(X_test, return_std=True),
+                    gpr.predict(X_test, return_std=True)):
+        np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+    theta = gpr.kernel_.theta
+    np.testing.assert_allclose(
+        sgpr.log_marginal_likelihood(theta, eval_gradient=True)[1],
+        gpr.log_marginal_likelihood(theta, eval_gradient=True)[1],
+        rtol=1e-5, atol=1e-6)
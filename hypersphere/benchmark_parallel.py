@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Times the derivative rows of HyperSphere for several dimensions.
+
+Compares one hypersphere_cython call per parameter with one call of
+hypersphere_parallel on a single thread and on all threads (which runs
+serially below PARALLEL_MIN_ANGLES parameters).  Build both extensions with
+GPR_Qualitative_Kernel/setup.py, then run from that directory:
+
+$ OMP_NUM_THREADS=4 PYTHONPATH=. python ../hypersphere/benchmark_parallel.py
+"""
+from __future__ import print_function
+
+import timeit
+
+import numpy as np
+
+import hypersphere_cython as hs
+import hypersphere_parallel as hsp
+
+
+def trig_values(dim, rng):
+    zeta = np.zeros((dim, dim))
+    zeta[np.tril_indices(dim, -1)] = rng.uniform(0, np.pi,
+                                                 dim * (dim - 1) // 2)
+    return np.cos(zeta), np.sin(zeta)
+
+
+def per_parameter(rows, dim, param_rows, param_cols, C, S):
+    for k, (dr, ds) in enumerate(zip(param_rows, param_cols)):
+        hs.HyperSphere_lower_triangular_derivative_row(rows[k], dim, dr, ds,
+                                                       C, S)
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    N = 50
+    threads = hsp.max_threads()
+    template = "{:4} {:6} {:12.6f} {:12.6f} {:12.6f}"
+    print("threshold {} angles, {} threads, seconds for {} calls"
+          .format(hsp.PARALLEL_MIN_ANGLES, threads, N))
+    print("{:>4} {:>6} {:>12} {:>12} {:>12}".format(
+        "dim", "angles", "per param", "1 thread", "%d threads" % threads))
+    for dim in (10, 30, 45, 60, 100, 150):
+        C, S = trig_values(dim, rng)
+        param_rows, param_cols = np.tril_indices(dim, -1)
+        param_rows = param_rows.astype(np.intp)
+        param_cols = param_cols.astype(np.intp)
+        rows = np.zeros((len(param_rows), dim))
+        args = (rows, dim, param_rows, param_cols, C, S)
+        rows_parallel = hsp.HyperSphere_lower_triangular_derivative_rows
+        times = [timeit.timeit(lambda: per_parameter(*args), number=N),
+                 timeit.timeit(lambda: rows_parallel(*args, num_threads=1),
+                               number=N),
+                 timeit.timeit(lambda: rows_parallel(*args,
+                                                     num_threads=threads),
+                               number=N)]
+        print(template.format(dim, len(param_rows), *times))
@@ -3,6 +3,7 @@ import numpy as np
 import cython
 from cython.parallel import prange
 cimport numpy as np
+cimport openmp
 
 from libc.math cimport sin, cos, pi
 
@@ -169,3 +170,88 @@ def HyperSphere_ltderiv_row_gradient(X, dLLtXt):
                         grad_[j_, i, k] = grad_i_k_
                 grad_[i, i, k] = 0.0
     return grad
+
+
+# =============================================================================
+# Row dr of d L / d zeta[dr,ds] for all parameters in one call, used by
+# GPR_Qualitative_Kernel/hypersphere.py; k implies both dr and ds, c.f.
+# for k, (dr, ds) in enumerate(np.tril_indices(dim, -1)):
+# Each row is O(dim) work, so threads only pay off for many parameters: below
+# PARALLEL_MIN_ANGLES the rows are filled by a serial loop without the GIL.
+# =============================================================================
+PARALLEL_MIN_ANGLES = 1000
+
+
+def max_threads():
+    """The number of threads prange uses by default (OMP_NUM_THREADS)."""
+    return openmp.omp_get_max_threads()
+
+
+@cython.boundscheck(False)
+@cython.initializedcheck(False)
+@cython.wraparound(False)
+cdef inline void _derivative_row(FLOAT64_t [:, :] dL,
+                                 Py_ssize_t k,
+                                 int dim,
+                                 int dr,
+                                 int ds,
+                                 FLOAT64_t [:, :] C,
+                                 FLOAT64_t [:, :] S) noexcept nogil:
+    """Row k of dL, built with a running product in O(dim)."""
+    cdef int s
+    # prefix = prod_{j<s} of sin(zeta[dr,j]), cos at j = ds
+    cdef FLOAT64_t prefix = 1.0
+    for s in range(dr):
+        if s < ds:
+            dL[k, s] = 0.0
+            prefix = prefix * S[dr, s]
+        elif s == ds:
+            dL[k, s] = -S[dr, s] * prefix
+            prefix = prefix * C[dr, s]
+        else:
+            dL[k, s] = C[dr, s] * prefix
+            prefix = prefix * S[dr, s]
+    # now set the diagonal, i.e. s = dr
+    dL[k, dr] = prefix
+    for s in range(dr + 1, dim):
+        dL[k, s] = 0.0
+
+
+@cython.boundscheck(False)
+@cython.initializedcheck(False)
+@cython.wraparound(False)  # turn off negative index wrapping
+def HyperSphere_lower_triangular_derivative_rows(np.ndarray dL_arr,
+                                                 int dim,
+                                                 np.ndarray param_rows,
+                                                 np.ndarray param_cols,
+                                                 np.ndarray cos_zeta,
+                                                 np.ndarray sin_zeta,
+                                                 int num_threads=0):
+    """Fills row k of dL_arr, shape (m, dim), with row dr of
+    d L / d zeta[dr,ds] for (dr, ds) = (param_rows[k], param_cols[k]).
+
+    With at least PARALLEL_MIN_ANGLES parameters they are distributed over
+    num_threads threads (0: the OpenMP default), otherwise, or with
+    num_threads=1, filled serially.
+    """
+    # Memoryviews of the numpy arrays
+    cdef FLOAT64_t [:, :] dL = dL_arr
+    cdef Py_ssize_t [:] R = param_rows
+    cdef Py_ssize_t [:] D = param_cols
+    cdef FLOAT64_t [:, :] C = cos_zeta
+    cdef FLOAT64_t [:, :] S = sin_zeta
+
+    cdef Py_ssize_t m = R.shape[0]
+    cdef Py_ssize_t k
+
+    if num_threads <= 0:
+        num_threads = openmp.omp_get_max_threads()
+
+    if num_threads == 1 or m < PARALLEL_MIN_ANGLES:
+        with nogil:
+            for k in range(m):
+                _derivative_row(dL, k, dim, R[k], D[k], C, S)
+    else:
+        for k in prange(m, nogil=True, schedule='static',
+                        num_threads=num_threads):
+            _derivative_row(dL, k, dim, R[k], D[k], C, S)
@@ -28,4 +28,9 @@ setup(
 # documentation. To compile the extension for use in the current directory use:
 # 
 # $ python setup.py build_ext --inplace
+#
+# GPR_Qualitative_Kernel/setup.py builds the same extension next to
+# hypersphere.py, which uses its derivative rows when it is importable.
+# The number of OpenMP threads is OMP_NUM_THREADS, or
+# hypersphere.set_num_threads().
 # =============================================================================